@@ -0,0 +1,237 @@
+"""
+Residual-driven refinement of contamination models.
+
+`refine_list` re-fits every object in its magnitude window with a
+polynomial continuum and updates the model of every FLT it disperses onto,
+whether or not the flat-spectrum model of `compute_full_model` was already
+good enough. Here each object's residual is measured first, and only
+objects above `threshold` are refined, brightest first.
+
+The residual is the mean chi-squared per pixel of SCI - model, the full
+model of the FLT (the object and its neighbours), over the object's
+footprint: the box of its segment in the FLT's segmentation map, spread
+along x over the extent of its first-order trace. Only pixels of positive
+ERR and zero DQ count. The chi-squared of each FLT is summed once per pass
+into an integral image, so each object's residual costs four lookups per
+FLT rather than the extraction of its beams. Refining an object changes
+its neighbours' models, so every object in the window is measured again
+after each pass, and the cycle repeats until none is above the threshold,
+the refinements stop paying off, or the budget of passes or seconds is
+spent.
+
+Use:
+
+    >>> stats = refine_adaptive(grp, poly_order=2, mag_limits=[16, 24],
+    ...     threshold=2., max_iter=3)
+
+"""
+
+import logging
+import numpy as np
+import time
+
+
+# Mean chi-squared per footprint pixel above which an object is refined.
+THRESHOLD = 2.
+
+# Extent of the first-order trace along x, in pixels from the object, when
+# the grism configuration doesn't give it (BEAMA); covers G102 and G141.
+BEAM_EXTENT = [-20, 300]
+
+
+#-------------------------------------------------------------------------------
+
+def flt_footprints(flt, beam_extent=None):
+    """ Finds the footprint of every object on one FLT.
+
+    Parameters
+    ----------
+    flt : grizli.model.GrismFLT
+        With its segmentation map.
+    beam_extent : list of ints
+        The x range of the first order relative to the object. By default
+        BEAMA of the grism configuration, else `BEAM_EXTENT`.
+
+    Returns
+    -------
+    footprints : dict
+        Keys of catalog NUMBER; values of (y0, y1, x0, x1), the box of the
+        object's segment grown along x by `beam_extent`, clipped to the FLT.
+
+    """
+    if beam_extent is None:
+        try:
+            beam_extent = flt.conf.conf['BEAMA']
+        except (AttributeError, KeyError):
+            beam_extent = BEAM_EXTENT
+    seg = np.asarray(flt.seg).astype(int)
+    nx = seg.shape[1]
+
+    # Bounding box of each segment, in one pass over its pixels.
+    y, x = np.nonzero(seg > 0)
+    ids, index = np.unique(seg[y, x], return_inverse=True)
+    y0 = np.full(len(ids), seg.shape[0]); y1 = np.zeros(len(ids), dtype=int)
+    x0 = np.full(len(ids), nx); x1 = np.zeros(len(ids), dtype=int)
+    np.minimum.at(y0, index, y)
+    np.maximum.at(y1, index, y + 1)
+    np.minimum.at(x0, index, x)
+    np.maximum.at(x1, index, x + 1)
+    x0 = np.maximum(x0 + int(beam_extent[0]), 0)
+    x1 = np.minimum(x1 + int(beam_extent[1]), nx)
+
+    return {int(id) : (int(y0[i]), int(y1[i]), int(x0[i]), int(x1[i]))
+        for i, id in enumerate(ids) if x0[i] < x1[i]}
+
+
+#-------------------------------------------------------------------------------
+
+def _integral(image):
+    """ Returns the summed-area table of `image`, with a leading row and
+    column of zeros, so the sum over [y0:y1, x0:x1] is
+    t[y1, x1] - t[y0, x1] - t[y1, x0] + t[y0, x0].
+    """
+    table = np.zeros((image.shape[0] + 1, image.shape[1] + 1))
+    np.cumsum(np.cumsum(image, axis=0), axis=1, out=table[1:, 1:])
+    return table
+
+
+#-------------------------------------------------------------------------------
+
+def flt_chi2(flt):
+    """ Integral images of the chi-squared of an FLT's model, and of its
+    valid pixels, for `object_residuals`.
+    """
+    err = flt.grism['ERR']
+    resid = flt.grism['SCI'] - flt.model
+    valid = (err > 0) & (flt.grism['DQ'] == 0) & np.isfinite(resid)
+    chi2 = np.zeros(resid.shape)
+    chi2[valid] = (resid[valid] / err[valid])**2
+
+    return _integral(chi2), _integral(valid)
+
+
+#-------------------------------------------------------------------------------
+
+def object_residuals(grp, ids, footprints=None):
+    """ Mean chi-squared per pixel of the current models over the footprint
+    of each object, in all the FLTs it falls on.
+
+    Parameters
+    ----------
+    grp : grizli.multifit.GroupFLT
+        With models from `compute_full_model`.
+    ids : list of ints
+        The catalog NUMBERs.
+    footprints : list of dicts
+        From `flt_footprints`, for each FLT of `grp`; found if not given.
+
+    Returns
+    -------
+    chi2 : array
+        For each id; NaN where the object has no valid footprint pixel.
+
+    """
+    if footprints is None:
+        footprints = [flt_footprints(flt) for flt in grp.FLTs]
+
+    chi2, npix = np.zeros(len(ids)), np.zeros(len(ids))
+    for flt, boxes in zip(grp.FLTs, footprints):
+        table, count = flt_chi2(flt)
+        for i, id in enumerate(ids):
+            if id not in boxes:
+                continue
+            y0, y1, x0, x1 = boxes[id]
+            chi2[i] += table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+            npix[i] += count[y1, x1] - count[y0, x1] - count[y1, x0] + count[y0, x0]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(npix > 0, chi2 / np.maximum(npix, 1), np.nan)
+
+
+#-------------------------------------------------------------------------------
+
+def refine_adaptive(grp, poly_order=2, mag_limits=[16, 24], threshold=THRESHOLD,
+    max_iter=3, max_time=None, tol=0.1, verbose=False):
+    """ Refines only the objects whose models don't match the data.
+
+    Parameters
+    ----------
+    grp : grizli.multifit.GroupFLT
+        With models from `compute_full_model`. Refined in place.
+    poly_order : int
+        As for `refine_list`.
+    mag_limits : list of floats
+        As for `refine_list`; objects outside are never refined.
+    threshold : float
+        Mean chi-squared per footprint pixel above which an object is 
+        refined.
+    max_iter : int
+        Most measure-and-refine passes.
+    max_time : float
+        Seconds after which no new pass starts. None for no limit.
+    tol : float
+        An object already refined is refined again only if its residual
+        fell by more than this fraction since it was last measured.
+    verbose : {True, False}
+        Passed to `refine_list`.
+
+    Returns
+    -------
+    stats : dict
+        'measured', 'refined' (counts over all passes), 'passes', and
+        'above' (objects still above the threshold at the end).
+
+    """
+    start = time.time()
+    ids = np.asarray(grp.catalog['NUMBER']).astype(int)
+    mags = np.asarray(grp.catalog['MAG_AUTO'], dtype=float)
+    sel = (mags >= mag_limits[0]) & (mags <= mag_limits[1])
+    order = np.argsort(mags[sel], kind='stable')
+    ids, mags = ids[sel][order], mags[sel][order]
+    mag_of = dict(zip(ids, mags))
+    footprints = [flt_footprints(flt) for flt in grp.FLTs]
+
+    last = {}
+    stats = {'measured':0, 'refined':0, 'passes':0, 'above':0}
+    todo = ids
+    for iteration in range(max_iter):
+        if max_time is not None and time.time() - start > max_time:
+            logging.info("Adaptive refinement stopped at its time budget")
+            break
+
+        chi2 = object_residuals(grp, todo, footprints=footprints)
+        stats['measured'] += len(todo)
+
+        refine = np.zeros(len(todo), dtype=bool)
+        for i, id in enumerate(todo):
+            if not chi2[i] > threshold:
+                continue
+            if id in last and chi2[i] > (1 - tol) * last[id]:
+                # Refined before without getting much better.
+                continue
+            refine[i] = True
+        stats['above'] = int((chi2 > threshold).sum())
+
+        logging.info("Refinement pass {}: {} of {} objects above chi2 {:.1f}, "
+            "refining {}".format(iteration + 1, stats['above'], len(todo),
+            threshold, refine.sum()))
+        if not refine.any():
+            break
+
+        refine_ids = todo[refine]
+        refine_mags = np.array([mag_of[id] for id in refine_ids])
+        grp.refine_list(ids=refine_ids, mags=refine_mags, poly_order=poly_order,
+            mag_limits=mag_limits, verbose=verbose)
+        stats['refined'] += len(refine_ids)
+        stats['passes'] += 1
+
+        for id, c in zip(refine_ids, chi2[refine]):
+            last[id] = c
+        # Refinement moves the models of the neighbours too, so every 
+        # object is measured again, even those that were below.
+
+    logging.info("Adaptive refinement: refined {} of {} objects in {} passes, "
+        "{:.0f} s".format(stats['refined'], len(ids), stats['passes'],
+        time.time() - start))
+
+    return stats
@@ -0,0 +1,416 @@
+#! /usr/bin/env python
+
+"""
+End-to-end performance harness of `clear_grizli_pipeline.py` on a
+synthetic field (`synthetic_field.py`), offline.
+
+The pipeline is pointed at the synthetic RAW/ and REF/ directories and a
+fresh time-stamped outputs directory, and its stages run one after the
+other, each in a forked process of its own so their measurements don't
+mix:
+
+* find_files : `find_files` on RAW/.
+* model : `model`, staging the FLTs from RAW/ (the synthetic FLTs stand in
+  for prepped ones) and computing the contamination models.
+* refine : the refinement alone, timed twice from the same unrefined
+  models (restored from the model cache of the model stage): as
+  refine:all, `refine_list` of every object in the window, and as
+  refine:adaptive, `refine_adaptive`. Not run by default.
+* fit : `model` loading the saved models, then `fit`. The loading time is
+  reported on its own as load_wall.
+
+For each stage the wall time, the CPU time (user + system, of the stage
+and every process it waited for) and the peak resident memory (the largest
+of the stage and its workers) are printed, written to benchmark.json in the
+outputs directory, and appended to <outdir>/benchmarks.jsonl along with the
+configuration and git revision, so runs before and after a change can be
+compared.
+
+By default each run models from an empty model cache of its own; use
+--warm to share <outdir>/model_cache between runs.
+
+Use:
+
+    >>> python benchmark_pipeline.py --outdir /tmp/synthetic --sources 300 \
+        --visits 2 --workers 4 --steps find_files model fit
+
+    >>> python benchmark_pipeline.py --outdir /tmp/synthetic --steps refine
+
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import traceback
+
+import clear_grizli_pipeline as pipeline
+
+from model_cache import restore_models
+from model_deps import load_manifest
+from set_paths import paths
+from staging import stage_files
+from synthetic_field import make_field
+from utils import store_outputs
+
+
+STAGES = ['find_files', 'model', 'refine', 'fit']
+
+# Stages run unless others are asked for.
+DEFAULT_STAGES = ['find_files', 'model', 'fit']
+
+
+#-------------------------------------------------------------------------------
+
+def _peak_rss():
+    """ Returns the peak resident memory of this process and of its waited
+    children, in bytes.
+    """
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return unit * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+#-------------------------------------------------------------------------------
+
+def _cpu_time():
+    """ Returns the user + system seconds of this process and of its waited
+    children.
+    """
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+#-------------------------------------------------------------------------------
+
+def _stage_child(conn, func, args):
+    """ Process target. Runs `func(*args)` and sends back (result,
+    measurements, error or None).
+    """
+    wall, cpu = time.time(), _cpu_time()
+    result, error = None, None
+    try:
+        result = func(*args)
+    except Exception:
+        error = traceback.format_exc()
+    stats = {'wall':time.time() - wall, 'cpu':_cpu_time() - cpu,
+             'peak_rss':_peak_rss()}
+    conn.send((result, stats, error))
+    conn.close()
+
+
+#-------------------------------------------------------------------------------
+
+def run_stage(name, func, *args):
+    """ Runs one stage in a forked process and measures it.
+
+    Parameters
+    ----------
+    name : string
+        The stage, for the log.
+    func : function
+        Runs the stage; its return value must pickle.
+    args : tuple
+        Passed to `func`.
+
+    Returns
+    -------
+    result :
+        What `func` returned.
+    stats : dict
+        'wall', 'cpu' (seconds) and 'peak_rss' (bytes).
+
+    """
+    logging.info("Benchmarking stage {}".format(name))
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context('fork').Process(target=_stage_child,
+        args=(child, func, args))
+    process.start()
+    child.close()
+    try:
+        result, stats, error = parent.recv()
+    except EOFError:
+        result, stats, error = None, None, "exited with {}".format(
+            process.exitcode)
+    process.join()
+
+    if error is not None:
+        raise RuntimeError("Stage {} failed:\n{}".format(name, error))
+
+    return result, stats
+
+
+#-------------------------------------------------------------------------------
+
+def _find_files(field):
+    return pipeline.find_files(fields=[field])
+
+
+def _model(visits, field, raw_dir, refine):
+    pipeline.model(visits=visits, field=field, ref_filter='F105W',
+        use_prep_path=raw_dir, load_only=False, refine=refine)
+
+
+def _refine(visits, field, refine):
+    # From the unrefined models, in a directory of its own so the saved 
+    # models of the run are left alone.
+    grism_files = pipeline.field_files(visits, field)[0]
+    manifest = load_manifest('{}.model_manifest.json'.format(field))
+    if manifest is None:
+        raise RuntimeError("No model manifest; run the model stage first")
+    p = pipeline.Pointing(field=field, ref_filter='F105W')
+    scratch = 'refine_{}'.format(refine)
+    if not os.path.isdir(scratch):
+        os.makedirs(scratch)
+    stage_files([os.path.abspath(flt) for flt in grism_files], dest=scratch,
+        readme=None)
+    os.chdir(scratch)
+    if restore_models(grism_files, manifest) != []:
+        raise RuntimeError("Unrefined models missing from the model cache")
+
+    grp = pipeline.GroupFLT(grism_files=grism_files, direct_files=[],
+        ref_file=os.path.join(pipeline.PATH_REF, p.ref_image),
+        seg_file=os.path.join(pipeline.PATH_REF, p.seg_map),
+        catalog=os.path.join(pipeline.PATH_REF, p.catalog), pad=p.pad, 
+        cpu_count=1)
+    params = pipeline.MODEL_PARAMS
+    start = time.time()
+    if refine == 'adaptive':
+        refined = pipeline.refine_adaptive(grp, poly_order=params['poly_order'],
+            mag_limits=params['mag_limits'], **pipeline.ADAPTIVE_PARAMS)['refined']
+    else:
+        grp.refine_list(poly_order=params['poly_order'], 
+            mag_limits=params['mag_limits'])
+        mags = grp.catalog['MAG_AUTO']
+        refined = int(((mags >= params['mag_limits'][0]) & 
+            (mags <= params['mag_limits'][1])).sum())
+    return {'refine_wall':time.time() - start, 'refined':refined}
+
+
+def _fit(visits, field, mag_lim, workers, make_figures, extract_workers):
+    start = time.time()
+    grp = pipeline.model(visits=visits, field=field, ref_filter='F105W',
+        use_prep_path='.', use_model_path='.', load_only=True)
+    load_wall = time.time() - start
+    pipeline.fit(grp, field=field, mag_lim=mag_lim, workers=workers,
+        make_figures=make_figures, extract_workers=extract_workers)
+    return {'load_wall':load_wall}
+
+
+#-------------------------------------------------------------------------------
+
+def git_revision():
+    """ Returns the git revision of this repository, or '' if unknown.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+#-------------------------------------------------------------------------------
+
+def benchmark(outdir, field='GS1', steps=DEFAULT_STAGES, n_sources=300, n_visits=2,
+    seed=1, mag_lim=24, workers=1, extract_workers=0, make_figures=False,
+    refine='all', warm=False):
+    """ Runs the pipeline stages on a synthetic field and measures them.
+
+    Parameters
+    ----------
+    outdir : string
+        Holds the synthetic field (written if there is no RAW/ yet), the
+        outputs/ of each run and benchmarks.jsonl.
+    field : string
+        The pointing of the synthetic field.
+    steps : list of strings
+        Stages to run, from `STAGES`, in that order. 'refine' or 'fit'
+        without 'model' use the models of the latest run.
+    n_sources, n_visits, seed : int
+        Of the synthetic field, if written.
+    mag_lim : float
+        Magnitude limit of the fit.
+    workers : int
+        Processes of the fit.
+    extract_workers : int
+        Processes extracting while fitting; 0 to not stream.
+    make_figures : {True, False}
+        Whether the fit draws its PNGs.
+    refine : string
+        'all' or 'adaptive' refinement of the models of the model stage.
+    warm : {True, False}
+        Share the model cache with earlier runs.
+
+    Returns
+    -------
+    report : dict
+        The configuration and the measurements of each stage.
+
+    """
+    outdir = os.path.abspath(outdir)
+    raw_dir = os.path.join(outdir, 'RAW')
+    if not os.path.isdir(raw_dir):
+        logging.info("Writing a synthetic field in {}".format(outdir))
+        make_field(outdir, field=field, n_sources=n_sources,
+            n_visits=n_visits, seed=seed)
+
+    path_outputs = os.path.join(outdir, 'outputs')
+    if not os.path.isdir(path_outputs):
+        os.makedirs(path_outputs)
+    if 'model' in steps or 'find_files' in steps:
+        run_dir = store_outputs(path_outputs=path_outputs, store_type='')
+    else:
+        runs = sorted(os.listdir(path_outputs))
+        run_dir = os.path.join(path_outputs, runs[-1])
+
+    pipeline.PATH_RAW = raw_dir
+    pipeline.PATH_REF = os.path.join(outdir, 'REF')
+    pipeline.PATH_OUTPUTS = path_outputs
+    pipeline.PATH_OUTPUTS_TIMESTAMP = run_dir
+    cache_root = outdir if warm else run_dir
+    paths['path_to_model_cache'] = os.path.join(cache_root, 'model_cache')
+    paths['path_to_template_cache'] = os.path.join(outdir, 'template_cache')
+    os.chdir(run_dir)
+
+    report = {'revision':git_revision(), 'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host':platform.node(), 'cpus':multiprocessing.cpu_count(),
+              'outputs':run_dir,
+              'config':{'field':field, 'n_sources':n_sources,
+                        'n_visits':n_visits, 'seed':seed, 'mag_lim':mag_lim,
+                        'workers':workers, 'extract_workers':extract_workers,
+                        'make_figures':make_figures, 'refine':refine,
+                        'warm':warm},
+              'stages':{}}
+
+    if 'find_files' in steps:
+        (visits, filters), report['stages']['find_files'] = \
+            run_stage('find_files', _find_files, field)
+    else:
+        # The other stages still need the visits.
+        visits, filters = _find_files(field)
+    if 'model' in steps:
+        report['stages']['model'] = run_stage('model', _model, visits, field,
+            raw_dir, refine)[1]
+    if 'refine' in steps:
+        for method in ['all', 'adaptive']:
+            extra, stats = run_stage('refine:' + method, _refine, visits, 
+                field, method)
+            stats.update(extra)
+            report['stages']['refine:' + method] = stats
+    if 'fit' in steps:
+        extra, stats = run_stage('fit', _fit, visits, field, mag_lim, workers,
+            make_figures, extract_workers)
+        stats.update(extra)
+        report['stages']['fit'] = stats
+
+    with open(os.path.join(run_dir, 'benchmark.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+    with open(os.path.join(outdir, 'benchmarks.jsonl'), 'a') as f:
+        f.write(json.dumps(report) + '\n')
+
+    return report
+
+
+#-------------------------------------------------------------------------------
+
+def print_report(report):
+    """ Prints the measurements of `benchmark` as a table.
+    """
+    print("Revision {}, {} on {} CPUs".format(report['revision'] or '?',
+        report['time'], report['cpus']))
+    print("{:<16s} {:>10s} {:>10s} {:>12s}".format('stage', 'wall [s]',
+        'cpu [s]', 'peak RSS [MB]'))
+    for stage, stats in report['stages'].items():
+        print("{:<16s} {:>10.2f} {:>10.2f} {:>12.1f}".format(stage,
+            stats['wall'], stats['cpu'], stats['peak_rss'] / 1.e6))
+        if 'load_wall' in stats:
+            print("{:<16s} {:>10.2f}".format('  (loading)', stats['load_wall']))
+        if 'refine_wall' in stats:
+            print("{:<16s} {:>10.2f}   {} objects refined".format(
+                '  (refining)', stats['refine_wall'], stats['refined']))
+
+
+#-------------------------------------------------------------------------------
+
+def parse_args():
+    """Parses command line arguments.
+
+    Returns
+    -------
+    args : object
+        Containing the outdir, field, steps, sources, visits, seed, mlim,
+        workers, extract_workers, figures, refine and warm arguments.
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outdir', dest = 'outdir',
+                        action = 'store', type = str, required = True,
+                        help = "Directory of the synthetic field and the runs.")
+    parser.add_argument('--field', dest = 'field',
+                        action = 'store', type = str, required = False,
+                        help = "The pointing. Default is 'GS1'.",
+                        default='GS1')
+    parser.add_argument('--steps', dest = 'steps',
+                        action = 'store', type = str, required = False,
+                        help = "Stages to run. Default is find_files, model and fit.",
+                        nargs='+', default=DEFAULT_STAGES, choices=STAGES)
+    parser.add_argument('--sources', dest = 'sources',
+                        action = 'store', type = int, required = False,
+                        help = "Sources of a new synthetic field. Default is 300.",
+                        default=300)
+    parser.add_argument('--visits', dest = 'visits',
+                        action = 'store', type = int, required = False,
+                        help = "Visits of a new synthetic field. Default is 2.",
+                        default=2)
+    parser.add_argument('--seed', dest = 'seed',
+                        action = 'store', type = int, required = False,
+                        help = "Random seed of a new synthetic field. Default is 1.",
+                        default=1)
+    parser.add_argument('--mlim', dest = 'mag_lim',
+                        action = 'store', type = float, required = False,
+                        help = "Magnitude limit of the fit. Default is 24.",
+                        default=24)
+    parser.add_argument('--workers', dest = 'workers',
+                        action = 'store', type = int, required = False,
+                        help = "Processes of the fit. Default is 1.",
+                        default=1)
+    parser.add_argument('--extract_workers', dest = 'extract_workers',
+                        action = 'store', type = int, required = False,
+                        help = "Processes extracting while fitting. Default is 0.",
+                        default=0)
+    parser.add_argument('--figures', dest = 'figures',
+                        action = 'store_true', required = False,
+                        help = "Draw the fit PNGs.")
+    parser.add_argument('--refine', dest = 'refine',
+                        action = 'store', type = str, required = False,
+                        help = "Refinement of the models. Default is 'all'.",
+                        default='all', choices=['all', 'adaptive'])
+    parser.add_argument('--warm', dest = 'warm',
+                        action = 'store_true', required = False,
+                        help = "Share the model cache between runs.")
+    args = parser.parse_args()
+
+    return args
+
+
+#-------------------------------------------------------------------------------
+#-------------------------------------------------------------------------------
+
+if __name__=="__main__":
+
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    report = benchmark(args.outdir, field=args.field, steps=args.steps,
+        n_sources=args.sources, n_visits=args.visits, seed=args.seed,
+        mag_lim=args.mag_lim, workers=args.workers,
+        extract_workers=args.extract_workers, make_figures=args.figures,
+        refine=args.refine, warm=args.warm)
+    print_report(report)
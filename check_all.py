@@ -66,6 +66,10 @@ from mywfc3 import reprocess_wfc3
 def read_filesinfo():
     """ Reads in the "files.info" file. Assumes you are in the RAW directory.
 
+    Both layouts are read: that of `flt_index.py` (`retrieve_all.make_filesinfo`),
+    whose first line names the columns, and the older one of threedhst's 
+    flt_info.sh, with the filter in the sixth column.
+
     Returns
     -------
     files : numpy array
@@ -75,9 +79,16 @@ def read_filesinfo():
 
     """
     if os.path.isfile('files.info'):
-        
-        files, filters = np.loadtxt('files.info', unpack=True, \
-                                              usecols=(0,5), dtype='S24') 
+
+        with open('files.info') as f:
+            header = f.readline().split()
+        if 'FILE' in header and 'FILTER' in header:
+            info = ascii.read('files.info', format='basic')
+            files = np.array(info['FILE'], dtype='S24')
+            filters = np.array(info['FILTER'], dtype='S24')
+        else:
+            files, filters = np.loadtxt('files.info', unpack=True, \
+                                                  usecols=(0,5), dtype='S24') 
 
     else: 
         print "'files.info' does NOT exist."
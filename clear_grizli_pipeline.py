@@ -13,8 +13,10 @@ Use:
     --fields : (optional) By default all pointings. Or choose from
         [GS1, GS2, GS3, GS4, GS5, ERSPRIME, GN1, GN2, GN3, GN4, GN5, GN7]
 
-    --steps : (optional) By default all pipeline steps. Or choose from
-        [prep, model, fit]
+    --steps : (optional) By default the steps prep, model and fit. Choose 
+        from [prep, model, fit, render]. "render" draws the stack PNGs and
+        full summary PNGs (<field>_<id>.full_summary.png, lighter than the
+        full PNGs of "fit") from the FITS, skipping any that are up to date.
 
     --mlim : (optional) Magnitude limit of extractions. By default "25".
 
@@ -30,6 +32,57 @@ Use:
     --modeldir : (optional) Directory containing files from "model" step.
         By default, ".".
 
+    --workers : (optional) Number of processes over which to spread the
+        objects in the "fit" step, and the direct/grism visit pairs in the
+        "prep" step. By default "1".
+
+    --timeout : (optional) Wall-clock budget in seconds for each object in 
+        the "fit" step. Objects that overrun are killed and recorded in
+        <field>.ledger. By default "600".
+
+    --order : (optional) Order in which the "fit" step takes the objects,
+        "brightest" first or "catalog" order. By default "brightest".
+
+    --plan : (optional) Set to "True" to only print, for each field, how many
+        objects are left to fit and the estimated cost. Combine with 
+        --rerun "True" to plan against the ledgers of the last run. 
+        By default "False".
+
+    --figures : (optional) Set to "False" to write only FITS in the "fit" 
+        step, for the "render" step to draw later. By default "True". The
+        "render" step draws <field>_<id>.full_summary.png, not the 
+        <field>_<id>.full.png of "fit": QA that reads the full PNGs of a 
+        run without figures should read the full summary PNGs instead.
+
+    --prefit_chunk : (optional) Number of objects whose polynomial continuum
+        prefits are solved together in one batched pass. By default "1".
+
+    --extract_workers : (optional) Set above "0" to stream the "fit" step:
+        this many processes extract beams while --workers processes fit the
+        objects already extracted. By default "0", extracting and fitting
+        each object in turn.
+
+    --queue_size : (optional) When streaming, the most objects being extracted
+        or waiting to be fit. By default twice --workers.
+
+    --refine : (optional) How the "model" step refines the contamination
+        models: "all" objects in the magnitude range, or "adaptive", only 
+        those whose residuals over their traces stay high, in repeated 
+        passes. By default "all".
+
+    --dag : (optional) Set to "True" to run the steps as a graph of tasks
+        (`pipeline_dag`): a "prep" task per direct/grism visit pair, and
+        "model", "fit" and "render" tasks per field, each declaring the
+        files it reads and writes. A task whose inputs, parameters and
+        outputs are unchanged since it last succeeded in the outputs
+        directory is skipped, so with --rerun "True" only what changed, or
+        what a crash interrupted, runs again. Tasks of independent visits
+        and fields run in parallel. --prepdir FLTs are staged first;
+        --modeldir is not used. By default "False".
+
+    --jobs : (optional) With --dag "True", the number of tasks run at once.
+        Each task still spreads its own work over --workers. By default "1".
+
     --release : NotImplemented
 
 
@@ -50,6 +103,13 @@ Examples:
 
     >>> python clear_grizli_pipeline.py --steps 'fit' --rerun 'True'
 
+    # 3.
+    # Bring the last outputs directory up to date with RAW, the reference 
+    # files and the code, re-running only the tasks whose inputs changed, 
+    # two at a time.
+
+    >>> python clear_grizli_pipeline.py --dag 'True' --jobs 2 --rerun 'True'
+
 Dependencies:
 
     * cgosmeyer's fork of `grizli` : https://github.com/cgosmeyer/grizli
@@ -96,24 +156,41 @@ from __future__ import print_function
 
 import argparse
 import grizli
+import inspect
 import drizzlepac
 import glob
+import hashlib
+import json
 import logging
 import matplotlib.pyplot as plt
 import numpy as np
 import os
-import shutil
 import time
 
 from astropy.io import fits
-from astropy.table import Table
+from collections import OrderedDict, deque
 from set_paths import paths
 from utils import store_outputs, retrieve_latest_outputs, tobool
+from adaptive_refine import refine_adaptive
 from clear_inspection_tools import flt_residuals
+from fit_ledger import FitLedger, start_ledger
+from fit_planner import plan_fits, print_plan
+from fit_supervisor import PENDING, stream, supervise
+from flt_index import flt_info
+from lazy_grp import load_lazy_grp
+from model_cache import restore_models, store_models
+from model_deps import file_digest, needs_refinement, plan_models, \
+    refined_digests, remove_saved_models, save_manifest
+from model_scheduler import model_flts, model_workers
+from pipeline_dag import Task, run_dag
+from pointings import Pointing
+from poly_prefit import batch_prefit
+from prep_pool import match_visits, prep_pairs, process_pair
+from render_figures import render
+from staging import stage_files
+from template_cache import load_cached_templates
 
 # cgosmeyer's grizli fork and other personal packages
-from analysis_tools.tables import bypass_table 
-from grizli.prep import process_direct_grism_visit
 from grizli.multifit import GroupFLT, MultiBeam, get_redshift_fit_defaults
 from record.log import setup_logging, log_fail, log_info, log_metadata
 
@@ -136,47 +213,20 @@ overlapping_fields = {'GN1':['GDN20'],
                       'GN7':['GDN3', 'GDN6', 'GDN7', 'GDN11'],
                       'ERSPRIME':['WFC3-ERSII-G01']}
 
-class Pointing():
-    """ Generalization of GN1, GS1, ERSPRIME, etc
+# Contamination modeling: `compute_full_model` magnitude limit, and the
+# polynomial order and magnitude range of `refine_list`.
+MODEL_PARAMS = {'mag_limit':26, 'poly_order':2, 'mag_limits':[16, 24]}
 
-    To change field-dependent catalog, seg map, ref image, and padding
-    only need to change them here.
-    """
-    def __init__(self, field, ref_filter):
-        if 'N' in field.upper():
-            self.pad = 500 # really only necessary for GDN
-            self.radec_catalog = 'goodsn_radec.cat'
-            self.seg_map = 'Goods_N_plus_seg.fits'
-            if '125' in ref_filter:
-                self.catalog = 'GoodsN_plus_merged.cat'
-                self.ref_image = 'goodsn_3dhst.v4.0.F125W_orig_sci.fits'
-            elif '105' in ref_filter:
-                self.catalog = 'goodsn-F105W-astrodrizzle-v4.4_drz_sub_plus.cat'
-                self.ref_image = 'goodsn-F105W-astrodrizzle-v4.4_drz_sci.fits'
-                
-        elif 'S' in field.upper():
-            self.pad = 200 # grizli default
-            self.radec_catalog = 'goodss_3dhst.v4.1.radec.cat'
-            self.seg_map = 'Goods_S_plus_seg.fits'
-            if '125' in ref_filter:
-                self.catalog = 'GoodsS_plus_merged.cat'
-                self.ref_image = 'goodss_3dhst.v4.0.F125W_orig_sci.fits'  
-            elif '105' in ref_filter:
-                self.catalog = 'goodss-F105W-astrodrizzle-v4.3_drz_sub_plus.cat'
-                self.ref_image = 'goodss-F105W-astrodrizzle-v4.3_drz_sci.fits'
-            
+# Adaptive refinement: residual threshold and budget of `refine_adaptive`.
+ADAPTIVE_PARAMS = {'threshold':2., 'max_iter':3}
 
-# Define TimeoutException to handle run_all hanging error.
-# See grizli issue https://github.com/gbrammer/grizli/issues/16
-# Solution from https://stackoverflow.com/questions/25027122/break-the-function-after-certain-time
-
-import signal
-
-class TimeoutException(Exception):   # Custom exception class
-    pass
-def timeout_handler(signum, frame):   # Custom signal handler
-    raise TimeoutException
-signal.signal(signal.SIGALRM, timeout_handler)
+# Redshift range and (coarse, fine) steps of the redshift fit, the same for
+# every object. The templates on this grid are not precomputed per field: 
+# redshifting a template only rescales its wavelengths, while the cost of
+# each step of `run_all` is dispersing it through the object's own beams,
+# which no other object shares.
+FIT_ZR = [0.5, 2.3]
+FIT_DZ = [0.004, 0.0005]
 
 
 #-------------------------------------------------------------------------------
@@ -202,33 +252,19 @@ def find_files(fields):
 
     """
     files = glob.glob(os.path.join(PATH_RAW, '*flt.fits'))
-    info = grizli.utils.get_flt_info(files)
+    # Only the headers of FLTs new to RAW (or changed) are read; the rest
+    # come from the index of earlier runs.
+    info = flt_info(files, index_path=os.path.join(PATH_RAW, 'flt_index.db'))
     # 'info' is an astropy table.
 
-    # Creating a new table and inserting only the rows I want is quite annoying
-    # Just convert 'info' into an ordered dictionary
-    info_dict = bypass_table.decompose_table(info, return_type=dict, include_meta=True)
-
-    new_info_list = []
-
-    # Convert table to ordered dictionary, put it in a list, convert to numpy array
-    # to convert it back into a table. awesome
-    for row in range(len(info_dict['TARGNAME'])):
-        if info_dict['TARGNAME'][row] in fields:
-            new_info_list.append([info_dict[key][row] for key in info_dict.keys() if key != 'meta'])
-        # Now, if one of the fields is GOODS-N, need be sure all the Barro programs
-        # are also retained. 
-        for field in [field for field in fields if 'N' in field or 'ERSPRIME' in field]:
-            if info_dict['TARGNAME'][row] in overlapping_fields[field]:
-                new_info_list.append([info_dict[key][row] for key in info_dict.keys() if key != 'meta'])
-                # Break so the Barro programs are added only once.
-                break
-
-    # Convert 'info' back into a table
-    # I couldn't simply do dtype=info.dtype, so just hard code it
-    new_info_tab = Table(np.array(new_info_list), names=info.colnames, meta=info.meta, 
-        dtype=['S18', 'S5', 'S8', 'S10', 'S8', '<f8', '<f8', '<f8', '<f8', 
-        '<f8', '<f8', '<f8'])
+    # The targets to keep: the fields, and if one of the fields is GOODS-N,
+    # all the Barro programs overlapping it as well.
+    targets = set(fields)
+    for field in [field for field in fields if 'N' in field or 'ERSPRIME' in field]:
+        targets.update(overlapping_fields.get(field, []))
+
+    # Select the rows in one pass, keeping the table's own column types.
+    new_info_tab = info[np.isin(info['TARGNAME'], sorted(targets))]
 
     visits, filters = grizli.utils.parse_flt_files(info=new_info_tab, uniquename=True)
 
@@ -238,7 +274,7 @@ def find_files(fields):
 #-------------------------------------------------------------------------------
 
 @log_metadata
-def prep(visits, ref_filter='F105W', ref_grism='G102'):
+def prep(visits, ref_filter='F105W', ref_grism='G102', workers=1):
     """
     You should have previewed all the FLTs for anomalies prior to this step
     and appropriately removed reads, created masks, removed bad observations, etc.
@@ -256,6 +292,9 @@ def prep(visits, ref_filter='F105W', ref_grism='G102'):
         The reference image's filter.
     ref_grism : string
         The grism.
+    workers : int
+        Number of direct/grism visit pairs processed at once 
+        (`prep_pool.prep_pairs`).
 
     Outputs 
     -------
@@ -294,50 +333,239 @@ def prep(visits, ref_filter='F105W', ref_grism='G102'):
 
     """
 
-    # Match the direct and the grism visits.
-    # Going by order as in the example won't work. 
-    # Might be able to match 'product'.split('.')[0] values from 'visit' dictionary
-    print(visits)
-
-    for visit1 in visits:
-        product1 = visit1['product']
-        filt1 = product1.split('.')[1]
-        basename1 = product1.split('.')[0]
-        if ref_filter.lower() in filt1.lower():
-            # If the filter indicates stare images, search for the grisms
-            for visit2 in visits:
-                # would be better to pull this out of the dictionary as keys
-                product2 = visit2['product']
-                filt2 = product2.split('.')[1]
-                basename2 = product2.split('.')[0]
-                field = product2.split('-')[0]
-                if basename1 == basename2 and ref_grism.lower() in filt2.lower():
-                    # Point to correct, field-dependent radec catalog
-                    logging.info("Matched direct to grism products: {} {}"\
-                        .format(product1, product2))
-                    p = Pointing(field=field, ref_filter=ref_filter)
-                    radec_catalog = p.radec_catalog
-                    logging.info("Using radec catalog: {}".format(radec_catalog))
-
-                    # Do the prep steps.
-                    logging.info(" ")
-                    logging.info("process_direct_grism_visit on direct {} and grism {}"\
-                        .format(visit1, visit2))
-                    status = process_direct_grism_visit(
-                        direct=visit1,
-                        grism=visit2,
-                        radec=os.path.join(PATH_REF, radec_catalog),
-                        path_raw=PATH_RAW,
-                        align_mag_limits=[14,23])
+    # Match the direct and the grism visits on the basenames and filters of
+    # their products. Going by order as in the example won't work. 
+    pairs = match_visits(visits, ref_filter=ref_filter, ref_grism=ref_grism)
+
+    # Point each pair to its correct, field-dependent radec catalog.
+    radec = []
+    for direct, grism in pairs:
+        field = grism['product'].split('-')[0]
+        p = Pointing(field=field, ref_filter=ref_filter)
+        logging.info("Using radec catalog for {}: {}".format(grism['product'], 
+            p.radec_catalog))
+        radec.append(os.path.join(PATH_REF, p.radec_catalog))
+
+    # Do the prep steps, each pair in a scratch directory of its own.
+    failed = prep_pairs(pairs, radec=radec, run_dir='.', workers=workers,
+        path_raw=PATH_RAW, align_mag_limits=[14,23])
+    if failed:
+        raise RuntimeError("process_direct_grism_visit failed on {}".format(
+            ', '.join(['{} + {}'.format(d, g) for d, g, error in failed])))
 
     # need make some inspection tools?
 
 
+#-------------------------------------------------------------------------------
+
+def field_files(visits, field):
+    """ Selects the FLTs of a field and of the visits overlapping it.
+
+    Parameters
+    ----------
+    visits : OrderedDict
+        Keys of 'files' and 'products'; values of list of FLT files and product name.
+    field : string
+        The pointing, technically, 'GN1', 'GS1', etc.
+
+    Returns
+    -------
+    grism_files : list of strings
+        The grism FLTs.
+    all_flt_files : list of strings
+        The grism and direct FLTs.
+
+    """
+    grism_files = []
+    all_flt_files = []
+    for i in range(len(visits)):
+        # e.g., visits[i]['product'] = 'gn2-cxt-51-345.0-g102'  
+        field_in_contest = visits[i]['product'].split('-')[0].upper()  
+        if '-g1' in visits[i]['product']:
+            # Only add to list the grism files IF they are among the specified
+            # fields
+            if field_in_contest in overlapping_fields[field] or \
+                field_in_contest == field:
+                grism_files.extend(visits[i]['files'])
+                all_flt_files.extend(visits[i]['files'])
+        elif '-f1' in visits[i]['product']:
+            if field_in_contest in overlapping_fields[field] or \
+                field_in_contest == field:
+                all_flt_files.extend(visits[i]['files'])
+
+    return grism_files, all_flt_files
+
+
+#-------------------------------------------------------------------------------
+
+def update_models(grism_files, name='', ref_file='', seg_file='', catalog='',
+    pad=200, refine='all'):
+    """ Brings the saved contamination models of FLTs in the working 
+    directory up to date, modeling only what neither the last models here 
+    nor the model cache provide.
+
+    `refine_list` refines each object against all the FLTs that see it, so
+    `grism_files` are refined together, as one group, whenever any of them
+    is re-modeled or the group changes (`model_deps.needs_refinement`); the
+    FLTs kept as saved are reset to their models as modeled, from the 
+    cache, before the group is refined. Models are cached as modeled, for
+    any field, and as refined, for this group.
+
+    Parameters
+    ----------
+    grism_files : list of strings
+        The grism FLTs; all those of the field, unless `refine` is None.
+    name : string
+        Names the manifest, <name>.model_manifest.json, and the modeling 
+        time history; the field, e.g. 'GN2'.
+    ref_file, seg_file, catalog : strings
+        The reference image, segmentation map and catalog, as for GroupFLT.
+    pad : int
+        The padding, as for GroupFLT.
+    refine : string or None
+        'all' to refine every object in the magnitude range, 'adaptive' 
+        to refine only those left with high residuals 
+        (`adaptive_refine.refine_adaptive`), or None to leave the models
+        unrefined, as `model_shared` does.
+
+    """
+    refinement = {'refine':refine, 'poly_order':MODEL_PARAMS['poly_order'],
+        'mag_limits':MODEL_PARAMS['mag_limits']}
+    if refine == 'adaptive':
+        refinement.update(ADAPTIVE_PARAMS)
+
+    manifest_path = '{}.model_manifest.json'.format(name)
+    stale, manifest = plan_models(grism_files, ref_file, seg_file, catalog,
+        pad=pad, params=MODEL_PARAMS, manifest_path=manifest_path, 
+        refinement=refinement)
+
+    if refine is not None:
+        if not needs_refinement(grism_files, stale, manifest, manifest_path):
+            save_manifest(manifest, manifest_path)
+            return
+        # The whole group, refined by an earlier run.
+        if restore_models(grism_files, manifest, group=grism_files) == []:
+            manifest['refined'] = refined_digests(grism_files, manifest)
+            save_manifest(manifest, manifest_path)
+            return
+
+    # Refinement starts over from the models as modeled, of every FLT of the
+    # group, rather than from what an earlier run, or another field's
+    # refinement, left on disk; only the misses are modeled again.
+    modeled = restore_models(stale if refine is None else grism_files, 
+        manifest)
+    if modeled != []:
+        for flt in modeled:
+            remove_saved_models(flt)
+
+        # Each FLT is modeled and saved by its own worker, sized to the
+        # host's cores and memory, biggest FLTs first.
+        logging.info("Computing contam model of {} FLTs.".format(len(modeled)))
+        model_flts(modeled, manifest, ref_file=ref_file, 
+            seg_file=seg_file, catalog=catalog, pad=pad, 
+            mag_limit=MODEL_PARAMS['mag_limit'],  # mag limit for contam model
+            history_path=os.path.join(paths['path_to_model_cache'], 
+                '{}.model_times.json'.format(name)))
+        store_models(modeled, manifest)
+
+    if refine is not None:
+        workers = model_workers(len(grism_files))
+        grp = GroupFLT(
+            grism_files=grism_files, 
+            direct_files=[], 
+            ref_file=ref_file,
+            seg_file=seg_file,
+            catalog=catalog,
+            pad=pad,
+            cpu_count=workers)
+
+        logging.info("Refining contam model of {} FLTs.".format(len(grism_files)))
+        if refine == 'adaptive':
+            refine_adaptive(grp, poly_order=MODEL_PARAMS['poly_order'],
+                mag_limits=MODEL_PARAMS['mag_limits'], **ADAPTIVE_PARAMS)
+        else:
+            grp.refine_list(poly_order=MODEL_PARAMS['poly_order'], 
+                mag_limits=MODEL_PARAMS['mag_limits'])
+
+        # Residual statistics of the flts - models, with previews, and 
+        # full PNGs of the outliers.
+        flt_residuals(grp, workers=workers, 
+            output='{}.flt_residuals.txt'.format(name))
+
+        # Save grp. Restored models may be links into the cache, so they are
+        # removed first rather than written through.
+        for flt in grism_files:
+            remove_saved_models(flt)
+        grp.save_full_data()
+        del grp
+
+        store_models(grism_files, manifest, group=grism_files)
+        manifest['refined'] = refined_digests(grism_files, manifest)
+
+    save_manifest(manifest, manifest_path)
+
+
+#-------------------------------------------------------------------------------
+
+def model_shared(visits, fields, ref_filter='', use_prep_path='.'):
+    """ Models once the grism FLTs that several of the fields include.
+
+    Fields like GN2, GN3 and GN4 share visits (GDN21, GDN22, GDN25) and the
+    same reference image, segmentation map and catalog, so a shared FLT's
+    model, before refinement, is the same product for each of them. Here 
+    the FLTs included by more than one field of the same inputs are modeled
+    once and stored in the model cache, from which `model` of each field 
+    restores them instead of modeling them again. They are not refined 
+    here: each field refines them along with the rest of its FLTs.
+
+    Parameters
+    ----------
+    visits : OrderedDict
+        Keys of 'files' and 'products'; values of list of FLT files and product name.
+    fields : list of strings
+        The pointings to be modeled.
+    ref_filter : string
+        The reference image's filter.
+    use_prep_path : string
+        Path to the pre-processed files. By default the working directory.
+
+    Outputs
+    -------
+    * <field>-<field>.model_manifest.json : GN2-GN3-GN4.model_manifest.json
+
+    """
+    # Fields modeled from the same inputs.
+    groups = OrderedDict()
+    for field in fields:
+        p = Pointing(field=field, ref_filter=ref_filter)
+        groups.setdefault((p.ref_image, p.seg_map, p.catalog, p.pad), []).append(field)
+
+    for (ref_image, seg_map, catalog, pad), group in groups.items():
+        counts = OrderedDict()
+        for field in group:
+            for flt in set(field_files(visits, field)[0]):
+                counts[flt] = counts.get(flt, 0) + 1
+        shared = sorted([flt for flt in counts if counts[flt] > 1])
+        if shared == []:
+            continue
+
+        logging.info("{} FLTs are shared by fields {}".format(len(shared), 
+            ', '.join(group)))
+        if use_prep_path != '.':
+            stage_files([os.path.join(use_prep_path, flt) for flt in shared],
+                dest='.', readme='README.txt')
+
+        update_models(shared, name='-'.join(group), 
+            ref_file=os.path.join(PATH_REF, ref_image), 
+            seg_file=os.path.join(PATH_REF, seg_map), 
+            catalog=os.path.join(PATH_REF, catalog), pad=pad, refine=None)
+
+
 #-------------------------------------------------------------------------------
 
 @log_metadata
 def model(visits, field='', ref_filter='', use_prep_path='.', use_model_path='.',
-    load_only=False):
+    load_only=False, refine='all'):
     """ Models the contamination.
 
     Parameters
@@ -358,6 +586,16 @@ def model(visits, field='', ref_filter='', use_prep_path='.', use_model_path='.'
         run of the pipeline.)
     load_models : {True, False}
         Set to True if want to reload already existing models.
+        Otherwise only the FLTs whose inputs changed since the models saved
+        in the working directory (or `use_model_path`), or whose traces 
+        reach catalog objects that changed, are re-modeled; see 
+        `model_deps.plan_models`. The rest are loaded as saved. Models of
+        identical inputs from any earlier run are restored from the model
+        cache (`model_cache`) rather than computed.
+    refine : string
+        'all' to refine every object in the magnitude range, or 'adaptive'
+        to refine only those whose models leave high residuals; see 
+        `update_models`.
 
     Returns
     -------
@@ -369,46 +607,30 @@ def model(visits, field='', ref_filter='', use_prep_path='.', use_model_path='.'
     * <root>_flt.01.wcs.fits    : icxt51jwq_flt.01.wcs.fits
     * <root>.01.GrismFLT.fits   : icxt51jwq.01.GrismFLT.fits
     * <root>.01.GrismFLT.pkl    : icxt51jwq.01.GrismFLT.pkl 
-    * <root>_residuals.png      : icxt51jwq_residuals.png
+    * <root>_residuals_preview.png : icxt51jwq_residuals_preview.png
+    * <root>_residuals.png      : icxt51jwq_residuals.png, outliers only
+    * <field>.flt_residuals.txt : GN2.flt_residuals.txt
+    * <field>.model_manifest.json : GN2.model_manifest.json
 
     """
 
-    grism_files = []
-    all_flt_files = []
-    for i in range(len(visits)):
-        # e.g., visits[i]['product'] = 'gn2-cxt-51-345.0-g102'  
-        field_in_contest = visits[i]['product'].split('-')[0].upper()  
-        if '-g1' in visits[i]['product']:
-            # Only add to list the grism files IF they are among the specified
-            # fields
-            if field_in_contest in overlapping_fields[field] or \
-                field_in_contest == field:
-                grism_files.extend(visits[i]['files'])
-                all_flt_files.extend(visits[i]['files'])
-        elif '-f1' in visits[i]['product']:
-            if field_in_contest in overlapping_fields[field] or \
-                field_in_contest == field:
-                all_flt_files.extend(visits[i]['files'])
+    grism_files, all_flt_files = field_files(visits, field)
 
     p = Pointing(field=field, ref_filter=ref_filter)
     
     # If modeling on a later run than when generating prep step files,
-    # copy the pre-processed FLTs to the current time-stamp directory.
+    # stage the pre-processed FLTs into the current time-stamp directory.
     # Brammer says only *FLTs produced by prep are needed, since for CLEAR
     # we are providing the ref_file, seg_file, and catalog.
+    # Modeling only reads the FLTs, so they are linked rather than copied;
+    # the README lists how each was staged, its checksum and its origin.
     if use_prep_path != '.':
         all_flt_files = [os.path.join(use_prep_path, flt) for flt in all_flt_files]
-        # Copy only the FLT files for the given field.
-        for flt in all_flt_files:
-            # assuming have cd'd into the outputs location
-            logging.info("Copying {} from {} to {}"\
-                .format(flt, use_prep_path, PATH_OUTPUTS_TIMESTAMP))
-            shutil.copy(flt, '.')
-
-        # Create a readme listing origin of the prep files
-        with open('README.txt', 'w') as readme:
-            readme.write('{}\n'.format(time.ctime()))
-            readme.write('FLT files copied from {}\n'.format(use_prep_path))
+        # Stage only the FLT files for the given field.
+        # assuming have cd'd into the outputs location
+        logging.info("Staging {} FLTs from {} in {}"\
+            .format(len(all_flt_files), use_prep_path, PATH_OUTPUTS_TIMESTAMP))
+        stage_files(all_flt_files, dest='.', readme='README.txt')
 
     
     logging.info(" ")
@@ -421,28 +643,21 @@ def model(visits, field='', ref_filter='', use_prep_path='.', use_model_path='.'
         os.chdir(use_model_path)
         logging.info("Loading GroupFLTs on field {}".format(field))
 
-    # Do modeling if GroupFLTs not already saved, or load if they are
-    grp = GroupFLT(
-        grism_files=grism_files, 
-        direct_files=[], 
-        ref_file=os.path.join(PATH_REF, p.ref_image),
-        seg_file=os.path.join(PATH_REF, p.seg_map),
-        catalog=os.path.join(PATH_REF, p.catalog),
-        pad=p.pad,
-        cpu_count=8)
+    ref_file = os.path.join(PATH_REF, p.ref_image)
+    seg_file = os.path.join(PATH_REF, p.seg_map)
+    catalog = os.path.join(PATH_REF, p.catalog)
 
-    # If first time creating the models, need refine model and save the GroupFLT
-    # [[might be better if check whether contam extension is empty?]]
+    # Model only the FLTs that are new or whose inputs changed, and that no
+    # earlier run (or another field, see `model_shared`) modeled from the 
+    # same inputs.
     if not load_only:
-        logging.info("Computing contam model.")
-        grp.compute_full_model(mag_limit=26)  # mag limit for contam model
-        grp.refine_list(poly_order=2, mag_limits=[16, 24])
+        update_models(grism_files, name=field, ref_file=ref_file, 
+            seg_file=seg_file, catalog=catalog, pad=p.pad, refine=refine)
 
-        # Save flts - models as PNGs.
-        flt_residuals(grp)
-
-        # Save grp.
-        grp.save_full_data()
+    # Load the GroupFLTs from the saved models, memory-mapped, so the fit
+    # step only reads the pixels of the objects it extracts.
+    grp = load_lazy_grp(grism_files, ref_file=ref_file, seg_file=seg_file,
+        catalog=catalog, pad=p.pad)
 
     return grp
         
@@ -450,7 +665,9 @@ def model(visits, field='', ref_filter='', use_prep_path='.', use_model_path='.'
 #-------------------------------------------------------------------------------
 
 @log_metadata
-def fit(grp, field='', mag_lim=35, release=False):
+def fit(grp, field='', mag_lim=35, release=False, workers=1, timeout=600,
+    order='brightest', prefit_chunk=1, make_figures=True,
+    extract_workers=0, queue_size=None):
     """
     Extract, stack, and fit (z and em lines).
 
@@ -466,128 +683,517 @@ def fit(grp, field='', mag_lim=35, release=False):
     release : NotImplemented
         Should be a number, which will also be a root directory of 
         the release's outputs?
+    workers : int
+        Number of objects to fit at once. Each object is fit in its own 
+        child process, forked with `grp` and the templates already in 
+        memory, and results are logged in the order they complete.
+    timeout : float
+        Wall-clock budget in seconds for each object. An object that 
+        overruns is killed and recorded as 'timeout' in the ledger, so a 
+        hung `run_all` (grizli issue #16) can't stall the field. None for no
+        limit, in which case a single worker fits in this process.
+    order : string
+        'brightest' to fit the brightest objects first, 'catalog' to keep
+        catalog order.
+    prefit_chunk : int
+        Number of objects whose polynomial continuum prefits are solved 
+        together by `poly_prefit.batch_prefit`. A chunk is one task for a
+        worker, with a budget of `timeout` per object. If a chunk's worker
+        dies or overruns, only the object it was on is charged; the others
+        left unfinished are fit again one by one. By default 1, which
+        prefits each object with `template_at_z`.
+    make_figures : {True, False}
+        Set to False to write only FITS while fitting and leave the PNGs to
+        the "render" step (`render_figures.render`).
+    extract_workers : int
+        Set above 0 to stream: this many processes extract beams while 
+        `workers` processes fit the objects whose beams.fits are written,
+        reading them back from disk. By default 0, which extracts and fits
+        each object in turn. `prefit_chunk` is not used when streaming.
+    queue_size : int
+        When streaming, the most objects being extracted or waiting to be fit.
+        By default twice `workers`.
 
     Outputs
     -------
+    * <field>.ledger            : GN2.ledger
     * <field>_<id>.beams.fits   : GN2_23121.beams.fits
     * <field>_<id>.stack.fits   : GN2_23121.stack.fits
     * <field>_<id>.stack.png    : GN2_23121.stack.png
 
     """
-    # Load templates with combined emission line complexes for the redshift fit 
-    # (don't allow infinite freedom) of the line ratios / fluxes
-    templ0 = grizli.utils.load_templates(fwhm=1200, line_complexes=True, stars=False, 
-                                         full_line_list=None,  continuum_list=None, 
-                                         fsps_templates=True)
+    # The ledger decides what is left to do. Objects that were fit, failed 
+    # or timed out are skipped; to retry one, delete its lines from the 
+    # ledger. A directory fit before ledgers existed is seeded from its 
+    # products once.
+    ledger = FitLedger('{}.ledger'.format(field))
+    if ledger.is_new:
+        ledger.bootstrap(field)
+
+    # Run extracting and fitting only on ids that fall under the magnitude
+    # limit and aren't finished.
+    todo_ids, todo_mags = plan_fits(grp.catalog['NUMBER'], grp.catalog['MAG_AUTO'],
+        ledger=ledger, mag_lim=float(mag_lim), order=order)
+    todo = list(zip(todo_ids, todo_mags))
+    chunks = [todo[i:i+prefit_chunk] for i in range(0, len(todo), prefit_chunk)]
+
+    templ0, templ1 = load_fit_templates()
+
+    if extract_workers > 0:
+        fit_streamed(grp, todo, field=field, templ0=templ0, templ1=templ1,
+            ledger=ledger, workers=workers, timeout=timeout,
+            extract_workers=extract_workers, queue_size=queue_size, 
+            make_figures=make_figures)
+        return
+
+    if workers <= 1 and timeout is None:
+        for chunk in chunks:
+            fit_chunk(grp, chunk, field=field, templ0=templ0, templ1=templ1,
+                ledger=ledger, make_figures=make_figures)
+        return
+
+    def fit_one(chunk):
+        fit_chunk(grp, chunk, field=field, templ0=templ0, templ1=templ1, 
+            ledger=ledger, make_figures=make_figures)
+
+    def budget(chunk):
+        return None if timeout is None else timeout * len(chunk)
+
+    # Chunks, and the objects of dead chunks put back one by one.
+    queue = deque(chunks)
+    running = [0]
+
+    def tasks():
+        while queue or running[0]:
+            if queue:
+                running[0] += 1
+                yield queue.popleft()
+            else:
+                time.sleep(0.1)
+                yield PENDING
+
+    logging.info("Fitting {} objects on {} workers".format(len(todo), workers))
+    for chunk, status, result in supervise(fit_one, tasks(), workers=workers, 
+        timeout=budget):
+        running[0] -= 1
+        if status == 'done':
+            for id, mag in chunk:
+                logging.info("Finished id: {}, mag: {}".format(id, mag))
+            continue
+
+        # The child recorded what it finished before it died. Only the 
+        # object it was on is charged with the failure; the rest are 
+        # queued again, each on its own.
+        finished = FitLedger(ledger.path)
+        culprit = chunk_in_progress(chunk, finished)
+        for id, mag in chunk:
+            if finished.is_finished(id):
+                continue
+            if id != culprit:
+                queue.append([(id, mag)])
+            elif status == 'failed':
+                logging.info("Fit failed on id {}:\n{}".format(id, result))
+                ledger.record(id, 'failed', note=result.strip().split('\n')[-1])
+            elif status == 'timeout':
+                logging.info("Killed id {} after {:.0f} s".format(id, result))
+                ledger.record(id, 'timeout', elapsed=result)
+
+
+#-------------------------------------------------------------------------------
+
+def chunk_in_progress(chunk, ledger):
+    """ Finds the object a `fit_chunk` worker was on when it died.
+
+    `fit_chunk` extracts the objects of a chunk in turn, prefits them 
+    together, then fits them in turn, each finishing before the next. So
+    the object on its way through the fit ('polyfit' or 'stack'), else the
+    first not yet extracted, was in progress. If every unfinished object is
+    only extracted, the batched prefit was running, and no single object is
+    to blame; a chunk of one object always is.
+
+    Parameters
+    ----------
+    chunk : list of tuples
+        The (id, mag) of each object.
+    ledger : fit_ledger.FitLedger
+        Read after the worker died.
+
+    Returns
+    -------
+    id : int or None
+
+    """
+    if len(chunk) == 1:
+        return chunk[0][0]
+
+    unfinished = [id for id, mag in chunk if not ledger.is_finished(id)]
+    for stages in [['polyfit', 'stack'], [None]]:
+        for id in unfinished:
+            if ledger.stage(id) in stages:
+                return id
+
+    return None
+
+
+#-------------------------------------------------------------------------------
+
+def fit_streamed(grp, todo, field='', templ0=None, templ1=None,
+    ledger=None, workers=1, timeout=600, extract_workers=1, queue_size=None,
+    make_figures=True):
+    """
+    Extracts beams in forked processes and fits them in others at the same
+    time, extraction running at most `queue_size` objects ahead (see 
+    `fit_supervisor.stream`). Only ids pass between them; each fit reads its <field>_<id>.beams.fits
+    back, so memory stays flat however far extraction gets.
+
+    Parameters
+    ----------
+    grp : grizli.multifit.GroupFLT
+
+    todo : list of tuples
+        The (id, mag) of each object, in the order to fit them.
+    field : string
+        The pointing, technically, 'GN1', 'GS1', etc.
+    templ0, templ1 : OrderedDict
+        The template sets from `load_fit_templates`.
+    ledger : fit_ledger.FitLedger
+        Each stage the objects reach is recorded with its timing.
+    workers : int
+        Number of objects to fit at once.
+    timeout : float
+        Wall-clock budget in seconds for each fit, and for each extraction.
+        None for no limit.
+    extract_workers : int
+        Number of extraction processes.
+    queue_size : int
+        The most objects being extracted or waiting to be fit.
+    make_figures : {True, False}
+        See `fit_object`.
+
+    """
+    def extract_one(task):
+        id, mag = task
+        return extract_object(grp, id, mag, field=field, ledger=ledger) is not None
+
+    def fit_one(task):
+        id, mag = task
+        mb = MultiBeam('{0}_{1:05d}.beams.fits'.format(field, id), fcontam=1, 
+            group_name=field)
+        fit_object(grp, id, mag, field=field, templ0=templ0, templ1=templ1, 
+            ledger=ledger, mb=mb, make_figures=make_figures)
+
+    logging.info("Streaming {} objects through {} extraction processes and {} "
+        "fitting workers".format(len(todo), extract_workers, workers))
+    for (id, mag), stage, status, result in stream(extract_one, fit_one, todo,
+        extract_workers=extract_workers, fit_workers=workers, 
+        queue_size=queue_size, timeout=timeout):
+        if status == 'done':
+            logging.info("Finished id: {}, mag: {}".format(id, mag))
+        elif status == 'failed':
+            logging.info("{} failed on id {}:\n{}".format(stage.capitalize(), 
+                id, result))
+            if not FitLedger(ledger.path).is_finished(id):
+                ledger.record(id, 'failed', note=result.strip().split('\n')[-1])
+        elif status == 'timeout':
+            logging.info("Killed id {} after {:.0f} s".format(id, result))
+            ledger.record(id, 'timeout', elapsed=result)
+
+
+#-------------------------------------------------------------------------------
+
+def load_fit_templates():
+    """ Loads the two template sets used by `run_all`, from the on-disk 
+    template cache when possible.
+
+    Returns
+    -------
+    templ0 : OrderedDict
+        Templates with combined emission line complexes for the redshift fit 
+        (don't allow infinite freedom) of the line ratios / fluxes.
+    templ1 : OrderedDict
+        Individual line templates for fitting the line fluxes.
+
+    """
+    templ0 = load_cached_templates(fwhm=1200, line_complexes=True, stars=False, 
+                                   full_line_list=None,  continuum_list=None, 
+                                   fsps_templates=True)
+
+    templ1 = load_cached_templates(fwhm=1200, line_complexes=False, stars=False, 
+                                   full_line_list=None, continuum_list=None, 
+                                   fsps_templates=True)
+
+    return templ0, templ1
+
+
+#-------------------------------------------------------------------------------
+
+def fit_chunk(grp, chunk, field='', templ0=None, templ1=None, 
+    ledger=None, make_figures=True):
+    """
+    Extract, stack, and fit (z and em lines) a chunk of objects, solving 
+    their polynomial continuum prefits together in one batched pass.
+
+    Parameters
+    ----------
+    grp : grizli.multifit.GroupFLT
+
+    chunk : list of tuples
+        The (id, mag) of each object.
+    field : string
+        The pointing, technically, 'GN1', 'GS1', etc.
+    templ0, templ1 : OrderedDict
+        The template sets from `load_fit_templates`.
+    ledger : fit_ledger.FitLedger
+        If given, each stage the objects reach is recorded with its timing.
+    make_figures : {True, False}
+        See `fit_object`.
+
+    """
+    # A single object goes through the usual `template_at_z` prefit.
+    if len(chunk) == 1:
+        fit_object(grp, chunk[0][0], chunk[0][1], field=field, templ0=templ0,
+            templ1=templ1, ledger=ledger, 
+            make_figures=make_figures)
+        return
+
+    extracted = []
+    for id, mag in chunk:
+        mb = extract_object(grp, id, mag, field=field, ledger=ledger)
+        if mb is not None:
+            extracted.append((id, mag, mb))
+    if extracted == []:
+        return
+
+    start = time.time()
+    pfits = batch_prefit([mb for id, mag, mb in extracted])
+    elapsed = (time.time() - start) / len(extracted)
+
+    for (id, mag, mb), pfit in zip(extracted, pfits):
+        fit_object(grp, id, mag, field=field, templ0=templ0, templ1=templ1, 
+            ledger=ledger, mb=mb, pfit=pfit, 
+            prefit_time=elapsed, make_figures=make_figures)
+
+
+#-------------------------------------------------------------------------------
+
+def extract_object(grp, id, mag, field='', ledger=None):
+    """
+    Extracts the 2D traces of a single object and saves them as 
+    <field>_<id>.beams.fits.
+
+    Parameters
+    ----------
+    grp : grizli.multifit.GroupFLT
+
+    id : int
+        The catalog NUMBER of the object.
+    mag : float
+        The catalog MAG_AUTO of the object.
+    field : string
+        The pointing, technically, 'GN1', 'GS1', etc.
+    ledger : fit_ledger.FitLedger
+        If given, the 'beams' stage (or the failure) is recorded.
+
+    Returns
+    -------
+    mb : grizli.multifit.MultiBeam
+        None if the object has no beams.
+
+    """
+    logging.info("Extracting id: {}, mag: {}".format(id, mag))
+    start = time.time()
+    # Extract the 2D traces
+    beams = grp.get_beams(id, size=80) #size??
+    if beams == []:
+        if ledger is not None:
+            ledger.record(id, 'failed', time.time() - start, note='no beams')
+        return None
+
+    logging.info("running MultiBeam on id: {}, mag: {}, {} beams".format(id, 
+        mag, len(beams)))
+    mb = MultiBeam(beams, fcontam=1, group_name=field)
+
+    # Save a FITS file with the 2D cutouts (beams) from the individual exposures
+    mb.write_master_fits()
+    if ledger is not None:
+        ledger.record(id, 'beams', time.time() - start)
 
-    # Load individual line templates for fitting the line fluxes
-    templ1 = grizli.utils.load_templates(fwhm=1200, line_complexes=False, stars=False, 
-                                         full_line_list=None, continuum_list=None, 
-                                         fsps_templates=True)
+    return mb
+
+
+#-------------------------------------------------------------------------------
+
+def fit_object(grp, id, mag, field='', templ0=None, templ1=None,
+    ledger=None, mb=None, pfit=None, prefit_time=0., 
+    make_figures=True):
+    """
+    Extract, stack, and fit (z and em lines) a single object.
+
+    Parameters
+    ----------
+    grp : grizli.multifit.GroupFLT
+
+    id : int
+        The catalog NUMBER of the object.
+    mag : float
+        The catalog MAG_AUTO of the object.
+    field : string
+        The pointing, technically, 'GN1', 'GS1', etc.
+    templ0, templ1 : OrderedDict
+        The template sets from `load_fit_templates`.
+    ledger : fit_ledger.FitLedger
+        If given, each stage the object reaches is recorded with its timing.
+    mb : grizli.multifit.MultiBeam
+        The already extracted beams, if any. By default they are extracted
+        with `extract_object`.
+    pfit : dict
+        The already fit polynomial continuum, e.g. from `batch_prefit`. By
+        default it is fit here with `template_at_z`.
+    prefit_time : float
+        Seconds to record for the 'polyfit' stage when `pfit` is given.
+    make_figures : {True, False}
+        Set to False to skip the stack and full PNGs, and the beam panels
+        of the redshift fit. The stack PNG, and a full summary PNG, 
+        <field>_<id>.full_summary.png, can be drawn later from the FITS by
+        `render_figures.render`. The full PNG is skipped with versions of 
+        grizli whose `run_all` takes `save_figures`; older ones draw it 
+        regardless.
+
+    """
+    def record(stage, start, note=''):
+        if ledger is not None:
+            ledger.record(id, stage, time.time() - start, note=note)
 
     #question: are these appropriate for clear?
     pline = {'kernel': 'point', 'pixfrac': 0.2, 'pixscale': 0.1, 'size': 8, 'wcs': None}
 
-    already_completed = glob.glob('*stack.png')
-    already_completed = [int(id.split('.stack.png')[0].split('_')[1]) for id in already_completed]
-    #already_completed = []
-    bad_ids = [20124, 21731, 23121]
-
-    # Loop over all ids, mag, and run extracting and fitting only on ids that
-    # full under the magnitude limit. 
-    for id, mag in zip(np.array(grp.catalog['NUMBER']), np.array(grp.catalog['MAG_AUTO'])):
-        if mag <= mag_lim and id not in already_completed and id not in bad_ids:
-            print(id, mag)
-            # Extract the 2D traces
-            beams = grp.get_beams(id, size=80) #size??
-            if beams != []:
-                print("beams: ", beams)
-
-                logging.info("running MultiBeam on id: {}, mag: {}".format(id, mag))
-                mb = MultiBeam(beams, fcontam=1, group_name=field)
-
-                # Save a FITS file with the 2D cutouts (beams) from the individual exposures
-                mb.write_master_fits()
-
-                # Fit polynomial model for initial continuum subtraction
-                wave = np.linspace(2000,2.5e4,100)
-                poly_templates = grizli.utils.polynomial_templates(
-                    wave=wave, 
-                    order=7,
-                    line=False)
-                pfit = mb.template_at_z(
-                    z=0, 
-                    templates=poly_templates, 
-                    fit_background=True, 
-                    fitter='lstsq', 
-                    fwhm=1400, 
-                    get_uncertainties=2)
-
-                if pfit == None:
-                    logging.info("Fit failed on id {}".format(id))
-                    # write these to a 'failed' file?
-                else:
-                    # Drizzle grisms / PAs
-                    hdu, fig = mb.drizzle_grisms_and_PAs(
-                        size=32, 
-                        fcontam=0.2, 
-                        flambda=False, 
-                        scale=1, 
-                        pixfrac=0.5, 
-                        kernel='point', 
-                        make_figure=True, 
-                        usewcs=False, 
-                        zfit=pfit,
-                        diff=True)
-
-                    # Save drizzled ("stacked") 2D trace as PNG and FITS
-                    fig.savefig('{0}_{1:05d}.stack.png'.format(field, id))
-                    hdu.writeto('{0}_{1:05d}.stack.fits'.format(field, id), clobber=True)
-
-                    signal.alarm(5) 
-                    # Fit the emission lines and redshifts
-                    # This produces field_id.full.fits and field_id.full.png
-                    try:
-                        out = grizli.fitting.run_all(
-                            id, 
-                            t0=templ0, 
-                            t1=templ1, 
-                            fwhm=1200, 
-                            zr=[0.5, 2.3], 
-                            dz=[0.004, 0.0005], 
-                            fitter='nnls',
-                            group_name=field,
-                            fit_stacks=False, 
-                            prior=None, 
-                            fcontam=0.,
-                            pline=pline, 
-                            mask_sn_limit=7, 
-                            fit_only_beams=False,
-                            fit_beams=True, 
-                            root=field+'_',
-                            fit_trace_shift=False, 
-                            phot=None, 
-                            verbose=True, 
-                            scale_photometry=False, 
-                            show_beams=True)
-
-                        if out == None:
-                            logging.info("Redshift fit failed on id {}".format(id))
-                        else:
-                            mb, st, fit, tfit, line_hdu = out
-
-                    except TimeoutException:
-                        logging.info("run_all timed out on id {}".format(id))
-                        continue
-                    else:
-                        # Reset alarm
-                        signal.alarm(0)
-
-                    # do we need more plots?
-
-                    # sort into Extractions directory? have a special parameter for release?
-                    #if release:
-                    #   ...
+    if mb is None:
+        mb = extract_object(grp, id, mag, field=field, ledger=ledger)
+        if mb is None:
+            return
+
+    # Fit polynomial model for initial continuum subtraction
+    start = time.time() - prefit_time
+    if pfit is None:
+        wave = np.linspace(2000,2.5e4,100)
+        poly_templates = grizli.utils.polynomial_templates(
+            wave=wave, 
+            order=7,
+            line=False)
+        pfit = mb.template_at_z(
+            z=0, 
+            templates=poly_templates, 
+            fit_background=True, 
+            fitter='lstsq', 
+            fwhm=1400, 
+            get_uncertainties=2)
+
+    if pfit == None:
+        logging.info("Fit failed on id {}".format(id))
+        record('failed', start, note='polynomial fit failed')
+        return
+
+    record('polyfit', start)
+
+    # Drizzle grisms / PAs
+    start = time.time()
+    out = mb.drizzle_grisms_and_PAs(
+        size=32, 
+        fcontam=0.2, 
+        flambda=False, 
+        scale=1, 
+        pixfrac=0.5, 
+        kernel='point', 
+        make_figure=make_figures, 
+        usewcs=False, 
+        zfit=pfit,
+        diff=True)
+    hdu = out[0] if isinstance(out, tuple) else out
+
+    # Save drizzled ("stacked") 2D trace as PNG and FITS
+    if make_figures:
+        out[1].savefig('{0}_{1:05d}.stack.png'.format(field, id))
+    hdu.writeto('{0}_{1:05d}.stack.fits'.format(field, id), clobber=True)
+    record('stack', start)
+
+    start = time.time()
+    figure_kwargs = {}
+    if 'save_figures' in inspect.signature(grizli.fitting.run_all).parameters:
+        figure_kwargs['save_figures'] = make_figures
+
+    # Fit the emission lines and redshifts
+    # This produces field_id.full.fits and field_id.full.png
+    out = grizli.fitting.run_all(
+        id, 
+        t0=templ0, 
+        t1=templ1, 
+        fwhm=1200, 
+        zr=FIT_ZR, 
+        dz=FIT_DZ, 
+        fitter='nnls',
+        group_name=field,
+        fit_stacks=False, 
+        prior=None, 
+        fcontam=0.,
+        pline=pline, 
+        mask_sn_limit=7, 
+        fit_only_beams=False,
+        fit_beams=True, 
+        root=field+'_',
+        fit_trace_shift=False, 
+        phot=None, 
+        verbose=True, 
+        scale_photometry=False, 
+        show_beams=make_figures,
+        **figure_kwargs)
+
+    if out == None:
+        logging.info("Redshift fit failed on id {}".format(id))
+        record('failed', start, note='run_all returned None')
+    else:
+        mb, st, fit, tfit, line_hdu = out
+        record('run_all', start)
+
+    # do we need more plots?
+
+    # sort into Extractions directory? have a special parameter for release?
+    #if release:
+    #   ...
+
+
+#-------------------------------------------------------------------------------
+
+def plan(field='', ref_filter='F105W', mag_lim=35, workers=1, order='brightest'):
+    """ Dry run of `fit`: prints how many objects are left to fit in the
+    field and an estimate of the cost, without loading any models.
+
+    Parameters
+    ----------
+    field : string
+        The pointing, technically, 'GN1', 'GS1', etc.
+    ref_filter : string
+        The reference image's filter.
+    mag_lim : int
+        The magnitude limit of sources to extract and fit.
+    workers : int
+        Number of objects that would be fit at once.
+    order : string
+        'brightest' or 'catalog'.
+
+    """
+    p = Pointing(field=field, ref_filter=ref_filter)
+    catalog = grizli.utils.GTable.gread(os.path.join(PATH_REF, p.catalog))
+
+    ledger = FitLedger('{}.ledger'.format(field))
+    if ledger.is_new:
+        ledger.bootstrap(field)
+
+    todo_ids, todo_mags = plan_fits(catalog['NUMBER'], catalog['MAG_AUTO'],
+        ledger=ledger, mag_lim=float(mag_lim), order=order)
+
+    logging.info("Fit plan for field {}".format(field))
+    print_plan(catalog['NUMBER'], catalog['MAG_AUTO'], todo_ids, todo_mags,
+        ledger=ledger, mag_lim=float(mag_lim), workers=workers)
 
 
 #-------------------------------------------------------------------------------
@@ -597,13 +1203,193 @@ def sort_extractions():
     """
 
 
+#-------------------------------------------------------------------------------
+
+def model_field(visits, field='', ref_filter='', refine='all'):
+    """ Brings the saved models of a field up to date, as `model` does,
+    without loading the GroupFLT; the model task of `dag_tasks`.
+    """
+    grism_files, all_flt_files = field_files(visits, field)
+    p = Pointing(field=field, ref_filter=ref_filter)
+    update_models(grism_files, name=field,
+        ref_file=os.path.join(PATH_REF, p.ref_image),
+        seg_file=os.path.join(PATH_REF, p.seg_map),
+        catalog=os.path.join(PATH_REF, p.catalog), pad=p.pad, refine=refine)
+
+
+#-------------------------------------------------------------------------------
+
+def fit_field(visits, field='', ref_filter='', inputs=[], **kwargs):
+    """ Loads the saved models of a field and runs `fit` with `kwargs`; the
+    fit task of `dag_tasks`. The ledger is written even if no object was
+    left to fit, as it is the task's output.
+
+    The ledger is kept for the `inputs` of the fits (the saved models, the
+    manifest and the catalog) and the redshift grid it was started with;
+    when they changed, a new one is started (`fit_ledger.start_ledger`), 
+    so every object is fit again rather than skipped as fit.
+    """
+    digests = [[os.path.basename(path), file_digest(path)] 
+        for path in sorted(inputs)]
+    stamp = hashlib.sha1(json.dumps([digests, FIT_ZR, FIT_DZ])\
+        .encode('utf-8')).hexdigest()
+    if start_ledger('{}.ledger'.format(field), stamp):
+        logging.info("The inputs of field {} changed: fitting every object "
+            "again".format(field))
+
+    grp = model(visits=visits, field=field, ref_filter=ref_filter,
+        use_prep_path='.', use_model_path='.', load_only=True)
+    fit(grp, field=field, **kwargs)
+    open('{}.ledger'.format(field), 'a').close()
+
+
+#-------------------------------------------------------------------------------
+
+def model_files(flts):
+    """ Names the saved models, <root>.01.GrismFLT.fits/.pkl, of FLTs.
+    """
+    roots = [os.path.basename(flt).split('_flt')[0] for flt in flts]
+    return ['{}.01.GrismFLT.{}'.format(root, ext)
+        for root in roots for ext in ['fits', 'pkl']]
+
+
+#-------------------------------------------------------------------------------
+
+def dag_tasks(visits, fields, ref_filter='F105W', mag_lim=25,
+    do_steps=['prep', 'model', 'fit'], refine='all', workers=1,
+    fit_kwargs={}):
+    """ Lays out the steps as tasks of `pipeline_dag.run_dag`, in the
+    working directory.
+
+    * prep:<direct product>:<grism product>, for each visit pair, reads
+      the pair's FLTs in RAW and the radec catalog, and writes the pair's
+      prepped FLTs.
+    * model:shared, if several fields are modeled, models the FLTs they
+      share (`model_shared`). It keeps track of its own inputs, so it
+      always runs.
+    * model:<field> reads the field's prepped grism FLTs, the reference
+      image, segmentation map and catalog, and writes the saved models and
+      the model manifest.
+    * fit:<field> reads the saved models, the manifest and the catalog,
+      and writes the ledger; the ledger itself lets an interrupted fit
+      resume object by object, and is started over when those inputs
+      change (`fit_field`).
+    * render:<field> draws the PNGs that are out of date, so always runs.
+
+    Each task waits for the tasks of the earlier steps that write its
+    inputs, if those steps are among `do_steps`; otherwise its inputs must
+    already be in the working directory. The model and fit tasks never run
+    at the same time, as the fields' models share files: a fit never reads
+    the models of an FLT that another field's model task is re-saving.
+
+    Parameters
+    ----------
+    visits : OrderedDict
+        Keys of 'files' and 'products'; values of list of FLT files and product name.
+    fields : list of strings
+        The pointings.
+    ref_filter : string
+        The reference image's filter.
+    mag_lim : int
+        The magnitude limit of sources to extract and fit.
+    do_steps : list of strings
+        The steps to lay out.
+    refine : string
+        'all' or 'adaptive'; see `update_models`.
+    workers : int
+        Processes of the render tasks.
+    fit_kwargs : dict
+        Passed to `fit`, besides `field` and `mag_lim`.
+
+    Returns
+    -------
+    tasks : list of pipeline_dag.Tasks
+
+    """
+    tasks = []
+
+    # Prep, by visit pair; the pairs of one direct visit write its FLTs.
+    prep_by_flt = {}
+    if 'prep' in do_steps:
+        kwargs = {'run_dir':'.', 'path_raw':PATH_RAW,
+            'align_mag_limits':[14,23]}
+        for direct, grism in match_visits(visits, ref_filter=ref_filter,
+            ref_grism='G102'):
+            p = Pointing(field=grism['product'].split('-')[0],
+                ref_filter=ref_filter)
+            radec = os.path.join(PATH_REF, p.radec_catalog)
+            flts = direct['files'] + grism['files']
+            name = 'prep:{}:{}'.format(direct['product'], grism['product'])
+            tasks.append(Task(name, process_pair,
+                args=(direct, grism, radec), kwargs=kwargs,
+                inputs=[os.path.join(PATH_RAW, flt) for flt in flts] + [radec],
+                outputs=flts, params={'align_mag_limits':[14,23]},
+                resource=direct['product']))
+            for flt in flts:
+                prep_by_flt.setdefault(flt, []).append(name)
+
+    def prep_deps(flts):
+        return sorted(set([name for flt in flts
+            for name in prep_by_flt.get(flt, [])]))
+
+    shared_deps = []
+    if 'model' in do_steps and len(fields) > 1:
+        all_grism_files = [flt for field in fields
+            for flt in field_files(visits, field)[0]]
+        tasks.append(Task('model:shared', model_shared,
+            kwargs={'visits':visits, 'fields':fields,
+            'ref_filter':ref_filter},
+            deps=prep_deps(all_grism_files), resource='models'))
+        shared_deps = ['model:shared']
+
+    for field in fields:
+        grism_files, all_flt_files = field_files(visits, field)
+        p = Pointing(field=field, ref_filter=ref_filter)
+        refs = [os.path.join(PATH_REF, ref)
+            for ref in [p.ref_image, p.seg_map, p.catalog]]
+        models = model_files(grism_files)
+        manifest = '{}.model_manifest.json'.format(field)
+
+        if 'model' in do_steps:
+            tasks.append(Task('model:{}'.format(field), model_field,
+                kwargs={'visits':visits, 'field':field,
+                'ref_filter':ref_filter, 'refine':refine},
+                inputs=grism_files + refs, outputs=models + [manifest],
+                deps=prep_deps(grism_files) + shared_deps,
+                params={'refine':refine, 'pad':p.pad,
+                'model':MODEL_PARAMS, 'adaptive':ADAPTIVE_PARAMS},
+                resource='models'))
+
+        if 'fit' in do_steps:
+            inputs = models + [manifest, refs[2]]
+            kwargs = dict(fit_kwargs, visits=visits, field=field,
+                ref_filter=ref_filter, mag_lim=mag_lim, inputs=inputs)
+            tasks.append(Task('fit:{}'.format(field), fit_field,
+                kwargs=kwargs, inputs=inputs,
+                outputs=['{}.ledger'.format(field)],
+                deps=['model:{}'.format(field)] if 'model' in do_steps else [],
+                params={'mag_lim':mag_lim, 'fit_zr':FIT_ZR, 'fit_dz':FIT_DZ,
+                'make_figures':fit_kwargs.get('make_figures', True)},
+                resource='models'))
+
+        if 'render' in do_steps:
+            tasks.append(Task('render:{}'.format(field), render,
+                args=(field,), kwargs={'workers':workers},
+                deps=['fit:{}'.format(field)] if 'fit' in do_steps else []))
+
+    return tasks
+
+
 #-------------------------------------------------------------------------------
 
 @log_fail
 @log_info
 @log_metadata
 def clear_grizli_pipeline(fields, ref_filter='F105W', mag_lim=25,
-    do_steps=['prep', 'model', 'fit'], use_prep_path='.', use_model_path='.'):
+    do_steps=['prep', 'model', 'fit'], use_prep_path='.', use_model_path='.',
+    workers=1, timeout=600, order='brightest', dry_run=False,
+    prefit_chunk=1, make_figures=True, extract_workers=0, queue_size=None,
+    refine='all', dag=False, jobs=1):
     """ Main wrapper on pre-processing, modeling and extracting/fitting steps.
 
     Parameters
@@ -621,6 +1407,34 @@ def clear_grizli_pipeline(fields, ref_filter='F105W', mag_lim=25,
         Timestamp directory containing pre-processed files.
     use_model_path : string 
         Timestamp directory containing model files.
+    workers : int
+        Number of processes over which to spread the objects in `fit` and
+        the visit pairs in `prep`.
+    timeout : float
+        Wall-clock budget in seconds for each object in `fit`.
+    order : string
+        Order in which `fit` takes the objects, 'brightest' or 'catalog'.
+    dry_run : {True, False}
+        Set to True to only print the fit plan of each field and stop.
+    prefit_chunk : int
+        Number of objects whose polynomial prefits `fit` solves together.
+    make_figures : {True, False}
+        Set to False for `fit` to write only FITS; add the "render" step to
+        draw the PNGs afterwards.
+    extract_workers : int
+        Set above 0 for `fit` to extract beams in this many processes while 
+        `workers` processes fit them.
+    queue_size : int
+        When streaming, the most objects being extracted or waiting to be fit.
+    refine : string
+        How `model` refines the contamination models, 'all' or 'adaptive'.
+    dag : {True, False}
+        Set to True to run the steps as tasks of `pipeline_dag.run_dag`,
+        skipping those up to date; see `dag_tasks`. The FLTs of 
+        `use_prep_path` and the saved models and manifests of 
+        `use_model_path` are staged in first.
+    jobs : int
+        With `dag`, the number of tasks run at once.
 
     """
     if use_prep_path != '.':
@@ -632,9 +1446,43 @@ def clear_grizli_pipeline(fields, ref_filter='F105W', mag_lim=25,
     os.chdir(PATH_OUTPUTS_TIMESTAMP)
     logging.info("cd into {}".format(PATH_OUTPUTS_TIMESTAMP))
 
+    if dry_run:
+        for field in fields:
+            plan(field=field, ref_filter=ref_filter, mag_lim=mag_lim, 
+                workers=workers, order=order)
+        return
+
     # Find the files in RAW
     visits, filters = find_files(fields=fields)
 
+    if dag:
+        if use_prep_path != '.':
+            flts = sorted(set([flt for field in fields
+                for flt in field_files(visits, field)[1]]))
+            stage_files([os.path.join(use_prep_path, flt) for flt in flts],
+                dest='.', readme='README.txt')
+        if use_model_path != '.':
+            # The saved models and manifests are inputs of the fit tasks,
+            # and let the model tasks re-model only what changed.
+            saved = []
+            for field in fields:
+                saved += model_files(field_files(visits, field)[0])
+                saved.append('{}.model_manifest.json'.format(field))
+            saved = [os.path.join(use_model_path, path) for path in saved]
+            stage_files([path for path in saved if os.path.isfile(path)],
+                dest='.', readme='README.txt')
+        tasks = dag_tasks(visits, fields, ref_filter=ref_filter,
+            mag_lim=mag_lim, do_steps=do_steps, refine=refine, workers=workers,
+            fit_kwargs={'release':False, 'workers':workers, 'timeout':timeout,
+            'order':order, 'prefit_chunk':prefit_chunk,
+            'make_figures':make_figures, 'extract_workers':extract_workers,
+            'queue_size':queue_size})
+        status = run_dag(tasks, state_path='dag_state.json', jobs=jobs)
+        failed = [name for name in status if status[name] == 'failed']
+        if failed:
+            raise RuntimeError("Tasks failed: {}".format(', '.join(failed)))
+        return
+
     # In outputs run the prepsteps
     # All the 'fields' will be pre-processed at same time.
     # Not until next steps do we go field-by-field.
@@ -642,7 +1490,17 @@ def clear_grizli_pipeline(fields, ref_filter='F105W', mag_lim=25,
         logging.info(" ")
         logging.info("PERFORMING PRE-PROCESSING STEP")
         logging.info("...")
-        prep(visits=visits, ref_filter='F105W', ref_grism='G102')
+        prep(visits=visits, ref_filter='F105W', ref_grism='G102', 
+            workers=workers)
+
+    # Model the FLTs that several fields share once, up front; each field 
+    # then restores them from the model cache and refines them with its own.
+    if 'model' in do_steps and len(fields) > 1:
+        logging.info(" ")
+        logging.info("PERFORMING MODELING STEP FOR SHARED FLTS")
+        logging.info("...")
+        model_shared(visits=visits, fields=fields, ref_filter=ref_filter,
+            use_prep_path=use_prep_path)
 
     for field in fields:
         # Do the modeling; need have option which outputs subdir to use? (nominally, all will be same)
@@ -652,7 +1510,7 @@ def clear_grizli_pipeline(fields, ref_filter='F105W', mag_lim=25,
                 .format(field.upper()))
             logging.info("...")
             grp = model(visits=visits, field=field, ref_filter=ref_filter, 
-                use_prep_path=use_prep_path, load_only=False)
+                use_prep_path=use_prep_path, load_only=False, refine=refine)
 
         # Do the fitting; need have option which outputs subdir to use? 
         if 'fit' in do_steps:
@@ -667,7 +1525,18 @@ def clear_grizli_pipeline(fields, ref_filter='F105W', mag_lim=25,
                 grp = model(visits=visits, field=field, ref_filter=ref_filter, 
                     use_prep_path='.', use_model_path=use_model_path, 
                     load_only=True)
-            fit(grp, field=field, mag_lim=mag_lim, release=False) 
+            fit(grp, field=field, mag_lim=mag_lim, release=False, workers=workers,
+                timeout=timeout, order=order,
+                prefit_chunk=prefit_chunk, make_figures=make_figures,
+                extract_workers=extract_workers, queue_size=queue_size) 
+
+        # Draw the stack and full PNGs from the saved FITS.
+        if 'render' in do_steps:
+            logging.info(" ")
+            logging.info("PERFORMING RENDERING STEP FOR FIELD {}"\
+                .format(field.upper()))
+            logging.info("...")
+            render(field, workers=workers)
 
 
 #-------------------------------------------------------------------------------
@@ -690,11 +1559,23 @@ def parse_args():
     do_steps_help += "  prep "
     do_steps_help += "  model "
     do_steps_help += "  fit "
+    do_steps_help += "  render "
     rerun_help = "If the last run just crashed because you're testing things, "
     rerun_help += "re-run in the last outputs directory."
     rerun_help += "Do NOT do this for actual runs, to keep your results clean."
     prepdir_help = "Timestamp directory containing pre-processed files. '.' by default."
     modeldir_help = "Timestamp directory containing model files. '.' by default."
+    workers_help = "Number of processes over which to spread the objects in the fit step and the visit pairs in the prep step. Default is 1."
+    timeout_help = "Wall-clock budget in seconds for each object in the fit step. Default is 600."
+    order_help = "Order of objects in the fit step, 'brightest' or 'catalog'. Default is 'brightest'."
+    plan_help = "Set to 'True' to print the fit plan of each field and stop. Default is 'False'."
+    prefit_chunk_help = "Number of objects whose polynomial prefits are solved together. Default is 1."
+    figures_help = "Set to 'False' to write only FITS in the fit step and draw PNGs in the render step, with full_summary.png in place of full.png. Default is 'True'."
+    extract_workers_help = "Number of processes extracting beams while the fit step streams. Default is 0, not streaming."
+    queue_size_help = "Most objects being extracted or waiting to be fit when streaming. Default is twice the workers."
+    refine_help = "Refine the contam models of 'all' objects, or only 'adaptive'ly those with high residuals. Default is 'all'."
+    dag_help = "Set to 'True' to run the steps as a graph of tasks, skipping those up to date. Default is 'False'."
+    jobs_help = "With --dag 'True', the number of tasks run at once. Default is 1."
     release_help = "NotImplemented."
     
     parser = argparse.ArgumentParser()
@@ -722,6 +1603,41 @@ def parse_args():
     parser.add_argument('--modeldir', dest = 'modeldir',
                         action = 'store', type = str, required = False,
                         help = modeldir_help,  default='.')
+    parser.add_argument('--workers', dest = 'workers',
+                        action = 'store', type = int, required = False,
+                        help = workers_help,  default=1)
+    parser.add_argument('--timeout', dest = 'timeout',
+                        action = 'store', type = float, required = False,
+                        help = timeout_help,  default=600)
+    parser.add_argument('--order', dest = 'order',
+                        action = 'store', type = str, required = False,
+                        help = order_help,  default='brightest',
+                        choices=['brightest', 'catalog'])
+    parser.add_argument('--plan', dest = 'plan',
+                        action = 'store', type = str, required = False,
+                        help = plan_help,  default='False')
+    parser.add_argument('--prefit_chunk', dest = 'prefit_chunk',
+                        action = 'store', type = int, required = False,
+                        help = prefit_chunk_help,  default=1)
+    parser.add_argument('--figures', dest = 'figures',
+                        action = 'store', type = str, required = False,
+                        help = figures_help,  default='True')
+    parser.add_argument('--extract_workers', dest = 'extract_workers',
+                        action = 'store', type = int, required = False,
+                        help = extract_workers_help,  default=0)
+    parser.add_argument('--queue_size', dest = 'queue_size',
+                        action = 'store', type = int, required = False,
+                        help = queue_size_help,  default=None)
+    parser.add_argument('--refine', dest = 'refine',
+                        action = 'store', type = str, required = False,
+                        help = refine_help,  default='all',
+                        choices=['all', 'adaptive'])
+    parser.add_argument('--dag', dest = 'dag',
+                        action = 'store', type = str, required = False,
+                        help = dag_help,  default='False')
+    parser.add_argument('--jobs', dest = 'jobs',
+                        action = 'store', type = int, required = False,
+                        help = jobs_help,  default=1)
     parser.add_argument('--release', dest = 'release',
                         action = 'store', type = str, required = False,
                         help = release_help,  default=False)
@@ -743,6 +1659,17 @@ if __name__=='__main__':
     rerun = tobool(args.rerun) #this is so nifty!
     prepdir = args.prepdir
     modeldir = args.modeldir
+    workers = args.workers
+    timeout = args.timeout
+    order = args.order
+    dry_run = tobool(args.plan)
+    prefit_chunk = args.prefit_chunk
+    make_figures = tobool(args.figures)
+    extract_workers = args.extract_workers
+    queue_size = args.queue_size
+    refine = args.refine
+    dag = tobool(args.dag)
+    jobs = args.jobs
     release = args.release # NotImplemented
 
     if rerun:
@@ -764,5 +1691,9 @@ if __name__=='__main__':
     # in 'outputs/'.
 
     clear_grizli_pipeline(fields=['GN2'], ref_filter=ref_filter, mag_lim=mag_lim, 
-        do_steps=do_steps, use_prep_path=prepdir, use_model_path=modeldir)
+        do_steps=do_steps, use_prep_path=prepdir, use_model_path=modeldir,
+        workers=workers, timeout=timeout, order=order, 
+        dry_run=dry_run, prefit_chunk=prefit_chunk, make_figures=make_figures,
+        extract_workers=extract_workers, queue_size=queue_size, refine=refine,
+        dag=dag, jobs=jobs)
 
@@ -1,18 +1,274 @@
 """
 CLEAR grizli inspection tools.
 
+`flt_residuals` is the QA of the contamination models: for every FLT of a
+GroupFLT it measures the residuals (SCI - model) over the detector, writes
+them to a table, and draws a block-averaged preview; the full-resolution
+residual PNG is only drawn for the FLTs flagged as outliers. The previews
+and PNGs are drawn in a pool of processes with the Agg backend; drawn in
+this process, the caller's backend is restored afterwards.
+
+Use:
+
+    >>> stats = flt_residuals(grp, workers=8, output='GN2.flt_residuals.txt')
+
 """
 
+import logging
 import matplotlib.pyplot as plt
+import multiprocessing
+import numpy as np
+
+from astropy.table import Table
+
+
+# Residuals beyond this many sigma (ERR) are outliers.
+NSIGMA = 5.
+
+# An FLT with more outlier pixels than this fraction is flagged.
+OUTLIER_FRACTION = 0.02
+
+# An FLT whose residual RMS is above the median of the group by more than
+# this many robust standard deviations is flagged.
+RMS_NSIGMA = 5.
+
+# Side of the blocks averaged into one preview pixel.
+BLOCK = 4
+
+# Display range of the residual images.
+VMIN, VMAX = -0.05, 0.001
+
+# The GroupFLT of the running `flt_residuals`, inherited by forked workers.
+_grp = None
+
+
+#-------------------------------------------------------------------------------
+
+def _residual(flt):
+    """ Returns the residual image of an FLT, without the padding, and the
+    mask of its valid pixels.
+    """
+    pad = getattr(flt.grism, 'pad', 0)
+    pady, padx = (pad, pad) if np.isscalar(pad) else pad
+    inner = (slice(pady, -pady if pady > 0 else None),
+             slice(padx, -padx if padx > 0 else None))
+    sci = flt.grism['SCI'][inner]
+    err = flt.grism['ERR'][inner]
+    dq = flt.grism['DQ'][inner]
+    resid = sci - flt.model[inner]
+    valid = (err > 0) & (dq == 0) & np.isfinite(resid)
+
+    return resid, err, valid
+
+
+#-------------------------------------------------------------------------------
+
+def residual_stats(flt, nsigma=NSIGMA):
+    """ Measures the residuals of one FLT.
+
+    Parameters
+    ----------
+    flt : grizli.model.GrismFLT
+        With its contamination model.
+    nsigma : float
+        Valid pixels with |SCI - model| > `nsigma` * ERR are outliers.
+
+    Returns
+    -------
+    rms : float
+        RMS of SCI - model over the valid pixels.
+    outlier_frac : float
+        Fraction of the valid pixels that are outliers.
+    masked_frac : float
+        Fraction of the detector pixels that are not valid (flagged in
+        DQ, no ERR, or not finite).
+
+    """
+    return _stats(*_residual(flt), nsigma=nsigma)
+
+
+#-------------------------------------------------------------------------------
+
+def _stats(resid, err, valid, nsigma=NSIGMA):
+    """ `residual_stats` of the output of `_residual`.
+    """
+    n_valid = valid.sum()
+    if n_valid == 0:
+        return np.nan, np.nan, 1.
+
+    r = resid[valid]
+    rms = np.sqrt(np.mean(r**2))
+    outlier_frac = np.count_nonzero(np.abs(r) > nsigma * err[valid]) / n_valid
+    masked_frac = 1. - n_valid / valid.size
+
+    return rms, outlier_frac, masked_frac
+
+
+#-------------------------------------------------------------------------------
+
+def block_average(image, valid, block=BLOCK):
+    """ Averages the valid pixels of `image` in `block` x `block` blocks,
+    leaving NaN where a block has none. Edges that don't fill a block are
+    dropped.
+    """
+    ny, nx = (image.shape[0] // block) * block, (image.shape[1] // block) * block
+    shape = (ny // block, block, nx // block, block)
+    data = np.where(valid, image, 0.)[:ny, :nx].reshape(shape)
+    count = valid[:ny, :nx].reshape(shape).sum(axis=(1, 3))
+    total = data.sum(axis=(1, 3))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+
+#-------------------------------------------------------------------------------
+
+def flag_outliers(rms, outlier_frac, outlier_limit=OUTLIER_FRACTION,
+    rms_nsigma=RMS_NSIGMA):
+    """ Flags the FLTs whose residuals stand out.
+
+    An FLT is flagged if its outlier fraction is above `outlier_limit`, or
+    if its RMS is above the median of all of them by more than
+    `rms_nsigma` robust (MAD) standard deviations.
+
+    Returns
+    -------
+    flagged : array of bools
+
+    """
+    rms = np.asarray(rms, dtype=float)
+    flagged = ~(np.asarray(outlier_frac, dtype=float) <= outlier_limit)
+
+    ok = np.isfinite(rms)
+    if ok.sum() >= 3:
+        median = np.median(rms[ok])
+        sigma = 1.4826 * np.median(np.abs(rms[ok] - median))
+        flagged |= ok & (rms > median + rms_nsigma * sigma)
+
+    return flagged
+
+
+#-------------------------------------------------------------------------------
+
+def _init_worker():
+    """ Pool initializer. Draws off screen, whatever the parent used. Only
+    ever run in the workers; the serial path switches and restores the 
+    backend itself.
+    """
+    plt.switch_backend('Agg')
+
+
+#-------------------------------------------------------------------------------
+
+def _draw(task):
+    """ Pool task. Draws a preview, ('preview', name, image), or the full
+    residuals of FLT i of `_grp`, ('full', name, i).
+    Returns (name, error or None).
+    """
+    kind, name, data = task
+    try:
+        if kind == 'preview':
+            image, figsize, suffix = data, [4, 4], '_residuals_preview.png'
+        else:
+            flt = _grp.FLTs[data]
+            image = flt.grism['SCI'] - flt.model
+            figsize, suffix = [12, 12], '_residuals.png'
+
+        fig, ax = plt.subplots(figsize=figsize)
+        ax.imshow(image, vmin=VMIN, vmax=VMAX, cmap='Greys',
+            interpolation='Nearest', origin='lower')
+        ax.set_title(name)
+        fig.savefig('{}{}'.format(name.split('_flt.fits')[0], suffix))
+        plt.close(fig)
+    except Exception as err:
+        return name, '{}: {}'.format(type(err).__name__, err)
+    return name, None
+
+
+#-------------------------------------------------------------------------------
+
+def flt_residuals(grp, workers=1, output='flt_residuals.txt', block=BLOCK,
+    nsigma=NSIGMA):
+    """ Measures and draws the residuals of the contamination models.
+
+    Parameters
+    ----------
+    grp : grizli.multifit.GroupFLT
+        With the contamination models.
+    workers : int
+        Number of drawing processes.
+    output : string
+        The table of residual statistics to write. None to not write it.
+    block : int
+        Side of the blocks averaged into one preview pixel.
+    nsigma : float
+        Threshold of the outlier pixels; see `residual_stats`.
+
+    Returns
+    -------
+    stats : astropy.table.Table
+        Columns of file, rms, outlier_frac, masked_frac and flagged.
+
+    Outputs
+    -------
+    * <root>_residuals_preview.png : icxt51jwq_residuals_preview.png
+    * <root>_residuals.png         : icxt51jwq_residuals.png, flagged only
+    * `output`                     : GN2.flt_residuals.txt
+
+    """
+    global _grp
+
+    names = [flt.grism.parent_file for flt in grp.FLTs]
+    rms, outlier_frac, masked_frac, tasks = [], [], [], []
+    for flt, name in zip(grp.FLTs, names):
+        resid, err, valid = _residual(flt)
+        r, o, m = _stats(resid, err, valid, nsigma=nsigma)
+        rms.append(r)
+        outlier_frac.append(o)
+        masked_frac.append(m)
+        tasks.append(('preview', name, block_average(resid, valid, block=block)))
+
+    flagged = flag_outliers(rms, outlier_frac)
+    tasks += [('full', names[i], i) for i in np.where(flagged)[0]]
+
+    stats = Table([names, rms, outlier_frac, masked_frac, flagged],
+        names=['file', 'rms', 'outlier_frac', 'masked_frac', 'flagged'])
+    for col in ['rms', 'outlier_frac', 'masked_frac']:
+        stats[col].format = '.5g'
+    if output is not None:
+        stats.write(output, format='ascii.fixed_width', overwrite=True)
+
+    logging.info("Residuals of {} FLTs: median RMS {:.4g}, {} flagged{}"\
+        .format(len(names), np.nanmedian(rms) if len(names) else np.nan,
+        flagged.sum(), ': ' + ', '.join(np.array(names)[flagged])
+        if flagged.any() else ''))
+
+    _grp = grp
+    try:
+        if workers <= 1:
+            # Off screen here too, but the caller keeps its backend.
+            backend = plt.get_backend()
+            plt.switch_backend('Agg')
+            try:
+                results = [_draw(task) for task in tasks]
+            finally:
+                plt.switch_backend(backend)
+        else:
+            # Forked, so the workers draw the flagged FLTs from `_grp` as
+            # inherited rather than pickled.
+            pool = multiprocessing.get_context('fork').Pool(processes=workers,
+                initializer=_init_worker)
+            try:
+                results = list(pool.imap_unordered(_draw, tasks))
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        _grp = None
 
+    for name, error in results:
+        if error is not None:
+            logging.info("Could not draw the residuals of {}: {}".format(name,
+                error))
 
-def flt_residuals(grp):
-	"""
-	"""
-	for i in range(len(grp.FLTs)):
-	    fig, ax = plt.subplots(figsize=[12,12])
-	    ax.imshow(grp.FLTs[i].grism['SCI'] - grp.FLTs[i].model, vmin=-0.05, vmax=0.001,cmap='Greys',
-	          interpolation='Nearest', origin='lower')
-	    ax.set_title('%s' %(grp.FLTs[i].grism.parent_file))
-	    fig.savefig('{}_residuals.png'.format((grp.FLTs[i].grism.parent_file).split('_flt.fits')[0]))
-	    plt.close()
\ No newline at end of file
+    return stats
@@ -0,0 +1,181 @@
+"""
+Append-only per-field status ledger for the extract/stack/fit loop.
+
+Each line of the ledger records one stage reached by one object:
+
+    <unix time> <id> <stage> <elapsed seconds> <note>
+
+The ledger is read once into a dictionary when opened, so resume and skip
+decisions are O(1) lookups instead of globbing the products directory, and
+it tells "stack done, fit timed out" apart from "fully done". Lines are
+appended with single `write` calls on an O_APPEND descriptor, so forked fit
+workers can record into the same file as the parent.
+
+A ledger belongs to the inputs of the fits it records: `start_ledger` sets
+it aside and starts an empty one when those inputs change, e.g. the models
+were re-made, so every object is fit again.
+
+Use:
+
+    >>> start_ledger('GN2.ledger', stamp)
+    >>> ledger = FitLedger('GN2.ledger')
+    >>> ledger.record(23121, 'beams', 1.2)
+    >>> ledger.is_finished(23121)
+    False
+
+"""
+
+import glob
+import numpy as np
+import os
+import time
+
+
+# Stages in the order an object passes through them; the last three are
+# terminal.
+STAGES = ['beams', 'polyfit', 'stack', 'run_all', 'failed', 'timeout']
+FINISHED_STAGES = ['run_all', 'failed', 'timeout']
+
+
+#-------------------------------------------------------------------------------
+
+class FitLedger():
+    """ The status of every object of one field.
+
+    Parameters
+    ----------
+    path : string
+        The ledger file, e.g. 'GN2.ledger'. Created on the first record.
+
+    Attributes
+    ----------
+    stages : dict
+        Keys of object ids; values of the latest stage recorded.
+    elapsed : dict
+        Keys of object ids; values of dicts of stage -> seconds.
+    is_new : {True, False}
+        True if the ledger file did not exist when opened.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+        self.elapsed = {}
+        self.is_new = not os.path.isfile(path)
+
+        if not self.is_new:
+            with open(path) as f:
+                for line in f:
+                    parts = line.split(None, 4)
+                    if len(parts) < 4:
+                        # Tolerate a truncated last line after a crash.
+                        continue
+                    self._update(int(parts[1]), parts[2], float(parts[3]))
+
+    def _update(self, id, stage, elapsed):
+        self.stages[id] = stage
+        self.elapsed.setdefault(id, {})[stage] = elapsed
+
+    def record(self, id, stage, elapsed=0., note=''):
+        """ Appends a stage for object `id`.
+
+        Parameters
+        ----------
+        id : int
+            The catalog NUMBER.
+        stage : string
+            One of STAGES.
+        elapsed : float
+            Seconds spent in the stage.
+        note : string
+            Free text, e.g. the reason for a failure. Kept to one line.
+        """
+        if stage not in STAGES:
+            raise ValueError("Unknown ledger stage '{}'".format(stage))
+        id = int(id)
+        line = '{:.3f} {} {} {:.3f} {}\n'.format(time.time(), id, stage,
+            elapsed, ' '.join(str(note).split()))
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+        self._update(id, stage, elapsed)
+
+    def stage(self, id):
+        """ Returns the latest stage of `id`, or None if never started.
+        """
+        return self.stages.get(int(id))
+
+    def is_finished(self, id):
+        """ True if `id` reached a terminal stage (fit, failed or timed out).
+        """
+        return self.stages.get(int(id)) in FINISHED_STAGES
+
+    def ids(self, stages=FINISHED_STAGES):
+        """ Returns an array of the ids whose latest stage is in `stages`.
+        """
+        return np.array([id for id, stage in self.stages.items()
+            if stage in stages], dtype=int)
+
+    def bootstrap(self, field):
+        """ Seeds a new ledger from the products of an earlier run made
+        without one, so those objects aren't fit again. Objects with a
+        <field>_<id>.full.fits are recorded as 'run_all', objects with only
+        a <field>_<id>.stack.fits as 'stack'.
+
+        Parameters
+        ----------
+        field : string
+            The pointing, technically, 'GN1', 'GS1', etc.
+        """
+        for stage, ext in [('stack', 'stack.fits'), ('run_all', 'full.fits')]:
+            for product in glob.glob('{}_[0-9]*.{}'.format(field, ext)):
+                id = int(os.path.basename(product)[len(field)+1:].split('.')[0])
+                if self.stage(id) != 'run_all':
+                    self.record(id, stage, note='bootstrap')
+
+
+#-------------------------------------------------------------------------------
+
+def start_ledger(path, stamp):
+    """ Starts a new, empty ledger at `path` if the one there records fits
+    of other inputs.
+
+    The stamp of the inputs the ledger belongs to is kept in <path>.inputs.
+    When it differs from `stamp`, the ledger is renamed <path>.<old stamp>
+    and an empty one takes its place, so nothing counts as fit, and
+    `FitLedger.bootstrap` doesn't seed it from the old products. A ledger
+    older than stamps is kept, for the inputs it records are unknown.
+
+    Parameters
+    ----------
+    path : string
+        The ledger file, e.g. 'GN2.ledger'.
+    stamp : string
+        Identifies the inputs, e.g. a digest of the saved models.
+
+    Returns
+    -------
+    started : {True, False}
+        True if an empty ledger was started for new inputs.
+    """
+    stamp_path = path + '.inputs'
+    old = None
+    if os.path.isfile(stamp_path):
+        with open(stamp_path) as f:
+            old = f.read().strip()
+    if old == stamp:
+        return False
+
+    started = old is not None
+    if started:
+        if os.path.isfile(path):
+            os.replace(path, '{}.{}'.format(path, old[:12]))
+        open(path, 'w').close()
+
+    tmp = stamp_path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(stamp + '\n')
+    os.replace(tmp, stamp_path)
+
+    return started
@@ -0,0 +1,177 @@
+"""
+Work-list planner for the extract/stack/fit loop.
+
+Selects the objects left to fit from a catalog and a field's status ledger
+with one set of NumPy masks, orders them, and estimates what the run will
+cost from the timings already in the ledger.
+
+Use:
+
+    >>> ids, mags = plan_fits(grp.catalog['NUMBER'], grp.catalog['MAG_AUTO'],
+    ...     ledger=ledger, mag_lim=25)
+    >>> print_plan(grp.catalog['NUMBER'], grp.catalog['MAG_AUTO'], ids, mags,
+    ...     ledger=ledger, workers=8)
+
+"""
+
+import numpy as np
+
+from fit_ledger import FINISHED_STAGES
+
+
+# Seconds per object assumed when the ledger has no timings yet.
+DEFAULT_COST = 120.
+
+ORDERS = ['brightest', 'catalog']
+
+
+#-------------------------------------------------------------------------------
+
+def plan_fits(ids, mags, ledger=None, mag_lim=35, mag_min=None, min_id=0,
+    id_choose=None, order='brightest'):
+    """ Returns the ordered list of objects still to fit.
+
+    Parameters
+    ----------
+    ids : array of ints
+        The catalog NUMBER column.
+    mags : array of floats
+        The catalog MAG_AUTO column.
+    ledger : fit_ledger.FitLedger
+        Objects in a finished stage here are dropped.
+    mag_lim : float
+        Faintest magnitude to fit.
+    mag_min : float
+        Brightest magnitude to fit. None for no limit.
+    min_id : int
+        Only ids greater than this are fit.
+    id_choose : int
+        If given, fit only this id.
+    order : string
+        'brightest' to fit the brightest objects first, 'catalog' to keep
+        catalog order.
+
+    Returns
+    -------
+    ids, mags : arrays
+        The objects to fit, in the order to fit them.
+
+    """
+    if order not in ORDERS:
+        raise ValueError("order must be one of {}".format(ORDERS))
+
+    ids = np.asarray(ids).astype(int)
+    mags = np.asarray(mags, dtype=float)
+
+    mask = (mags <= mag_lim) & (ids > min_id)
+    if mag_min is not None:
+        mask &= mags >= mag_min
+    if id_choose is not None:
+        mask &= ids == id_choose
+    if ledger is not None:
+        mask &= ~np.isin(ids, ledger.ids())
+
+    sel = np.flatnonzero(mask)
+    if order == 'brightest':
+        sel = sel[np.argsort(mags[sel], kind='stable')]
+
+    return ids[sel], mags[sel]
+
+
+#-------------------------------------------------------------------------------
+
+def estimate_cost(ids, mags, todo_mags, ledger=None, bin_width=1.):
+    """ Estimates the seconds each planned object will take.
+
+    Uses the median total time of objects already fit to completion in the
+    same magnitude bin, falling back to the median over all magnitudes,
+    then to DEFAULT_COST.
+
+    Parameters
+    ----------
+    ids, mags : arrays
+        The full catalog NUMBER and MAG_AUTO columns.
+    todo_mags : array
+        Magnitudes of the planned objects.
+    ledger : fit_ledger.FitLedger
+        Source of the timings.
+    bin_width : float
+        Width of the magnitude bins, in magnitudes.
+
+    Returns
+    -------
+    cost : array
+        Estimated seconds for each planned object.
+
+    """
+    todo_mags = np.asarray(todo_mags, dtype=float)
+    cost = np.full(len(todo_mags), DEFAULT_COST)
+    if ledger is None:
+        return cost
+
+    done = ledger.ids(stages=['run_all'])
+    totals = np.array([sum(ledger.elapsed[id].values()) for id in done])
+    keep = totals > 0
+    if not keep.any():
+        return cost
+    done, totals = done[keep], totals[keep]
+    cost[:] = np.median(totals)
+
+    # Catalog magnitudes of the finished objects.
+    ids = np.asarray(ids).astype(int)
+    mags = np.asarray(mags, dtype=float)
+    order = np.argsort(ids)
+    found = np.searchsorted(ids, done, sorter=order)
+    found = np.clip(found, 0, len(ids)-1)
+    matched = ids[order][found] == done
+    done_bins = np.floor(mags[order][found][matched] / bin_width)
+    totals = totals[matched]
+
+    todo_bins = np.floor(todo_mags / bin_width)
+    for b in np.unique(done_bins):
+        cost[todo_bins == b] = np.median(totals[done_bins == b])
+
+    return cost
+
+
+#-------------------------------------------------------------------------------
+
+def print_plan(ids, mags, todo_ids, todo_mags, ledger=None, mag_lim=35,
+    workers=1):
+    """ Prints object counts and the estimated cost of a planned fit.
+
+    Parameters
+    ----------
+    ids, mags : arrays
+        The full catalog NUMBER and MAG_AUTO columns.
+    todo_ids, todo_mags : arrays
+        The planned objects, from `plan_fits`.
+    ledger : fit_ledger.FitLedger
+        The field's ledger.
+    mag_lim : float
+        The magnitude limit used for the plan.
+    workers : int
+        Number of objects fit at once.
+
+    """
+    ids = np.asarray(ids).astype(int)
+    mags = np.asarray(mags, dtype=float)
+    in_lim = mags <= mag_lim
+
+    print("Catalog objects:          {}".format(len(ids)))
+    print("Within mag limit {}:      {}".format(mag_lim, in_lim.sum()))
+    if ledger is not None:
+        for stage in FINISHED_STAGES:
+            n = np.isin(ids[in_lim], ledger.ids(stages=[stage])).sum()
+            print("  already {:<9s}        {}".format(stage + ':', n))
+    print("To fit:                   {}".format(len(todo_ids)))
+
+    if len(todo_ids) == 0:
+        return
+
+    cost = estimate_cost(ids, mags, todo_mags, ledger=ledger)
+    print("Magnitude range:          {:.2f} - {:.2f}".format(np.min(todo_mags),
+        np.max(todo_mags)))
+    print("Estimated CPU time:       {:.1f} h".format(cost.sum() / 3600.))
+    print("Estimated wall time:      {:.1f} h on {} workers".format(
+        cost.sum() / 3600. / max(workers, 1), max(workers, 1)))
@@ -0,0 +1,375 @@
+"""
+Per-object process supervisor for the CLEAR grizli pipelines.
+
+Runs each task in its own forked child so that a hung grizli call can be
+killed without taking the rest of the field down with it. Unlike
+`signal.alarm`, this works from any thread and for any number of workers.
+
+`stream` chains two stages: forked processes extracting beams (I/O bound)
+feed, at most a bounded number of tasks ahead, forked children fitting them
+(CPU bound), so the fits start as soon as the first beams are written.
+
+Use:
+
+    >>> for task, status, result in supervise(func, tasks, workers=8, timeout=600):
+    ...     print(task, status)
+
+    >>> for task, stage, status, result in stream(extract, fit, tasks,
+    ...     extract_workers=4, fit_workers=8, timeout=600):
+    ...     print(task, stage, status)
+
+"""
+
+import collections
+import multiprocessing
+import time
+import traceback
+
+from multiprocessing.connection import wait
+
+
+# Yielded by a task iterator of `supervise` when no task is ready yet but 
+# more may come.
+PENDING = object()
+
+
+#-------------------------------------------------------------------------------
+
+def _run_child(func, task, conn):
+    """ Child process target. Sends ('done', result) or ('failed', traceback)
+    back through `conn`.
+    """
+    try:
+        result = func(task)
+    except Exception:
+        conn.send(('failed', traceback.format_exc()))
+    else:
+        conn.send(('done', result))
+    conn.close()
+
+
+#-------------------------------------------------------------------------------
+
+def _stop(proc, grace=5.):
+    """ Terminates `proc`, escalating to SIGKILL if it ignores SIGTERM.
+    """
+    proc.terminate()
+    proc.join(grace)
+    if proc.is_alive():
+        proc.kill()
+        proc.join()
+
+
+#-------------------------------------------------------------------------------
+
+def _workers(workers):
+    """ Resolves joblib-style worker counts (<= 0 counts back from the cores).
+    """
+    if workers <= 0:
+        workers = max(multiprocessing.cpu_count() + 1 + workers, 1)
+    return workers
+
+
+#-------------------------------------------------------------------------------
+
+def supervise(func, tasks, workers=1, timeout=None, poll=1.):
+    """ Runs `func(task)` for every task, each in a fresh forked child,
+    keeping up to `workers` children busy at once.
+
+    Children are forked, so `func` and anything it closes over (a GroupFLT,
+    loaded templates) are inherited rather than pickled. Only the return
+    value of `func` travels back, so keep it small. Tasks are pulled from
+    `tasks` lazily, one per free worker.
+
+    Parameters
+    ----------
+    func : callable
+        Called as `func(task)` in the child.
+    tasks : iterable
+        The tasks, e.g. (id, mag) pairs. It may yield PENDING when no task
+        is ready yet, e.g. while waiting on another stage; it should then 
+        have blocked for a moment first, as it is polled again right away
+        when no child is running.
+    workers : int
+        Maximum number of children alive at once. Values <= 0 count back
+        from the number of cores, as in joblib (-1 is all cores).
+    timeout : float, callable or None
+        Wall-clock budget in seconds per task. A child that overruns is
+        killed. A callable is called as `timeout(task)` for the budget of
+        each task. None for no limit.
+    poll : float
+        Seconds between deadline checks.
+
+    Returns
+    -------
+    A generator of (task, status, result) in completion order, where status
+    is 'done', 'failed' or 'timeout'. `result` is the return value of `func`
+    when 'done', the child's traceback when 'failed', and the elapsed
+    seconds when 'timeout'.
+
+    """
+    workers = _workers(workers)
+
+    ctx = multiprocessing.get_context('fork')
+    tasks = iter(tasks)
+    running = {}
+    exhausted = False
+
+    try:
+        while True:
+            # Top up the free workers.
+            while not exhausted and len(running) < workers:
+                try:
+                    task = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if task is PENDING:
+                    break
+                recv_conn, send_conn = ctx.Pipe(duplex=False)
+                proc = ctx.Process(target=_run_child, args=(func, task, send_conn))
+                proc.start()
+                send_conn.close()
+                limit = timeout(task) if callable(timeout) else timeout
+                running[recv_conn] = (proc, task, time.time(), limit)
+
+            if not running:
+                if exhausted:
+                    return
+                continue
+
+            # A closed pipe also counts as ready, so a child that dies without
+            # reporting (segfault, OOM kill) is noticed here too.
+            for conn in wait(list(running.keys()), timeout=poll):
+                proc, task, start, limit = running.pop(conn)
+                try:
+                    status, result = conn.recv()
+                except EOFError:
+                    proc.join()
+                    status, result = 'failed', 'child exited with code {}'.format(proc.exitcode)
+                conn.close()
+                proc.join()
+                yield task, status, result
+
+            now = time.time()
+            for conn in [c for c, (p, t, start, limit) in running.items()
+                if limit is not None and now - start > limit]:
+                proc, task, start, limit = running.pop(conn)
+                _stop(proc)
+                conn.close()
+                yield task, 'timeout', now - start
+    finally:
+        # Don't leave orphans behind if the caller stops early or is interrupted.
+        for conn, (proc, task, start, limit) in running.items():
+            _stop(proc)
+            conn.close()
+
+
+#-------------------------------------------------------------------------------
+
+def _extract_child(extract, conn):
+    """ Extraction process target. Runs `extract` on each task received 
+    through `conn`, in order, until None, and sends back (task, 'done' or 
+    'skipped', None) or (task, 'failed', traceback).
+    """
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        try:
+            ok = extract(task)
+        except Exception:
+            conn.send((task, 'failed', traceback.format_exc()))
+        else:
+            conn.send((task, 'done' if ok else 'skipped', None))
+    conn.close()
+
+
+#-------------------------------------------------------------------------------
+
+def stream(extract, fit, tasks, extract_workers=1, fit_workers=1, 
+    queue_size=None, timeout=None, extract_timeout=None, poll=1.):
+    """ Runs `extract(task)` and then `fit(task)` for every task, with the 
+    two stages overlapping.
+
+    `extract` runs in `extract_workers` processes, forked once at the start
+    so they share whatever it closes over (e.g. a GroupFLT), and should 
+    leave its product on disk. Tasks are handed to them at most 
+    `queue_size` ahead of the fits; each task they finish is fit with 
+    `supervise`, in a forked child with a budget of `timeout`. No threads 
+    run in this process, so the fitting children are never forked while a 
+    lock is held.
+
+    An extraction process that dies, or overruns `extract_timeout` on a 
+    task, is replaced: the task it was on is reported failed or timed out,
+    and the ones waiting behind it are handed out again, so a hung 
+    extraction can't stall the queue.
+
+    Parameters
+    ----------
+    extract : callable
+        Called as `extract(task)` in an extraction process. Returns True if
+        the task should go on to be fit.
+    fit : callable
+        Called as `fit(task)` in a forked child.
+    tasks : iterable
+        The tasks, e.g. (id, mag) pairs. They are sent to the extraction 
+        processes, so must pickle.
+    extract_workers : int
+        Number of extraction processes. Values <= 0 count back from the 
+        number of cores.
+    fit_workers : int
+        Maximum number of fitting children alive at once. Values <= 0 count
+        back from the number of cores.
+    queue_size : int
+        Most tasks being extracted or waiting to be fit. By default twice 
+        `fit_workers`.
+    timeout : float, callable or None
+        Wall-clock budget in seconds per fit, as for `supervise`. None for
+        no limit.
+    extract_timeout : float, callable or None
+        Wall-clock budget in seconds per extraction, from when the process
+        starts on the task. By default `timeout`.
+    poll : float
+        Seconds between checks on the other stage and on the deadlines.
+
+    Returns
+    -------
+    A generator of (task, stage, status, result), where stage is 'extract'
+    or 'fit'. For 'fit', status and result are as from `supervise`. For 
+    'extract', status is 'skipped' when `extract` returned False, with None
+    as result, 'failed' with the traceback, or the exit code of the 
+    process that died, or 'timeout' with the elapsed seconds. Extraction outcomes are reported along with the next
+    fit to finish, and at the end.
+
+    """
+    extract_workers = _workers(extract_workers)
+    fit_workers = _workers(fit_workers)
+    if queue_size is None:
+        queue_size = 2 * fit_workers
+    if extract_timeout is None:
+        extract_timeout = timeout
+
+    ctx = multiprocessing.get_context('fork')
+    tasks = iter(tasks)
+    exhausted = [False]
+    retry = collections.deque()
+    ready = collections.deque()
+    events = collections.deque()
+    # Pipe -> (process, tasks sent to it and not yet answered, in order).
+    extractors = collections.OrderedDict()
+    # Pipe -> when the process started on the first of those tasks.
+    started = {}
+
+    def start():
+        conn, child_conn = ctx.Pipe()
+        proc = ctx.Process(target=_extract_child, args=(extract, child_conn))
+        proc.start()
+        child_conn.close()
+        extractors[conn] = (proc, collections.deque())
+
+    def assign():
+        # Hands out tasks, to the least loaded process, while fewer than
+        # queue_size are being extracted or waiting to be fit.
+        while retry or not exhausted[0]:
+            sent = sum([len(assigned) for _, assigned in extractors.values()])
+            if sent + len(ready) >= queue_size:
+                return
+            if retry:
+                task = retry.popleft()
+            else:
+                try:
+                    task = next(tasks)
+                except StopIteration:
+                    exhausted[0] = True
+                    return
+            conn = min(extractors, key=lambda c: len(extractors[c][1]))
+            if not extractors[conn][1]:
+                started[conn] = time.time()
+            extractors[conn][1].append(task)
+            try:
+                conn.send(task)
+            except OSError:
+                # Already dead: collect() finds it out and retries the task.
+                pass
+
+    def replace(conn, status, result):
+        # Reports the task the process was on, hands out the ones behind 
+        # it again, and starts a new process in its place.
+        proc, assigned = extractors.pop(conn)
+        del started[conn]
+        events.append((assigned.popleft(), 'extract', status, result))
+        retry.extend(assigned)
+        conn.close()
+        start()
+
+    def collect():
+        busy = [conn for conn in extractors if extractors[conn][1]]
+        for conn in (wait(busy, timeout=poll) if busy else []):
+            proc, assigned = extractors[conn]
+            try:
+                task, status, result = conn.recv()
+            except (EOFError, OSError):
+                # Died; a reset if tasks it hadn't read were left behind.
+                proc.join()
+                replace(conn, 'failed', 'extraction process exited with '
+                    'code {}'.format(proc.exitcode))
+                continue
+            assigned.popleft()
+            started[conn] = time.time()
+            if status == 'done':
+                ready.append(task)
+            else:
+                events.append((task, 'extract', status, result))
+
+        now = time.time()
+        for conn in list(extractors):
+            proc, assigned = extractors[conn]
+            if not assigned:
+                continue
+            limit = extract_timeout(assigned[0]) if callable(extract_timeout) \
+                else extract_timeout
+            if limit is not None and now - started[conn] > limit:
+                _stop(proc)
+                replace(conn, 'timeout', now - started[conn])
+
+    def extracted():
+        while True:
+            assign()
+            if ready:
+                yield ready.popleft()
+                continue
+            if exhausted[0] and not retry and \
+                not any([assigned for _, assigned in extractors.values()]):
+                return
+            collect()
+            if not ready:
+                yield PENDING
+
+    # Forked before any fitting child, and before anything else runs.
+    for i in range(extract_workers):
+        start()
+
+    try:
+        for task, status, result in supervise(fit, extracted(), 
+            workers=fit_workers, timeout=timeout, poll=poll):
+            while events:
+                yield events.popleft()
+            yield task, 'fit', status, result
+        while events:
+            yield events.popleft()
+    finally:
+        # Let the processes finish the object in hand and stop taking more.
+        for conn, (proc, _) in extractors.items():
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for conn, (proc, _) in extractors.items():
+            proc.join(poll)
+            if proc.is_alive():
+                _stop(proc)
+            conn.close()
@@ -0,0 +1,253 @@
+#! /usr/bin/env python
+
+"""
+Persistent, incremental index of FLT headers.
+
+`find_files` and `grizli_getfiles` called `grizli.utils.get_flt_info` on
+every *flt.fits of RAW on every run, opening each header again. Here the
+rows of that table are kept in an SQLite file keyed on each FLT's path,
+size and mtime. `flt_info` only passes the new or changed FLTs to
+`get_flt_info`, in threads, and builds the same table from the index for
+the rest, in milliseconds for an unchanged archive.
+
+The index is rebuilt whenever grizli's version or the columns it returns
+change. Entries of FLTs that no longer exist are dropped.
+
+Use:
+
+    >>> info = flt_info(glob.glob('RAW/*flt.fits'), index_path='RAW/flt_index.db')
+
+    or, to also write RAW/files.info,
+
+    >>> python flt_index.py --raw RAW --filesinfo RAW/files.info
+
+"""
+
+import argparse
+import glob
+import grizli
+import grizli.utils
+import json
+import logging
+import numpy as np
+import os
+import sqlite3
+import time
+
+from astropy.table import Table, vstack
+from multiprocessing.pool import ThreadPool
+
+
+# Bump when the index layout changes.
+INDEX_VERSION = 1
+
+# FLTs read by one thread at a time.
+CHUNK = 16
+
+
+#-------------------------------------------------------------------------------
+
+def _connect(index_path):
+    """ Opens the index, creating its tables if needed.
+    """
+    conn = sqlite3.connect(index_path, timeout=60)
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS flts (path TEXT PRIMARY KEY, "
+        "size INTEGER, mtime REAL, row TEXT)")
+    return conn
+
+
+#-------------------------------------------------------------------------------
+
+def _schema():
+    """ Identifies what the stored rows depend on.
+    """
+    return json.dumps({'version':INDEX_VERSION,
+        'grizli_version':getattr(grizli, '__version__', '')})
+
+
+#-------------------------------------------------------------------------------
+
+def _columns(info):
+    """ Returns [names, dtypes] of the columns of a `get_flt_info` table.
+    String columns are given by kind only, so their widths follow the rows.
+    """
+    dtypes = [info[c].dtype.kind if info[c].dtype.kind in 'US'
+        else info[c].dtype.str for c in info.colnames]
+    return [info.colnames, dtypes]
+
+
+#-------------------------------------------------------------------------------
+
+def _to_json(value):
+    """ Converts a table value to a JSON-able one.
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if isinstance(value, np.generic):
+        return _to_json(value.item())
+    return value
+
+
+#-------------------------------------------------------------------------------
+
+def _read_headers(files, threads=8):
+    """ Runs `get_flt_info` on `files` in chunks over threads.
+
+    Returns
+    -------
+    info : astropy.table.Table
+        In the order of `files`.
+
+    """
+    chunks = [files[i:i + CHUNK] for i in range(0, len(files), CHUNK)]
+    if threads <= 1 or len(chunks) <= 1:
+        tables = [grizli.utils.get_flt_info(chunk) for chunk in chunks]
+    else:
+        pool = ThreadPool(min(threads, len(chunks)))
+        try:
+            tables = pool.map(grizli.utils.get_flt_info, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    return vstack(tables, join_type='exact', metadata_conflicts='silent')
+
+
+#-------------------------------------------------------------------------------
+
+def flt_info(files, index_path, threads=8):
+    """ Returns `grizli.utils.get_flt_info(files)`, reading only the
+    headers that aren't in the index yet or changed.
+
+    Parameters
+    ----------
+    files : list of strings
+        The FLTs.
+    index_path : string
+        The SQLite index, created if missing.
+    threads : int
+        Threads reading the new headers.
+
+    Returns
+    -------
+    info : astropy.table.Table
+        One row per FLT, in the order of `files`.
+
+    """
+    start = time.time()
+    keys = [os.path.abspath(f) for f in files]
+    stats = {}
+    for key in keys:
+        stat = os.stat(key)
+        stats[key] = (stat.st_size, stat.st_mtime)
+
+    conn = _connect(index_path)
+    try:
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        columns = json.loads(meta['columns']) if 'columns' in meta else None
+        if meta.get('schema') != _schema():
+            conn.execute("DELETE FROM flts")
+            columns = None
+
+        rows = {}
+        for path, size, mtime, row in conn.execute(
+                "SELECT path, size, mtime, row FROM flts").fetchall():
+            if path not in stats:
+                if not os.path.exists(path):
+                    conn.execute("DELETE FROM flts WHERE path = ?", (path,))
+            elif (size, mtime) == stats[path]:
+                rows[path] = json.loads(row)
+
+        todo = [key for key in keys if key not in rows]
+        if todo:
+            by_key = dict(zip(keys, files))
+            new = _read_headers([by_key[key] for key in todo], threads=threads)
+            if columns is not None and _columns(new) != columns:
+                # get_flt_info returns other columns now: read everything.
+                conn.execute("DELETE FROM flts")
+                rows, todo = {}, keys
+                new = _read_headers(files, threads=threads)
+            columns = _columns(new)
+
+            for key, row in zip(todo, new):
+                rows[key] = [_to_json(row[c]) for c in columns[0]]
+                conn.execute("INSERT OR REPLACE INTO flts VALUES (?, ?, ?, ?)",
+                    (key, stats[key][0], stats[key][1], json.dumps(rows[key])))
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('schema', ?)",
+                (_schema(),))
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('columns', ?)",
+                (json.dumps(columns),))
+
+        conn.commit()
+    finally:
+        conn.close()
+
+    if columns is None:
+        # Nothing indexed and nothing to read.
+        return grizli.utils.get_flt_info(files)
+
+    colnames, dtypes = columns
+    info = Table(rows=[rows[key] for key in keys], names=colnames,
+        dtype=dtypes)
+
+    logging.info("FLT index: {} of {} headers read, in {:.2f} s"\
+        .format(len(todo), len(keys), time.time() - start))
+
+    return info
+
+
+#-------------------------------------------------------------------------------
+
+def write_filesinfo(info, path):
+    """ Writes the table of `flt_info` as a files.info, a whitespace-
+    separated table with a header line of the column names.
+    """
+    info.write(path, format='ascii.basic', overwrite=True)
+
+
+#-------------------------------------------------------------------------------
+
+def parse_args():
+    """Parses command line arguments.
+
+    Returns
+    -------
+    args : object
+        Containing the raw, index, filesinfo and threads arguments.
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--raw', dest = 'raw',
+                        action = 'store', type = str, required = True,
+                        help = "Directory of the *flt.fits.")
+    parser.add_argument('--index', dest = 'index',
+                        action = 'store', type = str, required = False,
+                        help = "The index. Default is <raw>/flt_index.db.",
+                        default=None)
+    parser.add_argument('--filesinfo', dest = 'filesinfo',
+                        action = 'store', type = str, required = False,
+                        help = "Also write the table to this files.info.",
+                        default=None)
+    parser.add_argument('--threads', dest = 'threads',
+                        action = 'store', type = int, required = False,
+                        help = "Threads reading new headers. Default is 8.",
+                        default=8)
+    args = parser.parse_args()
+
+    return args
+
+
+#-------------------------------------------------------------------------------
+#-------------------------------------------------------------------------------
+
+if __name__=="__main__":
+
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    index = args.index or os.path.join(args.raw, 'flt_index.db')
+    info = flt_info(sorted(glob.glob(os.path.join(args.raw, '*flt.fits'))),
+        index_path=index, threads=args.threads)
+    if args.filesinfo is not None:
+        write_filesinfo(info, args.filesinfo)
+    print("Indexed {} FLTs in {}".format(len(info), index))
@@ -10,7 +10,6 @@ import grizli
 import glob
 from grizli import utils
 import importlib
-from grizli.prep import process_direct_grism_visit
 #from hsaquery import query, overlaps
 from grizli.pipeline import auto_script
 from grizli.multifit import GroupFLT, MultiBeam, get_redshift_fit_defaults
@@ -18,10 +17,22 @@ import os, sys, argparse
 from grizli.pipeline import photoz
 from astropy.table import Table
 import eazy
-from joblib import Parallel, delayed
 from glob import glob
 from mastquery import query, overlaps
 import gc
+from functools import partial
+from fit_supervisor import stream, supervise
+from shared_grp import SharedGroup, map_grp
+from adaptive_refine import refine_adaptive
+from lazy_grp import load_lazy_grp
+from model_cache import restore_models, store_models
+from model_deps import needs_refinement, plan_models, refined_digests, remove_saved_models, save_manifest
+from model_scheduler import model_flts, model_workers
+from template_cache import load_cached_templates
+from fit_ledger import FitLedger
+from flt_index import flt_info
+from prep_pool import plan_pairs, prep_pairs
+from fit_planner import plan_fits, print_plan
 
 plt.ioff()
 plt.close('all')
@@ -47,14 +58,21 @@ def parse():
     parser.add_argument('-on_jase', '--on_jase',    action = "store_true", default = False, help = 'bool to retrieve files from MAST')
     parser.add_argument('-do_prep',     '--do_prep',        action = "store_true", default = False, help = 'bool to PREP files with Grizli')
     parser.add_argument('-do_new_model',   '--do_new_model',      action = "store_true", default = False, help = 'bool to create new Grizli models')
+    parser.add_argument('-adaptive_refine', '--adaptive_refine', action = "store_true", default = False, help = 'refine only the objects whose contamination models leave high residuals')
     parser.add_argument('-do_beams',    '--do_beams',         action = "store_true", default = False, help = 'bool to write beams files')
     parser.add_argument('-do_fit',      '--do_fit',         action = "store_true", default = False, help = 'bool to fit modeled spectra')
     parser.add_argument('-use_psf',      '--use_psf',         action = "store_true", default = False, help = 'use psf extraction in fitting routine')
     parser.add_argument('-make_catalog',      '--make_catalog',         action = "store_true", default = False, help = 'use psf extraction in fitting routine')
     parser.add_argument('-use_phot',      '--use_phot',         action = "store_true", default = False, help = 'use psf extraction in fitting routine')
+    parser.add_argument('-plan',        '--plan',           action = "store_true", default = False, help = 'print the fit plan and estimated cost, then stop')
+    parser.add_argument('-stream',      '--stream',         action = "store_true", default = False, help = 'extract beams and fit them at the same time')
+    parser.add_argument('-extract_jobs', '--extract_jobs',  type = int, default = 4, help = 'number of beam extraction processes when streaming')
+    parser.add_argument('-queue_size',  '--queue_size',     type = int, default = None, help = 'most extracted objects waiting to be fit when streaming')
+    parser.add_argument('-order',       '--order',          default = 'brightest', choices = ['brightest', 'catalog'], help = 'order in which to fit objects')
 
     parser.add_argument('-fit_min_id',  '--fit_min_id',     type = int, default = 0, help = 'ID to start on for the fit')
     parser.add_argument('-n_jobs',      '--n_jobs',         type = int, default = -1, help = 'number of threads')
+    parser.add_argument('-timeout',     '--timeout',        type = float, default = 600, help = 'seconds allowed per object in a parallel fit')
     parser.add_argument('-id_choose',   '--id_choose',         type = int, default = None, help = 'ID to fit')
     parser.add_argument('-pso',         '--pso',         type = int, default = 1, help = 'phot_scale_order')
     parser.add_argument('-PATH_TO_RAW'    , '--PATH_TO_RAW'    , default = '/user/rsimons/grizli_extractions/RAW', help = 'path to RAW directory')
@@ -275,47 +293,32 @@ def grizli_getfiles(run = True):
 
     os.chdir(PATH_TO_PREP)
     files = glob('%s/*flt.fits'%PATH_TO_RAW)
-    info = grizli.utils.get_flt_info(files)
+    info = flt_info(files, index_path = '%s/flt_index.db'%PATH_TO_RAW)
     visits, filters = grizli.utils.parse_flt_files(info=info, uniquename=True)
     return visits, filters
 
-def grizli_prep(visits, field = '', run = True):
+def grizli_prep(visits, field = '', run = True, n_jobs = 1):
     if run == False: return
     else: 'Running grizli_prep...'
 
     print ('\n\n\n\n\n\n\n')
-    product_names = np.array([visit['product'] for visit in visits])
-    filter_names = np.array([visit['product'].split('-')[-1] for visit in visits])
-    basenames = np.array([visit['product'].split('.')[0]+'.0' for visit in visits])
-    for ref_grism, ref_filter in [('G102', 'F105W'), ('G141', 'F140W')]:
-        print ('Processing %s + %s visits'%(ref_grism, ref_filter))
-        for v, visit in enumerate(visits):
-            product = product_names[v]
-            basename = basenames[v]
-            filt1 = filter_names[v]
-            #print (filt1.lower())
-            field_in_contest = basename.split('-')[0]
-
-            #print (field_in_contest)
-            #if field_in_contest.upper() == field.upper() or field_in_contest.upper() in overlapping_fields[field]:
-            if (ref_filter.lower() == filt1.lower()):
-                #found a direct image, now search for grism counterpart
-                if len(np.where((basenames == basename) & (filter_names == ref_grism.lower()))[0]) > 0:
-                    grism_index= np.where((basenames == basename) & (filter_names == ref_grism.lower()))[0][0]
-                    #print(grism_index)
-                    p = Pointing(field = field, ref_filter = ref_filter)
-                    radec_catalog = p.radec_catalog
-                    print (field_in_contest, visits[grism_index], radec_catalog)
-                    #radec_catalog = None
-                    status = process_direct_grism_visit(direct = visit,
-                                                        grism = visits[grism_index],
-                                                        radec = radec_catalog, 
-                                                        align_mag_limits = [14, 24])
-            else:
-                print ('no grism associated with direct image %s'%basename)
+    # One planning pass over the visits for both grisms; all the direct/grism pairs 
+    # then share one pool, each in its own scratch directory under PREP.
+    configs = [('G102', 'F105W'), ('G141', 'F140W')]
+    pairs = plan_pairs(visits, configs = configs)
+    radec_catalog = os.path.abspath(Pointing(field = field, ref_filter = 'F105W').radec_catalog)
+    print ('Processing %i %s visit pairs with %s'%(len(pairs), ' + '.join(['%s/%s'%c for c in configs]), radec_catalog))
+    # Each pair runs in a scratch directory below PREP, so the RAW FLTs are 
+    # found through an absolute path rather than relative to the working directory.
+    failed = prep_pairs(pairs, radec = radec_catalog, run_dir = '.', workers = n_jobs, 
+                        path_raw = os.path.abspath(PATH_TO_RAW), align_mag_limits = [14, 24])
+    for direct, grism, error in failed:
+        print ('Prep failed on %s + %s:\n%s'%(direct, grism, error))
+    if failed:
+        raise RuntimeError('process_direct_grism_visit failed on %s'%', '.join(['%s + %s'%(d, g) for d, g, error in failed]))
     return visits, filters
 
-def grizli_model(visits, field = '', ref_filter_1 = 'F105W', ref_grism_1 = 'G102', ref_filter_2 = 'F140W', ref_grism_2 = 'G141', run = True, new_model = False, mag_lim = 25):
+def grizli_model(visits, field = '', ref_filter_1 = 'F105W', ref_grism_1 = 'G102', ref_filter_2 = 'F140W', ref_grism_2 = 'G141', run = True, new_model = False, mag_lim = 25, adaptive = False):
     if run == False: return
 
     all_grism_files = []
@@ -337,29 +340,68 @@ def grizli_model(visits, field = '', ref_filter_1 = 'F105W', ref_grism_1 = 'G102
     p = Pointing(field=field, ref_filter=ref_filter_1)
 
 
-    if not new_model: print('Loading contamination models...')
-    else: print('Initializing contamination models...')
-    
-    grp = GroupFLT(
-        grism_files=all_grism_files, 
-        direct_files=[], 
-        ref_file = p.ref_image,
-        seg_file = p.seg_map,
-        catalog  = p.catalog,
-        pad=p.pad,
-        cpu_count=4)
-    
     if new_model:
-        print('Computing contamination models with flat model...')
-        grp.compute_full_model(mag_limit=25, cpu_count = 4)
-    
-        print('Refine continuum/contamination models with poly_order polynomial, subtracting off contamination..')
-        grp.refine_list(poly_order=2, mag_limits=[16, 24], verbose=False)
+        # Only FLTs that changed, or whose traces reach changed catalog 
+        # objects, need modeling again, unless models of the same inputs from 
+        # earlier runs are in the cache. All the FLTs are then refined together,
+        # from their cached models before refinement, unless this group was 
+        # already refined, here or in the cache.
+        manifest_path = field + '.model_manifest.json'
+        params = {'mag_limit':25}
+        refinement = {'refine':'adaptive' if adaptive else 'all', 'poly_order':2, 'mag_limits':[16, 24]}
+        stale, manifest = plan_models(all_grism_files, p.ref_image, p.seg_map, p.catalog, pad = p.pad, 
+                                      params = params, manifest_path = manifest_path, refinement = refinement)
+        refine = needs_refinement(all_grism_files, stale, manifest, manifest_path)
+        if refine and restore_models(all_grism_files, manifest, group = all_grism_files) == []:
+            manifest['refined'] = refined_digests(all_grism_files, manifest)
+            refine = False
+
+        if refine:
+            # Every FLT starts over from its model before refinement, not from one
+            # refined by an earlier run or another field; the misses are modeled again.
+            stale = restore_models(all_grism_files, manifest)
+            print('Initializing contamination models of %i of %i FLTs...'%(len(stale), len(all_grism_files)))
+            for flt in stale: remove_saved_models(flt)
+
+            if len(stale) > 0:
+                print('Computing contamination models with flat model...')
+                model_flts(stale, manifest, ref_file = p.ref_image, seg_file = p.seg_map, 
+                           catalog = p.catalog, pad = p.pad, mag_limit = 25, 
+                           history_path = field + '.model_times.json')
+                store_models(stale, manifest)
+
+            grp = GroupFLT(
+                grism_files=all_grism_files, 
+                direct_files=[], 
+                ref_file = p.ref_image,
+                seg_file = p.seg_map,
+                catalog  = p.catalog,
+                pad=p.pad,
+                cpu_count=model_workers(len(all_grism_files)))
+        
+            print('Refine continuum/contamination models with poly_order polynomial, subtracting off contamination..')
+            if adaptive:
+                # Only objects whose flat models leave high residuals, re-measured after each pass.
+                refine_adaptive(grp, poly_order=2, mag_limits=[16, 24], verbose=False)
+            else:
+                grp.refine_list(poly_order=2, mag_limits=[16, 24], verbose=False)
 
-        #poly_order = 3
+            #poly_order = 3
 
-        print('Saving contamination models')
-        grp.save_full_data()
+            print('Saving contamination models')
+            # Restored models may be links into the cache; not written through.
+            for flt in all_grism_files: remove_saved_models(flt)
+            grp.save_full_data()
+            del grp
+            store_models(all_grism_files, manifest, group = all_grism_files)
+            manifest['refined'] = refined_digests(all_grism_files, manifest)
+
+        save_manifest(manifest, manifest_path)
+
+    print('Loading contamination models (memory-mapped)...')
+    
+    grp = load_lazy_grp(all_grism_files, ref_file = p.ref_image, seg_file = p.seg_map, 
+                        catalog = p.catalog, pad = p.pad)
     
     return grp
    
@@ -375,20 +417,36 @@ def grizli_beams(grp, id, min_id, mag, field = '', mag_lim = 35, mag_lim_lower =
             #mb = grizli.multifit.MultiBeam(beams, fcontam=1.0, group_name=field)
             mb = grizli.multifit.MultiBeam(beams, fcontam=fcontam, group_name=field)
             mb.write_master_fits()            
+            return True
+    return False
+
+def grizli_beams_task(grp, task):
+    # Module level, so the processes of map_grp can import it.
+    id, mag, kwargs = task
+    return grizli_beams(grp, id = id, mag = mag, **kwargs)
 
 def grizli_fit(id, min_id, mag, field = '', mag_lim = 35, mag_lim_lower = 35, run = True, 
                id_choose = None, ref_filter = 'F105W', use_pz_prior = True, use_phot = True, 
                scale_phot = True, templ0 = None, templ1 = None, ep = None, pline = None, 
-               fcontam = 0.2, phot_scale_order = 1, use_psf = False, fit_without_phot = True, zr = [0., 12.]):
-    
-    if os.path.exists(field + '_' + '%.5i.full.fits'%id): return
+               fcontam = 0.2, phot_scale_order = 1, use_psf = False, fit_without_phot = True, zr = [0., 12.],
+               ledger = None):
+
+    if ledger is not None:
+        if ledger.is_finished(id): return
+    elif os.path.exists(field + '_' + '%.5i.full.fits'%id): return
 
     if (mag <= mag_lim) & (mag >=mag_lim_lower) & (id > min_id):
         if (id_choose is not None) & (id != id_choose):  return
         #if os.path.isfile(field + '_' + '%.5i.stack.fits'%id): return
         if os.path.isfile(field + '_' + '%.5i.beams.fits'%id):
+            def record(stage, start, note = ''):
+                if ledger is not None: ledger.record(id, stage, time.time() - start, note = note)
+
             print('Reading in beams.fits file for %.5i'%id)
+            start = time.time()
             mb = grizli.multifit.MultiBeam(field + '_' + '%.5i.beams.fits'%id, fcontam=fcontam, group_name=field)
+            record('beams', start)
+            start = time.time()
             wave = np.linspace(2000,2.5e4,100)
             try:
                 print ('creating poly_templates...')
@@ -396,9 +454,13 @@ def grizli_fit(id, min_id, mag, field = '', mag_lim = 35, mag_lim_lower = 35, ru
                 pfit = mb.template_at_z(z=0, templates=poly_templates, fit_background=True, fitter='lstsq', fwhm=1400, get_uncertainties=2)
             except: 
                 print ('exception in poly_templates...')
+                record('failed', start, note = 'exception in poly_templates')
                 return
             # Fit polynomial model for initial continuum subtraction
+            if pfit == None: record('failed', start, note = 'polynomial fit failed')
             if pfit != None:
+                record('polyfit', start)
+                start = time.time()
                 #try:
                 try:
                     print ('drizzle_grisms_and_PAs...')
@@ -409,8 +471,10 @@ def grizli_fit(id, min_id, mag, field = '', mag_lim = 35, mag_lim_lower = 35, ru
                     # Save drizzled ("stacked") 2D trace as PNG and FITS
                     fig.savefig('{0}_diff_{1:05d}.stack.png'.format(field, id))
                     hdu.writeto('{0}_diff_{1:05d}.stack.fits'.format(field, id), clobber=True)
+                    record('stack', start)
                 except:
                     pass
+                start = time.time()
 
                 if use_pz_prior:
                     #use redshift prior from z_phot
@@ -487,6 +551,8 @@ def grizli_fit(id, min_id, mag, field = '', mag_lim = 35, mag_lim_lower = 35, ru
                             scale_photometry=phot_scale_order, 
                             show_beams=True,
                             use_psf = use_psf)          #default: False
+                        if out is None: record('failed', start, note = 'run_all returned None')
+                        else: record('run_all', start)
 
 
             print('Finished', id, mag)
@@ -536,11 +602,18 @@ if __name__ == '__main__':
     model_bool          = args['do_model']
     on_jase             = args['on_jase']
     new_model           = args['do_new_model']
+    adaptive            = args['adaptive_refine']
     fit_bool            = args['do_fit']
     beams_bool          = args['do_beams']
     use_psf             = args['use_psf']
     fit_min_id          = args['fit_min_id']
     n_jobs              = args['n_jobs']
+    timeout             = args['timeout']
+    plan_only           = args['plan']
+    order               = args['order']
+    stream_bool         = args['stream']
+    extract_jobs        = args['extract_jobs']
+    queue_size          = args['queue_size']
     id_choose           = args['id_choose']
     phot_scale_order    = args['pso']
     fit_without_phot    = args['fwop']
@@ -578,11 +651,18 @@ if __name__ == '__main__':
     print('prep_bool        ', prep_bool        )
     print('model_bool       ', model_bool       )
     print('new_model        ', new_model        )
+    print('adaptive         ', adaptive         )
     print('beams_bool       ', beams_bool       )
     print('fit_bool         ', fit_bool         )
     print('use_psf          ', use_psf          )
     print('fit_min_id       ', fit_min_id       )
     print('n_jobs           ', n_jobs           )
+    print('timeout          ', timeout          )
+    print('plan_only        ', plan_only        )
+    print('order            ', order            )
+    print('stream_bool      ', stream_bool      )
+    print('extract_jobs     ', extract_jobs     )
+    print('queue_size       ', queue_size       )
     print('id_choose        ', id_choose        )
     print('phot_scale_order ', phot_scale_order )
     print('fit_without_phot ', fit_without_phot )
@@ -613,19 +693,22 @@ if __name__ == '__main__':
     visits, filters = grizli_getfiles(run = files_bool)
 
     if prep_bool:
-        grizli_prep(visits = visits, field = field, run = prep_bool)
+        grizli_prep(visits = visits, field = field, run = prep_bool, n_jobs = n_jobs)
 
     if new_model:
         grp = grizli_model(visits, field = field, ref_filter_1 = 'F105W', ref_grism_1 = 'G102', ref_filter_2 = 'F140W', ref_grism_2 = 'G141',
-                           run = model_bool, new_model = new_model, mag_lim = mag_lim)    
+                           run = model_bool, new_model = new_model, mag_lim = mag_lim, adaptive = adaptive)    
 
     if beams_bool:
         print ('making beams')
         grp = grizli_model(visits, field = field, ref_filter_1 = 'F105W', ref_grism_1 = 'G102', ref_filter_2 = 'F140W', ref_grism_2 = 'G141',
                            run = model_bool, new_model = False, mag_lim = mag_lim)
-        Parallel(n_jobs = n_jobs, backend = 'threading')(delayed(grizli_beams)(grp, id = id, min_id = fit_min_id, mag = mag, field = field, 
-                                                                               mag_lim = mag_lim, mag_lim_lower = mag_max)
-                                                                               for id, mag in zip(np.array(grp.catalog['NUMBER']), np.array(grp.catalog['MAG_AUTO'])))
+        # The FLT arrays go into shared memory once; each extraction process
+        # attaches to them instead of getting its own copy of the group.
+        beams_kwargs = dict(min_id = fit_min_id, field = field, mag_lim = mag_lim, mag_lim_lower = mag_max)
+        with SharedGroup(grp) as shared:
+            map_grp(shared, grizli_beams_task, [(id, mag, beams_kwargs) for id, mag in zip(np.array(grp.catalog['NUMBER']), np.array(grp.catalog['MAG_AUTO']))], 
+                    workers = n_jobs)
 
 
     if make_catalog:
@@ -641,14 +724,33 @@ if __name__ == '__main__':
         print ('Changing to %s'%PATH_TO_PREP)
         os.chdir(PATH_TO_PREP)
 
-        templ0 = grizli.utils.load_templates(fwhm=1200, line_complexes=True, stars=False, 
-                                             full_line_list=None,  continuum_list=None, 
-                                             fsps_templates=True)
+        # Resume and skip decisions come from the ledger; a field fit before
+        # it existed is seeded from its full.fits products once.
+        ledger = FitLedger(field + '.ledger')
+        if ledger.is_new: ledger.bootstrap(field)
+
+        cat_ = np.load('/user/rsimons/grizli_extractions/Catalogs/model_catalogs/%s_catalog.npy'%field)[()]
+        cat_nums = cat_[0].astype('int')
+        cat_mags = cat_[1]
+
+    if fit_bool and plan_only:
+        nums, mags = plan_fits(cat_nums, cat_mags, ledger = ledger, mag_lim = mag_lim, mag_min = mag_max, 
+                               min_id = fit_min_id, id_choose = id_choose, order = order)
+        print_plan(cat_nums, cat_mags, nums, mags, ledger = ledger, mag_lim = mag_lim, 
+                   workers = n_jobs if n_jobs > 0 else os.cpu_count() + 1 + n_jobs)
+
+    elif fit_bool:
+
+        templ0 = load_cached_templates(cache_dir = PATH_TO_CATS + '/template_cache', 
+                                       fwhm=1200, line_complexes=True, stars=False, 
+                                       full_line_list=None,  continuum_list=None, 
+                                       fsps_templates=True)
 
         # Load individual line templates for fitting the line fluxes
-        templ1 = grizli.utils.load_templates(fwhm=1200, line_complexes=False, stars=False, 
-                                             full_line_list=None, continuum_list=None, 
-                                             fsps_templates=True)
+        templ1 = load_cached_templates(cache_dir = PATH_TO_CATS + '/template_cache', 
+                                       fwhm=1200, line_complexes=False, stars=False, 
+                                       full_line_list=None, continuum_list=None, 
+                                       fsps_templates=True)
 
         #templ0, templ1 = grizli.utils.load_quasar_templates(uv_line_complex = False, broad_fwhm = 2800, 
         #                                                    narrow_fwhm = 1000, fixed_narrow_lines = True)
@@ -669,27 +771,51 @@ if __name__ == '__main__':
         else:
             ep = None
 
-        cat_ = np.load('/user/rsimons/grizli_extractions/Catalogs/model_catalogs/%s_catalog.npy'%field)[()]
-        nums = cat_[0]
-        mags = cat_[1]
-
-        if run_parallel:
-            Parallel(n_jobs = n_jobs, backend = 'threading')(delayed(grizli_fit)(id = id, min_id = fit_min_id, mag = mag, field = field, 
-                                                                                 mag_lim = mag_lim, mag_lim_lower = mag_max, run = fit_bool, 
-                                                                                 id_choose = id_choose, use_pz_prior = False, use_phot = True, 
-                                                                                 scale_phot = True, templ0 = templ0, templ1 = templ1, 
-                                                                                 ep = ep, pline = pline, phot_scale_order = phot_scale_order, use_psf = use_psf, fit_without_phot = fit_without_phot,
-                                                                                 zr = [args['zr_min'], args['zr_max']]) 
-                                                                                 for id, mag in zip(nums.astype('int'), mags))
-
-
-        for id, mag in zip(nums.astype('int'), mags):
-            grizli_fit(id = id, min_id = fit_min_id, mag = mag, field = field, 
-                       mag_lim = mag_lim, mag_lim_lower = mag_max, run = fit_bool, 
-                       id_choose = id_choose, use_pz_prior = False, use_phot = True, 
-                       scale_phot = True, templ0 = templ0, templ1 = templ1, 
-                       ep = ep, pline = pline, phot_scale_order = phot_scale_order, use_psf = use_psf, fit_without_phot = fit_without_phot,
-                       zr = [args['zr_min'], args['zr_max']])
+        nums, mags = plan_fits(cat_nums, cat_mags, ledger = ledger, mag_lim = mag_lim, mag_min = mag_max, 
+                               min_id = fit_min_id, id_choose = id_choose, order = order)
+
+        fit_kwargs = dict(min_id = fit_min_id, field = field, 
+                          mag_lim = mag_lim, mag_lim_lower = mag_max, run = fit_bool, 
+                          id_choose = id_choose, use_pz_prior = False, use_phot = True, 
+                          scale_phot = True, templ0 = templ0, templ1 = templ1, 
+                          ep = ep, pline = pline, phot_scale_order = phot_scale_order, use_psf = use_psf, fit_without_phot = fit_without_phot,
+                          zr = [args['zr_min'], args['zr_max']], ledger = ledger)
+
+        if stream_bool:
+            # Extraction processes, forked once with the group, write beams.fits
+            # while forked processes fit the ones already written; at most 
+            # queue_size ids are handed out ahead of the fits, and a hung 
+            # extraction is killed after timeout like a hung fit.
+            grp = grizli_model(visits, field = field, ref_filter_1 = 'F105W', ref_grism_1 = 'G102', ref_filter_2 = 'F140W', ref_grism_2 = 'G141',
+                               run = model_bool, new_model = False, mag_lim = mag_lim)
+            def extract_one(id_mag):
+                if os.path.isfile(field + '_' + '%.5i.beams.fits'%id_mag[0]): return True
+                return grizli_beams(grp, id = id_mag[0], min_id = fit_min_id, mag = id_mag[1], field = field, 
+                                    mag_lim = mag_lim, mag_lim_lower = mag_max)
+            fit_one = partial(grizli_fit, **fit_kwargs)
+            for (id, mag), stage, status, result in stream(extract_one, lambda id_mag: fit_one(id = id_mag[0], mag = id_mag[1]), 
+                                                           zip(nums.astype('int'), mags), extract_workers = extract_jobs, 
+                                                           fit_workers = n_jobs, queue_size = queue_size, timeout = timeout):
+                if status == 'skipped': ledger.record(id, 'failed', note = 'no beams')
+                if status not in ['done', 'skipped']:
+                    print ('%s %s on %i: %s'%(stage.upper(), status.upper(), id, result))
+                if status == 'failed': ledger.record(id, 'failed', note = result.strip().split('\n')[-1])
+                if status == 'timeout': ledger.record(id, 'timeout', elapsed = result)
+
+        elif run_parallel:
+            # Each object is fit in its own forked process, so a hung run_all
+            # can be killed without stopping the rest of the field.
+            fit_one = partial(grizli_fit, **fit_kwargs)
+            for (id, mag), status, result in supervise(lambda id_mag: fit_one(id = id_mag[0], mag = id_mag[1]), 
+                                                       zip(nums.astype('int'), mags), workers = n_jobs, timeout = timeout):
+                if status != 'done':
+                    print ('%s on %i: %s'%(status.upper(), id, result))
+                if status == 'failed': ledger.record(id, 'failed', note = result.strip().split('\n')[-1])
+                if status == 'timeout': ledger.record(id, 'timeout', elapsed = result)
+
+        else:
+            for id, mag in zip(nums.astype('int'), mags):
+                grizli_fit(id = id, mag = mag, **fit_kwargs)
 
 
 
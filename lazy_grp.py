@@ -0,0 +1,149 @@
+"""
+Lazy, memory-mapped loading of saved GroupFLTs.
+
+With the models already saved, building a GroupFLT still reads every
+<root>.01.GrismFLT.fits into memory: `GrismFLT.load_from_fits` copies each
+extension (`data*1`) before the first object can be extracted. For the fit
+step that is minutes of I/O and the whole field resident, while `get_beams`
+only ever slices a cutout around each object.
+
+`load_lazy_grp` builds the GroupFLT through grizli as usual, but with
+`load_from_fits` swapped for `load_from_fits_mmap`, which leaves every
+extension as a copy-on-write memory map of the saved file. Only the pages
+of the cutouts are read, and forked fit workers share them through the
+page cache.
+
+The swap is made only while the group is built (`mapped_loading`), and
+undone even if building fails, so GroupFLTs built afterwards load as 
+grizli does. Don't build other GroupFLTs from other threads meanwhile. The FLTs are loaded serially, by design: mapping a file 
+takes no time, and a pool of grizli workers would pickle the maps back to
+this process as full arrays.
+
+Use:
+
+    >>> grp = load_lazy_grp(grism_files, ref_file=ref_file, seg_file=seg_file,
+    ...     catalog=catalog, pad=200)
+
+"""
+
+import grizli.model
+import logging
+import numpy as np
+import threading
+import time
+
+from astropy.io import fits
+from collections import OrderedDict
+from contextlib import contextmanager
+from grizli.multifit import GroupFLT
+
+
+# Held while `GrismFLT.load_from_fits` is swapped.
+_swap_lock = threading.Lock()
+
+
+#-------------------------------------------------------------------------------
+
+def load_from_fits_mmap(self, save_file):
+    """ Stand-in for `GrismFLT.load_from_fits` that maps rather than reads.
+
+    Reads the extensions written by `GrismFLT.save_full_pickle`: 'SEG',
+    'MODEL', and the direct ('D...') and grism ('G...') image data. Each
+    is a `numpy.memmap` of its section of the file, which knows the file,
+    so `shared_grp.SharedGroup` can map it again in other processes rather
+    than copy it. Writes to the arrays stay private to the process.
+
+    Parameters
+    ----------
+    save_file : string
+        The <root>.<ext>.GrismFLT.fits.
+
+    Returns
+    -------
+    status : {True}
+
+    """
+    hdul = fits.open(save_file, memmap=True, mode='copyonwrite')
+
+    self.direct.data = OrderedDict()
+    self.grism.data = OrderedDict()
+    for hdu in hdul[1:]:
+        key = hdu.header['EXTNAME']
+        data = hdu.data
+        if data is not None:
+            data = np.memmap(save_file, dtype=data.dtype, mode='c', 
+                offset=hdu.fileinfo()['datLoc'], shape=data.shape)
+        if key == 'SEG':
+            self.seg = data
+        elif key == 'MODEL':
+            self.model = data
+        elif key.startswith('D'):
+            self.direct.data[key[1:]] = data
+        elif key.startswith('G'):
+            self.grism.data[key[1:]] = data
+
+    # The arrays keep their maps open after the file is closed.
+    hdul.close()
+
+    return True
+
+
+#-------------------------------------------------------------------------------
+
+@contextmanager
+def mapped_loading():
+    """ Swaps `GrismFLT.load_from_fits` for `load_from_fits_mmap` within
+    the block, and restores grizli's method on the way out, also on error.
+    One block runs at a time.
+    """
+    with _swap_lock:
+        original = grizli.model.GrismFLT.load_from_fits
+        grizli.model.GrismFLT.load_from_fits = load_from_fits_mmap
+        try:
+            yield
+        finally:
+            grizli.model.GrismFLT.load_from_fits = original
+
+
+#-------------------------------------------------------------------------------
+
+def load_lazy_grp(grism_files, ref_file=None, seg_file=None, catalog=None,
+    pad=200):
+    """ Builds a GroupFLT whose saved GrismFLTs are memory-mapped.
+
+    FLTs without a saved <root>.01.GrismFLT.fits/.pkl in the working
+    directory are built by grizli in full, as usual. All are loaded 
+    serially in this process (`cpu_count=-1`), by design; see the module
+    notes.
+
+    Parameters
+    ----------
+    grism_files : list of strings
+        The grism FLTs.
+    ref_file, seg_file, catalog : strings
+        The reference image, segmentation map and catalog, as for GroupFLT.
+    pad : int
+        The padding, as for GroupFLT.
+
+    Returns
+    -------
+    grp : grizli.multifit.GroupFLT
+
+    """
+    start = time.time()
+    with mapped_loading():
+        # Serially, in this process: a worker pool would pickle the maps
+        # back as full arrays.
+        grp = GroupFLT(
+            grism_files=grism_files,
+            direct_files=[],
+            ref_file=ref_file,
+            seg_file=seg_file,
+            catalog=catalog,
+            pad=pad,
+            cpu_count=-1)
+
+    logging.info("Mapped {} GrismFLTs in {:.1f} s".format(len(grism_files),
+        time.time() - start))
+
+    return grp
@@ -0,0 +1,226 @@
+"""
+Content-addressed cache of saved GrismFLT contamination models.
+
+Every pipeline run writes into a new time-stamped directory, so the
+<root>.01.GrismFLT.fits/.pkl saved by one run were invisible to the next
+unless pointed at with --modeldir. Here each FLT's saved model is also
+stored under a key hashing everything it was built from: the FLT itself,
+the reference image, segmentation map and catalog, the padding, the
+modeling parameters, the grizli version and the grism configuration files.
+`model()` restores hits into the working directory from any earlier run
+and only models the misses.
+
+The file digests are those of the model manifest (`model_deps`), so nothing
+is hashed twice. `refine_list` refines each object against all the FLTs of
+its field, so a model is cached twice: as modeled, keyed on the FLT's own
+inputs and shared by every field that includes the FLT; and as refined,
+keyed also on the refinement parameters and on the names and digests of
+all the FLTs refined with it (`group`). Refined models are restored for
+the whole group or not at all.
+
+Use:
+
+    >>> stale, manifest = plan_models(...)
+    >>> if restore_models(grism_files, manifest, group=grism_files) == []:
+    ...     ... done, the refined models are in place ...
+    >>> stale = restore_models(stale, manifest)
+    >>> ... model and save the remaining `stale` FLTs ...
+    >>> store_models(stale, manifest)
+    >>> ... refine all the `grism_files` and save them ...
+    >>> store_models(grism_files, manifest, group=grism_files)
+
+"""
+
+import grizli
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from model_deps import saved_models
+from set_paths import paths
+from staging import stage_files
+
+
+# Bump when the entry layout changes.
+CACHE_VERSION = 2
+
+
+#-------------------------------------------------------------------------------
+
+def _conf_sources():
+    """ Lists (relative path, size, mtime) of every file in the grizli CONF
+    directory, where the grism configurations and sensitivities live.
+    """
+    grizli_path = getattr(grizli, 'GRIZLI_PATH', None) or os.getenv('GRIZLI', '')
+    conf_dir = os.path.join(grizli_path, 'CONF')
+
+    sources = []
+    for root, dirs, files in os.walk(conf_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            sources.append([os.path.relpath(path, conf_dir),
+                stat.st_size, int(stat.st_mtime)])
+
+    return sources
+
+
+#-------------------------------------------------------------------------------
+
+def group_digest(group, manifest):
+    """ Returns the hex digest of a refinement group: the sorted names of
+    its FLTs and their digests in the manifest.
+    """
+    names = sorted(set([os.path.basename(flt) for flt in group]))
+    blob = json.dumps([[name, manifest['flts'][name]] for name in names])
+
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+
+#-------------------------------------------------------------------------------
+
+def model_key(flt_file, manifest, conf=None, group=None):
+    """ Returns the hex digest identifying the model of one FLT.
+
+    Parameters
+    ----------
+    flt_file : string
+        The grism FLT.
+    manifest : dict
+        From `model_deps.plan_models`, holding the input digests.
+    conf : list
+        From `_conf_sources`; computed if not given.
+    group : list of strings or None
+        The FLTs the model was refined with, including `flt_file`; None 
+        for the model as modeled, before refinement.
+
+    Returns
+    -------
+    key : string
+
+    """
+    if conf is None:
+        conf = _conf_sources()
+
+    desc = {'cache_version' : CACHE_VERSION,
+            'flt' : manifest['flts'][os.path.basename(flt_file)],
+            'inputs' : manifest['inputs'],
+            'catalog' : manifest['catalog'],
+            'conf' : conf}
+    if group is not None:
+        desc['group'] = group_digest(group, manifest)
+        desc['refinement'] = manifest['refinement']
+
+    return hashlib.sha1(json.dumps(desc, sort_keys=True, default=str)\
+        .encode('utf-8')).hexdigest()
+
+
+#-------------------------------------------------------------------------------
+
+def _entry(cache_dir, key):
+    """ Directory of the cache entry `key`.
+    """
+    return os.path.join(cache_dir, 'v{}'.format(CACHE_VERSION), key[:2], key)
+
+
+#-------------------------------------------------------------------------------
+
+def restore_models(stale, manifest, cache_dir=None, group=None):
+    """ Stages the cached models of the stale FLTs into the working
+    directory, by link where possible. A model re-saved later is first
+    removed by `model_deps.remove_saved_models`, so the entry isn't touched.
+
+    Parameters
+    ----------
+    stale : list of strings
+        The grism FLTs `model_deps.plan_models` found need modeling.
+    manifest : dict
+        From `model_deps.plan_models`.
+    cache_dir : string
+        Root of the cache. By default `paths['path_to_model_cache']`.
+    group : list of strings or None
+        To restore the models refined together with these FLTs, which then
+        are `stale`, only if all of them are cached; None for the models 
+        before refinement.
+
+    Returns
+    -------
+    missed : list of strings
+        The FLTs of `stale` that weren't in the cache and still need
+        modeling, or refining; all of them if any, with `group`.
+
+    """
+    if cache_dir is None:
+        cache_dir = paths['path_to_model_cache']
+
+    conf = _conf_sources()
+    entries = [(flt, _entry(cache_dir, model_key(flt, manifest, conf=conf,
+        group=group))) for flt in stale]
+    missed = [flt for flt, path in entries if not os.path.isdir(path)]
+    if group is not None and missed != []:
+        missed = list(stale)
+    for flt, path in entries:
+        if flt in missed:
+            continue
+        for old in saved_models(flt):
+            os.remove(old)
+        stage_files([os.path.join(path, name) for name in sorted(os.listdir(path))],
+            dest='.', readme=None)
+        logging.info("Restored the model of {} from {}".format(flt, path))
+
+    logging.info("Model cache{}: {} hits, {} misses".format(
+        '' if group is None else ' (refined)', len(stale) - len(missed), 
+        len(missed)))
+
+    return missed
+
+
+#-------------------------------------------------------------------------------
+
+def store_models(flts, manifest, cache_dir=None, group=None):
+    """ Adds the saved models of freshly modeled FLTs to the cache.
+
+    Each entry is built under a temporary name and renamed into place, so
+    concurrent runs never see a partial entry.
+
+    Parameters
+    ----------
+    flts : list of strings
+        The grism FLTs whose models were just saved in the working
+        directory by `save_full_data`.
+    manifest : dict
+        From `model_deps.plan_models`.
+    cache_dir : string
+        Root of the cache. By default `paths['path_to_model_cache']`.
+    group : list of strings or None
+        The FLTs the models were refined with; None for models saved before
+        refinement.
+
+    """
+    if cache_dir is None:
+        cache_dir = paths['path_to_model_cache']
+
+    conf = _conf_sources()
+    for flt in flts:
+        products = saved_models(flt)
+        path = _entry(cache_dir, model_key(flt, manifest, conf=conf, 
+            group=group))
+        if products == [] or os.path.isdir(path):
+            continue
+
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+        for product in products:
+            shutil.copy2(product, tmp)
+
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Someone else stored the same model first.
+            shutil.rmtree(tmp)
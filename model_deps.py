@@ -0,0 +1,371 @@
+"""
+Dependency tracking for incremental contamination modeling.
+
+`compute_full_model` and `refine_list` model every FLT of a field from its
+own exposure, the reference image, the segmentation map and the catalog.
+This module keeps a manifest of what each saved <root>.01.GrismFLT.fits /
+.pkl was built from, so a re-run only re-models the FLTs that need it:
+
+* every FLT, if the reference image, segmentation map, padding, modeling
+  parameters or grizli version changed, or there is no manifest yet;
+* an FLT whose file changed, or that has no saved GrismFLT;
+* an FLT whose dispersed traces can reach a catalog object that was added,
+  removed or changed since the last run.
+
+Everything else is reused as saved. Digests of large files are keyed on
+their size and mtime in the manifest, so unchanged mosaics aren't re-read.
+
+`refine_list` then refines each object against all the FLTs of the field,
+so the refinement is redone for the whole group (`needs_refinement`) if any
+FLT was re-modeled, the group or the refinement parameters changed, or a 
+saved model was rewritten since, e.g. by another field sharing the FLT. 
+The manifest records the digests of the saved models once refined.
+
+Use:
+
+    >>> stale, manifest = plan_models(grism_files, ref_file, seg_file,
+    ...     catalog, pad=200, params=MODEL_PARAMS,
+    ...     manifest_path='GN2.model_manifest.json')
+    >>> ... model the `stale` FLTs and save them ...
+    >>> if needs_refinement(grism_files, stale, manifest,
+    ...     'GN2.model_manifest.json'):
+    ...     ... refine them all and save them ...
+    ...     manifest['refined'] = refined_digests(grism_files, manifest)
+    >>> save_manifest(manifest, 'GN2.model_manifest.json')
+
+"""
+
+import glob
+import grizli
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+
+# Bump when the manifest layout or the staleness rules change.
+MANIFEST_VERSION = 2
+
+# Pixels a first-order G102/G141 trace (or the zeroth order) can reach from
+# its object's direct-image position, along the dispersion axis.
+TRACE_MARGIN = 300
+
+# Catalog columns for the object positions, in order of preference.
+RA_COLUMNS = ['X_WORLD', 'RA', 'ra']
+DEC_COLUMNS = ['Y_WORLD', 'DEC', 'dec']
+
+
+#-------------------------------------------------------------------------------
+
+def file_digest(path, cache=None):
+    """ Returns the sha1 hex digest of a file's contents.
+
+    Parameters
+    ----------
+    path : string
+        The file.
+    cache : dict
+        Keys of absolute paths; values of [size, mtime, digest]. A digest
+        recorded for the same size and mtime is reused, and new ones are
+        added.
+
+    Returns
+    -------
+    digest : string
+
+    """
+    key = os.path.abspath(path)
+    stat = os.stat(path)
+    if cache is not None and key in cache:
+        size, mtime, digest = cache[key]
+        if size == stat.st_size and mtime == stat.st_mtime:
+            return digest
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    if cache is not None:
+        cache[key] = [stat.st_size, stat.st_mtime, digest]
+
+    return digest
+
+
+#-------------------------------------------------------------------------------
+
+def catalog_rows(catalog):
+    """ Reads a catalog into per-object fingerprints.
+
+    Parameters
+    ----------
+    catalog : string
+        The SExtractor catalog given to GroupFLT.
+
+    Returns
+    -------
+    rows : dict
+        Keys of NUMBER (as strings, as in JSON); values of [digest of the
+        row, ra, dec].
+
+    """
+    cat = grizli.utils.GTable.gread(catalog)
+    ra_col = [c for c in RA_COLUMNS if c in cat.colnames][0]
+    dec_col = [c for c in DEC_COLUMNS if c in cat.colnames][0]
+
+    rows = {}
+    for row in cat:
+        digest = hashlib.sha1(repr(tuple(row)).encode('utf-8')).hexdigest()
+        rows[str(int(row['NUMBER']))] = [digest, float(row[ra_col]),
+            float(row[dec_col])]
+
+    return rows
+
+
+#-------------------------------------------------------------------------------
+
+def changed_objects(old_rows, new_rows):
+    """ Returns the (ra, dec) of every object added, removed or changed
+    between two `catalog_rows`, as an (N, 2) array.
+    """
+    radec = []
+    for id in set(old_rows) | set(new_rows):
+        old, new = old_rows.get(id), new_rows.get(id)
+        if old is not None and new is not None and old[0] == new[0]:
+            continue
+        for row in [old, new]:
+            if row is not None:
+                radec.append(row[1:])
+
+    return np.array(radec, dtype=float).reshape(-1, 2)
+
+
+#-------------------------------------------------------------------------------
+
+def flt_object_count(flt_file, radec, pad=200, margin=TRACE_MARGIN):
+    """ Counts the positions that may disperse onto the FLT.
+
+    The positions are projected with the FLT's WCS and kept if they fall
+    within the detector grown by `pad` (the GroupFLT padding) on every side
+    and by a further `margin` along the dispersion axis.
+
+    Parameters
+    ----------
+    flt_file : string
+        The grism FLT.
+    radec : array, shape (N, 2)
+        Positions in degrees.
+    pad : int
+        The padding of the GroupFLT, pixels.
+    margin : int
+        Reach of the traces along x, pixels.
+
+    """
+    if len(radec) == 0:
+        return 0
+
+    header = fits.getheader(flt_file, 'SCI', 1)
+    x, y = WCS(header, relax=True).all_world2pix(radec[:, 0], radec[:, 1], 0)
+    nx, ny = header['NAXIS1'], header['NAXIS2']
+    inside = (x > -pad - margin) & (x < nx + pad + margin) & \
+             (y > -pad) & (y < ny + pad)
+
+    return int(inside.sum())
+
+
+#-------------------------------------------------------------------------------
+
+def flt_overlaps(flt_file, radec, pad=200, margin=TRACE_MARGIN):
+    """ True if any of the positions may disperse onto the FLT; see
+    `flt_object_count`.
+    """
+    return flt_object_count(flt_file, radec, pad=pad, margin=margin) > 0
+
+
+#-------------------------------------------------------------------------------
+
+def saved_models(flt_file):
+    """ Lists the saved <root>.<ext>.GrismFLT.fits/.pkl of an FLT.
+    """
+    root = os.path.basename(flt_file).split('_flt')[0]
+    return sorted(glob.glob('{}.[0-9]*.GrismFLT.*'.format(root)))
+
+
+#-------------------------------------------------------------------------------
+
+def remove_saved_models(flt_file):
+    """ Deletes the saved models of an FLT, so GroupFLT builds it afresh.
+    """
+    for path in saved_models(flt_file):
+        logging.info("Removing stale model {}".format(path))
+        os.remove(path)
+
+
+#-------------------------------------------------------------------------------
+
+def load_manifest(path):
+    """ Returns the manifest at `path`, or None if missing or outdated.
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+#-------------------------------------------------------------------------------
+
+def save_manifest(manifest, path):
+    """ Writes the manifest from `plan_models`. Call once the stale FLTs
+    are modeled and saved.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+
+#-------------------------------------------------------------------------------
+
+def plan_models(grism_files, ref_file, seg_file, catalog, pad=200, params={},
+    manifest_path='model_manifest.json', refinement={}):
+    """ Decides which FLTs of a field must be re-modeled.
+
+    Parameters
+    ----------
+    grism_files : list of strings
+        The grism FLTs of the GroupFLT, in the working directory.
+    ref_file, seg_file, catalog : strings
+        The reference image, segmentation map and catalog of the GroupFLT.
+    pad : int
+        The padding of the GroupFLT.
+    params : dict
+        The modeling parameters (magnitude limits, polynomial order, ...).
+        Any change re-models everything.
+    manifest_path : string
+        The manifest of the last run.
+    refinement : dict
+        The refinement parameters. A change only re-refines, see 
+        `needs_refinement`.
+
+    Returns
+    -------
+    stale : list of strings
+        The grism FLTs to re-model, in the order of `grism_files`.
+    manifest : dict
+        The manifest describing the models once `stale` are re-modeled,
+        for `save_manifest`.
+
+    """
+    old = load_manifest(manifest_path)
+    digests = dict(old['digests']) if old is not None else {}
+
+    inputs = {'ref_file' : file_digest(ref_file, digests),
+              'seg_file' : file_digest(seg_file, digests),
+              'pad' : pad,
+              'params' : params,
+              'grizli_version' : getattr(grizli, '__version__', '')}
+    inputs = json.loads(json.dumps(inputs))
+    catalog_digest = file_digest(catalog, digests)
+    flts = {os.path.basename(f) : file_digest(f, digests) for f in grism_files}
+
+    if old is not None and old['catalog'] == catalog_digest:
+        rows = old['rows']
+    else:
+        rows = catalog_rows(catalog)
+
+    manifest = {'version' : MANIFEST_VERSION, 'inputs' : inputs,
+                'catalog' : catalog_digest, 'rows' : rows, 'flts' : flts,
+                'refinement' : json.loads(json.dumps(refinement)),
+                'refined' : old.get('refined', {}) if old is not None else {},
+                'digests' : digests}
+
+    if old is None:
+        logging.info("No model manifest at {}; modeling all {} FLTs"\
+            .format(manifest_path, len(grism_files)))
+        return list(grism_files), manifest
+    if old['inputs'] != inputs:
+        changed = [k for k in inputs if old['inputs'].get(k) != inputs[k]]
+        logging.info("Modeling inputs changed ({}); modeling all {} FLTs"\
+            .format(', '.join(changed), len(grism_files)))
+        return list(grism_files), manifest
+
+    radec = changed_objects(old['rows'], rows)
+    if len(radec):
+        logging.info("{} catalog objects changed since the last models"\
+            .format(len(radec)))
+
+    stale = []
+    for flt in grism_files:
+        name = os.path.basename(flt)
+        if old['flts'].get(name) != flts[name]:
+            reason = 'new or changed FLT'
+        elif saved_models(flt) == []:
+            reason = 'no saved model'
+        elif flt_overlaps(flt, radec, pad=pad):
+            reason = 'overlaps changed objects'
+        else:
+            continue
+        logging.info("Re-modeling {}: {}".format(name, reason))
+        stale.append(flt)
+
+    logging.info("Reusing the saved models of {} of {} FLTs"\
+        .format(len(grism_files) - len(stale), len(grism_files)))
+
+    return stale, manifest
+
+
+#-------------------------------------------------------------------------------
+
+def refined_digests(grism_files, manifest):
+    """ Returns the digests of the saved models of each FLT, keyed on its
+    name, for the manifest's 'refined' once the group is refined and saved.
+    """
+    return {os.path.basename(flt) : [file_digest(path, manifest['digests'])
+        for path in saved_models(flt)] for flt in grism_files}
+
+
+#-------------------------------------------------------------------------------
+
+def needs_refinement(grism_files, stale, manifest, manifest_path):
+    """ Decides whether the saved models of a field must be refined again.
+
+    Parameters
+    ----------
+    grism_files : list of strings
+        The grism FLTs of the field, refined together.
+    stale : list of strings
+        The FLTs re-modeled, from `plan_models`.
+    manifest : dict
+        From `plan_models`.
+    manifest_path : string
+        The manifest of the last run.
+
+    Returns
+    -------
+    refine : {True, False}
+
+    """
+    old = load_manifest(manifest_path)
+    if stale != []:
+        reason = '{} FLTs re-modeled'.format(len(stale))
+    elif old is None:
+        reason = 'no manifest'
+    elif sorted(old['flts']) != sorted(manifest['flts']):
+        reason = 'the FLTs changed'
+    elif old['refinement'] != manifest['refinement']:
+        reason = 'the refinement parameters changed'
+    elif old['refined'] != refined_digests(grism_files, manifest):
+        reason = 'saved models were rewritten since refined'
+    else:
+        return False
+
+    logging.info("Refining all {} FLTs: {}".format(len(grism_files), reason))
+    return True
@@ -0,0 +1,240 @@
+"""
+Core- and memory-aware scheduling of contamination modeling.
+
+`compute_full_model` disperses every catalog object onto each FLT, one FLT
+independent of the others, and used to run with a hard-coded `cpu_count`
+whatever the host or the field. Here each stale FLT is modeled in a forked
+worker of its own (see `fit_supervisor.supervise`) and saved:
+
+* the number of workers is the smallest of the cores, the FLTs to model,
+  and what the available memory holds at `memory_per_worker` each;
+* FLTs start in decreasing order of estimated cost (longest processing
+  time first), so the biggest ones don't start last and leave the other
+  cores idle at the end;
+* the cost of an FLT is its time from earlier runs, from a per-field
+  history file, or else the number of catalog objects that can disperse
+  onto it, scaled by the seconds per object seen so far;
+* each FLT's modeling time is logged and added to the history;
+* each FLT's GroupFLT reads cutouts of the reference image and the
+  segmentation map around its footprint (`ref_cutouts`), rather than the
+  full mosaics.
+
+`refine_list` couples the FLTs, so it still runs on the whole set after.
+
+Use:
+
+    >>> model_flts(stale, manifest, ref_file=ref_file, seg_file=seg_file,
+    ...     catalog=catalog, pad=200, mag_limit=26,
+    ...     history_path='GN2.model_times.json')
+
+"""
+
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os
+import time
+
+from fit_supervisor import supervise
+from grizli.multifit import GroupFLT
+from model_deps import flt_object_count
+from ref_cutouts import flt_cutouts
+
+
+# Resident memory assumed for one worker modeling one FLT, in bytes.
+MEMORY_PER_WORKER = 2.e9
+
+# Fraction of the available memory the workers may use together.
+MEMORY_FRACTION = 0.8
+
+
+#-------------------------------------------------------------------------------
+
+def available_memory():
+    """ Returns the memory available to new processes, in bytes.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+#-------------------------------------------------------------------------------
+
+def model_workers(n_flts, memory_per_worker=MEMORY_PER_WORKER, cores=None):
+    """ Returns how many FLTs to model at once.
+
+    Parameters
+    ----------
+    n_flts : int
+        The number of FLTs to model.
+    memory_per_worker : float
+        Bytes one worker needs.
+    cores : int
+        The cores to use. By default all of them.
+
+    Returns
+    -------
+    workers : int
+        At least 1.
+
+    """
+    if cores is None:
+        cores = multiprocessing.cpu_count()
+    by_memory = int(available_memory() * MEMORY_FRACTION // memory_per_worker)
+
+    return max(1, min(n_flts, cores, by_memory))
+
+
+#-------------------------------------------------------------------------------
+
+def load_history(path):
+    """ Returns {FLT name : [seconds, number of objects]} from earlier runs.
+    """
+    if path is None or not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+#-------------------------------------------------------------------------------
+
+def estimate_costs(grism_files, manifest, pad=200, history={}):
+    """ Estimates the modeling seconds of each FLT.
+
+    Parameters
+    ----------
+    grism_files : list of strings
+        The FLTs to model.
+    manifest : dict
+        From `model_deps.plan_models`, for the catalog positions.
+    pad : int
+        The padding of the GroupFLT.
+    history : dict
+        From `load_history`.
+
+    Returns
+    -------
+    costs : array
+        Seconds for each FLT.
+    n_objects : array
+        The number of catalog objects that can disperse onto each FLT.
+
+    """
+    radec = np.array([row[1:] for row in manifest['rows'].values()],
+        dtype=float).reshape(-1, 2)
+    n_objects = np.array([flt_object_count(flt, radec, pad=pad)
+        for flt in grism_files])
+
+    # Seconds per object from the history, or 1 if there is none.
+    rates = [seconds / n for seconds, n in history.values() if n > 0]
+    rate = np.median(rates) if rates else 1.
+
+    costs = n_objects * rate
+    for i, flt in enumerate(grism_files):
+        if os.path.basename(flt) in history:
+            costs[i] = history[os.path.basename(flt)][0]
+
+    return costs, n_objects
+
+
+#-------------------------------------------------------------------------------
+
+def model_flts(grism_files, manifest, ref_file=None, seg_file=None,
+    catalog=None, pad=200, mag_limit=26, workers=None,
+    memory_per_worker=MEMORY_PER_WORKER, history_path=None, cutouts=True):
+    """ Computes and saves the contamination models of FLTs, each in its
+    own worker, largest first.
+
+    Parameters
+    ----------
+    grism_files : list of strings
+        The FLTs to model, with no saved models in the working directory.
+    manifest : dict
+        From `model_deps.plan_models`.
+    ref_file, seg_file, catalog : strings
+        The reference image, segmentation map and catalog, as for GroupFLT.
+    pad : int
+        The padding, as for GroupFLT.
+    mag_limit : float
+        Passed to `compute_full_model`.
+    workers : int
+        FLTs modeled at once. By default from `model_workers`.
+    memory_per_worker : float
+        Bytes one worker needs, to cap `workers` by the available memory.
+    history_path : string
+        JSON file of per-FLT modeling times, read for the estimates and
+        updated with this run's.
+    cutouts : {True, False}
+        Model each FLT from cutouts of `ref_file` and `seg_file` around
+        it, held in memory, rather than from the full images.
+
+    Returns
+    -------
+    workers : int
+        The number of workers used, e.g. to load the models back with.
+
+    """
+    if grism_files == []:
+        return 1
+
+    history = load_history(history_path)
+    costs, n_objects = estimate_costs(grism_files, manifest, pad=pad,
+        history=history)
+    order = np.argsort(-costs, kind='stable')
+    tasks = [grism_files[i] for i in order]
+
+    if workers is None:
+        workers = model_workers(len(tasks), memory_per_worker=memory_per_worker)
+    logging.info("Modeling {} FLTs on {} workers, est. {:.0f} s of CPU"\
+        .format(len(tasks), workers, costs.sum()))
+
+    def model_one(flt):
+        start = time.time()
+        ref, seg = ref_file, seg_file
+        if cutouts:
+            # Only the part of the mosaics the padded FLT covers.
+            ref, seg = flt_cutouts(flt, [ref_file, seg_file], pad=pad)
+        grp = GroupFLT(
+            grism_files=[flt],
+            direct_files=[],
+            ref_file=ref,
+            seg_file=seg,
+            catalog=catalog,
+            pad=pad,
+            cpu_count=-1)
+        grp.compute_full_model(mag_limit=mag_limit, cpu_count=1)
+        grp.save_full_data()
+        return time.time() - start
+
+    start = time.time()
+    failed = []
+    for flt, status, result in supervise(model_one, tasks, workers=workers):
+        if status == 'done':
+            logging.info("Modeled {} in {:.1f} s".format(flt, result))
+            i = grism_files.index(flt)
+            history[os.path.basename(flt)] = [result, int(n_objects[i])]
+        else:
+            logging.info("Modeling {} {}:\n{}".format(flt, status, result))
+            failed.append(flt)
+
+    # One more try in this process, so a real error surfaces here.
+    for flt in failed:
+        elapsed = model_one(flt)
+        logging.info("Modeled {} in {:.1f} s".format(flt, elapsed))
+
+    logging.info("Modeled {} FLTs in {:.1f} s".format(len(tasks),
+        time.time() - start))
+
+    if history_path is not None:
+        if not os.path.isdir(os.path.dirname(os.path.abspath(history_path))):
+            os.makedirs(os.path.dirname(os.path.abspath(history_path)))
+        with open(history_path, 'w') as f:
+            json.dump(history, f)
+
+    return workers
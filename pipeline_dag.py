@@ -0,0 +1,313 @@
+"""
+Make-style runner of the pipeline stages as a graph of tasks.
+
+Each task declares the files it reads and the files it writes, and the
+tasks it must wait for. Whether a task is up to date is judged by content
+rather than by the steps the user asked for:
+
+* its fingerprint, the sha1 of the digests of its input files, its
+  parameters and its name, must be the one recorded when it last
+  succeeded;
+* every output it declared must still exist with the digest recorded then.
+
+Up-to-date tasks are skipped; the others run as soon as the tasks they wait
+for are done or up to date, up to `jobs` at once, each in a forked child
+(`fit_supervisor.supervise`), so independent branches, e.g. the visit pairs
+of prep or the fields of fit, proceed in parallel. Children are not
+daemonic, so a task may start its own pool of workers. Tasks that name the
+same `resource` never run at the same time.
+
+The fingerprints and output digests are written to the state file after
+every task, atomically, so after a crash a re-run skips what finished and
+re-runs only what was interrupted or downstream of a change. Digests are
+keyed on size and mtime in the state file, so unchanged files aren't read
+again. A task with no declared outputs (None) always runs.
+
+Use:
+
+    >>> tasks = [Task('prep', prep_func, inputs=raw_files, outputs=flt_files),
+    ...          Task('model', model_func, inputs=flt_files,
+    ...               outputs=model_files, deps=['prep'])]
+    >>> status = run_dag(tasks, state_path='dag_state.json', jobs=4)
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+from collections import OrderedDict
+from fit_supervisor import PENDING, supervise
+from model_deps import file_digest
+
+
+# Bump when the state layout or the fingerprint changes.
+STATE_VERSION = 1
+
+# Statuses of tasks that let the tasks waiting for them go on.
+OK_STATUSES = ['done', 'up to date']
+
+# Seconds the task source waits for a running task before yielding PENDING.
+WAIT = 0.2
+
+
+#-------------------------------------------------------------------------------
+
+class Task():
+    """ One node of the graph.
+
+    Parameters
+    ----------
+    name : string
+        Unique; names the task in the state file and in `deps`.
+    func : callable
+        Called as `func(*args, **kwargs)` in a forked child. Its return
+        value is discarded; it communicates through its outputs.
+    args : tuple
+        Positional arguments of `func`.
+    kwargs : dict
+        Keyword arguments of `func`.
+    inputs : list of strings
+        Files read. Those written by other tasks must exist once the tasks
+        in `deps` are done.
+    outputs : list of strings or None
+        Files written. None for a task that always runs.
+    deps : list of strings
+        Names of the tasks to wait for.
+    params : dict or None
+        What, besides the inputs, decides the outputs; it enters the
+        fingerprint. By default `kwargs`.
+    resource : string or None
+        Tasks naming the same resource never run at the same time, e.g.
+        because they write the same files.
+
+    """
+    def __init__(self, name, func, args=(), kwargs={}, inputs=[],
+        outputs=None, deps=[], params=None, resource=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.inputs = list(inputs)
+        self.outputs = None if outputs is None else list(outputs)
+        self.deps = list(deps)
+        self.params = kwargs if params is None else params
+        self.resource = resource
+
+    def __repr__(self):
+        return 'Task({})'.format(self.name)
+
+
+#-------------------------------------------------------------------------------
+
+def load_state(path):
+    """ Returns the state file at `path`, or an empty state if missing or
+    outdated.
+    """
+    if os.path.isfile(path):
+        with open(path) as f:
+            state = json.load(f)
+        if state.get('version') == STATE_VERSION:
+            return state
+    return {'version':STATE_VERSION, 'tasks':{}, 'digests':{}}
+
+
+#-------------------------------------------------------------------------------
+
+def save_state(state, path):
+    """ Writes the state file, replacing the old one whole.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+#-------------------------------------------------------------------------------
+
+def fingerprint(task, digests):
+    """ Returns the fingerprint of a task's inputs and parameters.
+
+    Parameters
+    ----------
+    task : Task
+        Its inputs must exist.
+    digests : dict
+        Cache of file digests; see `model_deps.file_digest`.
+
+    Returns
+    -------
+    fingerprint : string
+
+    """
+    inputs = [[path, file_digest(path, cache=digests)]
+        for path in sorted(set(task.inputs))]
+    blob = json.dumps([task.name, inputs, task.params], sort_keys=True,
+        default=str)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+
+#-------------------------------------------------------------------------------
+
+def is_up_to_date(task, record, fp, digests):
+    """ Whether `task`, of fingerprint `fp`, may be skipped given its
+    `record` in the state file.
+    """
+    if task.outputs is None or record is None or record['fingerprint'] != fp:
+        return False
+    for path in task.outputs:
+        if not os.path.isfile(path) or \
+            file_digest(path, cache=digests) != record['outputs'].get(path):
+            return False
+    return True
+
+
+#-------------------------------------------------------------------------------
+
+def check_graph(tasks):
+    """ Raises ValueError if task names repeat, a dependency is unknown, or
+    the dependencies form a cycle.
+    """
+    by_name = OrderedDict()
+    for task in tasks:
+        if task.name in by_name:
+            raise ValueError("Task {} is defined twice".format(task.name))
+        by_name[task.name] = task
+    for task in tasks:
+        for dep in task.deps:
+            if dep not in by_name:
+                raise ValueError("Task {} depends on unknown task {}"\
+                    .format(task.name, dep))
+
+    # Kahn's algorithm; whatever is never freed is on a cycle.
+    waiting = {task.name:len(set(task.deps)) for task in tasks}
+    dependents = {name:[] for name in by_name}
+    for task in tasks:
+        for dep in set(task.deps):
+            dependents[dep].append(task.name)
+    free = [name for name in waiting if waiting[name] == 0]
+    while free:
+        for name in dependents[free.pop()]:
+            waiting[name] -= 1
+            if waiting[name] == 0:
+                free.append(name)
+    cycle = [name for name in waiting if waiting[name] > 0]
+    if cycle:
+        raise ValueError("Tasks {} depend on each other".format(', '.join(cycle)))
+
+
+#-------------------------------------------------------------------------------
+
+def _run_task(task):
+    """ `supervise` task. Runs the task's function.
+    """
+    task.func(*task.args, **task.kwargs)
+
+
+#-------------------------------------------------------------------------------
+
+def run_dag(tasks, state_path='dag_state.json', jobs=1):
+    """ Runs the tasks that aren't up to date, in dependency order.
+
+    Parameters
+    ----------
+    tasks : list of Tasks
+        Ready tasks are started in the order of this list.
+    state_path : string
+        The state file, created if missing.
+    jobs : int
+        Tasks running at once. Values <= 0 count back from the number of
+        cores, as for joblib.
+
+    Returns
+    -------
+    status : OrderedDict
+        Keys of the task names; values of 'done', 'up to date', 'failed'
+        (the task raised, its child died, an input was missing or an output
+        wasn't written) or 'blocked' (a task it waits for didn't succeed).
+
+    """
+    check_graph(tasks)
+    state = load_state(state_path)
+    digests = state['digests']
+    status = OrderedDict([(task.name, None) for task in tasks])
+    running = {}
+    held = set()
+
+    def finish(task, result, note=''):
+        status[task.name] = result
+        logging.info("Task {}: {}{}".format(task.name, result, note))
+
+    def source():
+        # Yields the tasks whose dependencies are met, checking each
+        # against the state file first; PENDING while only running tasks
+        # can free more.
+        while None in status.values():
+            started = False
+            for task in tasks:
+                if status[task.name] is not None or task.name in running \
+                    or task.resource in held:
+                    continue
+                deps = [status[dep] for dep in task.deps]
+                if None in deps:
+                    continue
+                if any([s not in OK_STATUSES for s in deps]):
+                    finish(task, 'blocked')
+                    continue
+
+                missing = [path for path in task.inputs
+                    if not os.path.isfile(path)]
+                if missing:
+                    finish(task, 'failed', ', missing {}'.format(
+                        ', '.join(missing)))
+                    continue
+                fp = fingerprint(task, digests)
+                if is_up_to_date(task, state['tasks'].get(task.name), fp,
+                    digests):
+                    finish(task, 'up to date')
+                    continue
+
+                logging.info("Task {}: starting".format(task.name))
+                running[task.name] = (fp, time.time())
+                if task.resource is not None:
+                    held.add(task.resource)
+                started = True
+                yield task
+            if not started and running:
+                time.sleep(WAIT)
+                yield PENDING
+
+    for task, result, error in supervise(_run_task, source(), workers=jobs):
+        fp, start = running.pop(task.name)
+        held.discard(task.resource)
+        elapsed = time.time() - start
+        if result != 'done':
+            finish(task, 'failed', ' after {:.0f} s:\n{}'.format(elapsed, error))
+            continue
+
+        outputs = task.outputs or []
+        missing = [path for path in outputs if not os.path.isfile(path)]
+        if missing:
+            finish(task, 'failed', ', did not write {}'.format(
+                ', '.join(missing)))
+            continue
+
+        if task.outputs is not None:
+            state['tasks'][task.name] = {'fingerprint':fp, 'elapsed':elapsed,
+                'outputs':{path:file_digest(path, cache=digests)
+                    for path in outputs}}
+            save_state(state, state_path)
+        finish(task, 'done', ' in {:.0f} s'.format(elapsed))
+
+    # The digests of skipped tasks' files may be new too.
+    save_state(state, state_path)
+
+    counts = OrderedDict()
+    for result in status.values():
+        counts[result] = counts.get(result, 0) + 1
+    logging.info("Tasks: {}".format(', '.join(['{} {}'.format(n, result)
+        for result, n in counts.items()])))
+
+    return status
@@ -0,0 +1,45 @@
+"""
+Reference products of each CLEAR pointing.
+
+`Pointing` names the reference image, segmentation map, catalogs and the
+GroupFLT padding of a field. It lives apart from the pipeline so that 
+tools needing only the names, e.g. `synthetic_field`, don't import grizli.
+
+Use:
+
+    >>> p = Pointing(field='GN2', ref_filter='F105W')
+    >>> p.ref_image, p.seg_map, p.catalog, p.pad
+
+"""
+
+
+#-------------------------------------------------------------------------------
+
+class Pointing():
+    """ Generalization of GN1, GS1, ERSPRIME, etc
+
+    To change field-dependent catalog, seg map, ref image, and padding
+    only need to change them here.
+    """
+    def __init__(self, field, ref_filter):
+        if 'N' in field.upper():
+            self.pad = 500 # really only necessary for GDN
+            self.radec_catalog = 'goodsn_radec.cat'
+            self.seg_map = 'Goods_N_plus_seg.fits'
+            if '125' in ref_filter:
+                self.catalog = 'GoodsN_plus_merged.cat'
+                self.ref_image = 'goodsn_3dhst.v4.0.F125W_orig_sci.fits'
+            elif '105' in ref_filter:
+                self.catalog = 'goodsn-F105W-astrodrizzle-v4.4_drz_sub_plus.cat'
+                self.ref_image = 'goodsn-F105W-astrodrizzle-v4.4_drz_sci.fits'
+                
+        elif 'S' in field.upper():
+            self.pad = 200 # grizli default
+            self.radec_catalog = 'goodss_3dhst.v4.1.radec.cat'
+            self.seg_map = 'Goods_S_plus_seg.fits'
+            if '125' in ref_filter:
+                self.catalog = 'GoodsS_plus_merged.cat'
+                self.ref_image = 'goodss_3dhst.v4.0.F125W_orig_sci.fits'  
+            elif '105' in ref_filter:
+                self.catalog = 'goodss-F105W-astrodrizzle-v4.3_drz_sub_plus.cat'
+                self.ref_image = 'goodss-F105W-astrodrizzle-v4.3_drz_sci.fits'
@@ -0,0 +1,160 @@
+"""
+Batched polynomial continuum prefit for many MultiBeams.
+
+Before drizzling, every object gets a 7th-order polynomial continuum fit,
+`mb.template_at_z(z=0, templates=poly_templates, fitter='lstsq', ...)`,
+which rebuilds the same polynomial basis and solves a small least-squares
+problem per object. Here the basis is built once per process, each
+object's weighted design matrix is projected through its beams, and the
+normal equations of a whole chunk of objects are solved in one batched
+`np.linalg.solve`.
+
+The returned dicts carry the keys of `template_at_z` that
+`drizzle_grisms_and_PAs(zfit=...)` and later steps use: 'cont1d', 'line1d',
+'cfit', 'coeffs', 'covar', 'chi2', 'z' and 'templates'.
+
+Use:
+
+    >>> pfits = batch_prefit([mb1, mb2, mb3])
+
+"""
+
+import grizli
+import logging
+import numpy as np
+
+from collections import OrderedDict
+
+
+POLY_WAVE = np.linspace(2000, 2.5e4, 100)
+POLY_ORDER = 7
+
+_poly_templates = {}
+
+
+#-------------------------------------------------------------------------------
+
+def poly_templates(order=POLY_ORDER):
+    """ Returns the polynomial continuum basis, built once per process.
+    """
+    if order not in _poly_templates:
+        _poly_templates[order] = grizli.utils.polynomial_templates(
+            wave=POLY_WAVE, order=order, line=False)
+    return _poly_templates[order]
+
+
+#-------------------------------------------------------------------------------
+
+def _design_matrix(mb, templates):
+    """ Weighted design matrix and data of one MultiBeam.
+
+    Columns are one background per beam followed by each template
+    dispersed through every beam, restricted to the fit mask and weighted
+    by the inverse error.
+    """
+    mask = mb.fit_mask
+    weight = mb.sivarf[mask]
+
+    columns = [bg[mask] for bg in mb.A_bg]
+    for key in templates:
+        t = templates[key]
+        model = np.hstack([beam.compute_model(spectrum_1d=[t.wave, t.flux],
+            in_place=False, is_cgs=True).flatten() for beam in mb.beams])
+        columns.append(model[mask])
+
+    A = np.array(columns).T * weight[:, None]
+    y = mb.scif[mask] * weight
+
+    return A, y
+
+
+#-------------------------------------------------------------------------------
+
+def _pfit_dict(mb, templates, coeffs, covar, chi2):
+    """ Packs a solution into the dict `template_at_z` returns.
+    """
+    coeffs_err = np.sqrt(np.maximum(np.diag(covar), 0))
+    cont1d, line1d = grizli.utils.dot_templates(coeffs[mb.N:], templates, z=0)
+
+    cfit = OrderedDict()
+    for i in range(mb.N):
+        cfit['bg {0:03d}'.format(i)] = coeffs[i], coeffs_err[i]
+    for j, key in enumerate(templates):
+        cfit[key] = coeffs[mb.N+j], coeffs_err[mb.N+j]
+
+    return {'cont1d':cont1d, 'line1d':line1d, 'cfit':cfit, 'coeffs':coeffs,
+            'covar':covar, 'chi2':chi2, 'z':0., 'templates':templates}
+
+
+#-------------------------------------------------------------------------------
+
+def batch_prefit(mbs, templates=None):
+    """ Polynomial continuum fit of a chunk of MultiBeams in one solve.
+
+    Parameters
+    ----------
+    mbs : list of grizli.multifit.MultiBeam
+        The objects of the chunk.
+    templates : OrderedDict
+        The continuum basis. By default `poly_templates()`.
+
+    Returns
+    -------
+    pfits : list of dicts
+        One per MultiBeam, as from `mb.template_at_z(z=0, ..., fitter='lstsq',
+        get_uncertainties=2)`. Objects whose design matrix can't be built
+        are fit with `template_at_z` itself, so an entry may be None where
+        that fails too.
+
+    """
+    if templates is None:
+        templates = poly_templates()
+
+    systems = []
+    for mb in mbs:
+        try:
+            systems.append(_design_matrix(mb, templates))
+        except Exception as err:
+            logging.info("Batched prefit fell back for {}: {}".format(mb.id, err))
+            systems.append(None)
+
+    # Normal equations of every object, padded to the largest number of
+    # columns with an identity block so the stack is square and solvable.
+    ok = [i for i, s in enumerate(systems) if s is not None]
+    pfits = [None]*len(mbs)
+    if ok:
+        kmax = max(systems[i][0].shape[1] for i in ok)
+        AtA = np.tile(np.eye(kmax), (len(ok), 1, 1))
+        Aty = np.zeros((len(ok), kmax))
+        for j, i in enumerate(ok):
+            A, y = systems[i]
+            k = A.shape[1]
+            # Scale columns to unit norm to keep the system well conditioned.
+            norm = np.sqrt((A**2).sum(axis=0))
+            norm[norm == 0] = 1.
+            An = A / norm
+            AtA[j, :k, :k] = An.T.dot(An)
+            Aty[j, :k] = An.T.dot(y)
+            systems[i] = A, y, norm
+
+        try:
+            covar_n = np.linalg.inv(AtA)
+        except np.linalg.LinAlgError:
+            covar_n = np.array([np.linalg.pinv(m) for m in AtA])
+        sol_n = np.einsum('ijk,ik->ij', covar_n, Aty)
+
+        for j, i in enumerate(ok):
+            A, y, norm = systems[i]
+            k = A.shape[1]
+            coeffs = sol_n[j, :k] / norm
+            covar = covar_n[j, :k, :k] / np.outer(norm, norm)
+            chi2 = ((y - A.dot(coeffs))**2).sum()
+            pfits[i] = _pfit_dict(mbs[i], templates, coeffs, covar, chi2)
+
+    for i, mb in enumerate(mbs):
+        if pfits[i] is None:
+            pfits[i] = mb.template_at_z(z=0, templates=templates,
+                fit_background=True, fitter='lstsq', fwhm=1400,
+                get_uncertainties=2)
+
+    return pfits
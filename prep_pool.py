@@ -0,0 +1,253 @@
+"""
+Parallel pre-processing of direct/grism visit pairs.
+
+`process_direct_grism_visit` aligns, background-subtracts and drizzles one
+direct visit and its grism visit, independently of every other pair, yet
+the pairs used to be found with a nested loop over the visits and run one
+after the other. Here:
+
+* the pairs are matched through a dictionary of the visits keyed on
+  (basename, filter) of their product names;
+* the pairs of each direct visit run one after the other in a forked 
+  child of their own (`fit_supervisor.supervise`), as each pair modifies 
+  that visit's FLTs; a group that kills its process (segfault, OOM) is
+  reported failed like a pair that raised;
+* each pair runs in a scratch directory of its own under the run 
+  directory, so the logs and temporary files of concurrent pairs never
+  collide; FLTs of the pair already in the run directory are staged into
+  it by copy (or reflink), as they are modified in place;
+* once a pair succeeds, everything it wrote is moved back into the run
+  directory with `os.replace`, each file appearing whole or not at all.
+  The scratch directory of a failed pair is left for inspection.
+
+Use:
+
+    >>> pairs = match_visits(visits, ref_filter='F105W', ref_grism='G102')
+
+    or, for both grisms at once,
+
+    >>> pairs = plan_pairs(visits, [('G102', 'F105W'), ('G141', 'F140W')])
+
+    >>> failed = prep_pairs(pairs, radec=radec_catalogs, workers=4,
+    ...     path_raw=PATH_RAW)
+
+"""
+
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import traceback
+
+from collections import OrderedDict
+from fit_supervisor import supervise
+from staging import stage_files
+
+
+#-------------------------------------------------------------------------------
+
+def product_key(product):
+    """ Splits a product name, e.g. 'gn2-cxt-51-345.0-f105w', into its
+    basename ('gn2-cxt-51-345') and filter ('f105w').
+    """
+    return product.split('.')[0], product.split('-')[-1].lower()
+
+
+#-------------------------------------------------------------------------------
+
+def plan_pairs(visits, configs=[('G102', 'F105W')]):
+    """ Pairs each direct visit with the grism visits of the same basename,
+    for every grism configuration, in one pass over the visits.
+
+    Parameters
+    ----------
+    visits : list of dicts
+        From `grizli.utils.parse_flt_files`, with keys of 'files' and
+        'product'.
+    configs : list of tuples
+        (grism, direct filter), e.g. [('G102', 'F105W'), ('G141', 'F140W')].
+
+    Returns
+    -------
+    pairs : list of tuples
+        (direct visit, grism visit), by configuration and then in the
+        order of the direct visits.
+
+    """
+    # Visits by (basename, filter), and the direct ones by filter.
+    by_key, by_filter = {}, {}
+    for visit in visits:
+        basename, filt = product_key(visit['product'])
+        by_key.setdefault((basename, filt), []).append(visit)
+        by_filter.setdefault(filt, []).append((basename, visit))
+
+    pairs = []
+    for ref_grism, ref_filter in configs:
+        for basename, visit in by_filter.get(ref_filter.lower(), []):
+            grisms = by_key.get((basename, ref_grism.lower()), [])
+            if grisms == []:
+                logging.info("No {} visit associated with direct image {}"\
+                    .format(ref_grism, visit['product']))
+            for grism in grisms:
+                logging.info("Matched direct to grism products: {} {}"\
+                    .format(visit['product'], grism['product']))
+                pairs.append((visit, grism))
+
+    return pairs
+
+
+#-------------------------------------------------------------------------------
+
+def match_visits(visits, ref_filter='F105W', ref_grism='G102'):
+    """ Pairs each direct visit of `ref_filter` with the `ref_grism` visits
+    of the same basename; see `plan_pairs`.
+    """
+    return plan_pairs(visits, configs=[(ref_grism, ref_filter)])
+
+
+#-------------------------------------------------------------------------------
+
+def process_pair(direct, grism, radec, run_dir='.', **kwargs):
+    """ Runs `process_direct_grism_visit` on one pair in a scratch
+    directory, and moves its products into `run_dir`.
+
+    Parameters
+    ----------
+    direct, grism : dicts
+        The visits.
+    radec : string
+        The alignment catalog.
+    run_dir : string
+        Where the products go.
+    kwargs : dict
+        Passed to `process_direct_grism_visit`, e.g. path_raw and
+        align_mag_limits.
+
+    Returns
+    -------
+    status :
+        What `process_direct_grism_visit` returned.
+    products : list of strings
+        The files moved into `run_dir`.
+
+    """
+    from grizli.prep import process_direct_grism_visit
+
+    run_dir = os.path.abspath(run_dir)
+    scratch = tempfile.mkdtemp(dir=run_dir,
+        prefix='.prep_{}_'.format(direct['product']))
+
+    # FLTs earlier steps left in the run directory, modified in place.
+    present = [os.path.join(run_dir, os.path.basename(f))
+        for f in direct['files'] + grism['files']]
+    present = [f for f in present if os.path.isfile(f)]
+    if present:
+        stage_files(present, dest=scratch, mutable=True, readme=None)
+
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    try:
+        status = process_direct_grism_visit(direct=direct, grism=grism,
+            radec=radec, **kwargs)
+    finally:
+        os.chdir(cwd)
+
+    products = []
+    for root, dirs, files in os.walk(scratch):
+        rel = os.path.relpath(root, scratch)
+        for d in dirs:
+            path = os.path.join(run_dir, rel, d)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        for name in files:
+            dest = os.path.normpath(os.path.join(run_dir, rel, name))
+            os.replace(os.path.join(root, name), dest)
+            products.append(dest)
+    shutil.rmtree(scratch)
+
+    return status, products
+
+
+#-------------------------------------------------------------------------------
+
+def _prep_task(task):
+    """ `supervise` task. Processes the pairs of one direct visit in turn,
+    and returns a list of (direct product, grism product, seconds, error or
+    None).
+    """
+    results = []
+    for direct, grism, radec, run_dir, kwargs in task:
+        start = time.time()
+        try:
+            process_pair(direct, grism, radec, run_dir=run_dir, **kwargs)
+        except Exception:
+            error = traceback.format_exc()
+        else:
+            error = None
+        results.append((direct['product'], grism['product'], 
+            time.time() - start, error))
+    return results
+
+
+#-------------------------------------------------------------------------------
+
+def prep_pairs(pairs, radec, run_dir='.', workers=1, **kwargs):
+    """ Pre-processes visit pairs, the pairs of `workers` direct visits at a
+    time. The pairs of one direct visit run one after the other, in the 
+    same process, since each writes that visit's FLTs.
+
+    Parameters
+    ----------
+    pairs : list of tuples
+        From `plan_pairs` or `match_visits`.
+    radec : string or list of strings
+        The alignment catalog, or one per pair.
+    run_dir : string
+        Where the products go.
+    workers : int
+        Direct visits processed at once. Values <= 0 count back from the 
+        number of cores, as for joblib.
+    kwargs : dict
+        Passed to `process_direct_grism_visit`.
+
+    Returns
+    -------
+    failed : list of tuples
+        (direct product, grism product, traceback or exit code) of the 
+        pairs that raised, or of every pair of a direct visit whose process
+        died; their scratch directories stay in `run_dir`.
+
+    """
+    if isinstance(radec, str):
+        radec = [radec] * len(pairs)
+    # One task per direct visit, its pairs in the order given.
+    groups = OrderedDict()
+    for (direct, grism), catalog in zip(pairs, radec):
+        groups.setdefault(direct['product'], []).append((direct, grism, 
+            catalog, run_dir, kwargs))
+    tasks = list(groups.values())
+
+    if workers <= 0:
+        workers = max(multiprocessing.cpu_count() + 1 + workers, 1)
+
+    logging.info("Processing {} direct/grism pairs of {} direct visits on {} "
+        "workers".format(len(pairs), len(tasks), workers))
+
+    failed = []
+    for task, status, result in supervise(_prep_task, tasks, workers=workers):
+        if status != 'done':
+            # The child died before it could report.
+            result = [(pair[0]['product'], pair[1]['product'], None, result)
+                for pair in task]
+        for direct, grism, elapsed, error in result:
+            if error is None:
+                logging.info("Processed {} and {} in {:.0f} s".format(direct,
+                    grism, elapsed))
+            else:
+                logging.info("Processing {} and {} failed:\n{}".format(direct,
+                    grism, error))
+                failed.append((direct, grism, error))
+
+    return failed
@@ -0,0 +1,210 @@
+"""
+Cutouts of the reference image and segmentation map around each FLT.
+
+`compute_full_model` blots the reference image and the segmentation map
+onto an FLT grown by `pad` on every side, yet each GroupFLT was handed the
+full GOODS mosaics, read and blotted whole for every FLT. Here only the
+section of each mosaic under the FLT's padded footprint (plus a margin for
+the blotting kernel) is read, through a memory map, into a small in-memory
+image (an HDU, which GroupFLT takes in place of a file name), so nothing is
+written to disk:
+
+* the footprint is traced along the edges of the padded detector with the
+  FLT's own WCS, distortion included, and projected onto the mosaic;
+* the cutout keeps every keyword of the mosaic's header (e.g. PHOTFLAM and
+  FILTER, which GrismFLT reads from the reference image) with CRPIX, and
+  LTV if present, shifted to the section, so it maps the same pixels to the
+  same sky;
+* scaled (BSCALE/BZERO) images are sliced raw and scaled after, so the
+  memory map is not defeated.
+
+`model_scheduler.model_flts` gives these to the GroupFLT of each FLT in
+place of the mosaics. A mosaic the FLT doesn't overlap is passed as is.
+
+Use:
+
+    >>> ref, seg = flt_cutouts('icxt51jwq_flt.fits', [ref_file, seg_file],
+    ...     pad=500)
+    >>> grp = GroupFLT(grism_files=['icxt51jwq_flt.fits'], ref_file=ref,
+    ...     seg_file=seg, catalog=catalog, pad=500)
+
+"""
+
+import numpy as np
+import os
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+
+# Mosaic pixels added around the footprint, for the blotting kernel.
+MARGIN = 20
+
+# Points traced along each edge of the padded detector.
+EDGE_POINTS = 9
+
+# Keywords of the mosaic's header that describe its layout rather than its
+# contents, and are rewritten for the cutout.
+STRUCTURAL = ['SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2',
+    'EXTEND', 'PCOUNT', 'GCOUNT', 'BSCALE', 'BZERO', 'BLANK']
+
+
+#-------------------------------------------------------------------------------
+
+def flt_footprint(flt_file, pad=200, n=EDGE_POINTS):
+    """ Traces the edges of an FLT's detector, grown by `pad`, on the sky.
+
+    Parameters
+    ----------
+    flt_file : string
+        The grism FLT.
+    pad : int
+        The padding of the GroupFLT, pixels.
+    n : int
+        Points along each edge.
+
+    Returns
+    -------
+    ra, dec : arrays
+        In degrees.
+
+    """
+    header = fits.getheader(flt_file, 'SCI', 1)
+    nx, ny = header['NAXIS1'], header['NAXIS2']
+    xs = np.linspace(-pad - 0.5, nx + pad - 0.5, n)
+    ys = np.linspace(-pad - 0.5, ny + pad - 0.5, n)
+    x = np.concatenate([xs, xs, np.full(n, xs[0]), np.full(n, xs[-1])])
+    y = np.concatenate([np.full(n, ys[0]), np.full(n, ys[-1]), ys, ys])
+
+    return WCS(header, relax=True).all_pix2world(x, y, 0)
+
+
+#-------------------------------------------------------------------------------
+
+def _image_ext(hdul):
+    """ Returns the index of the first 2-D image of a FITS.
+    """
+    for i, hdu in enumerate(hdul):
+        if hdu.header.get('NAXIS') == 2:
+            return i
+    raise ValueError("No image in {}".format(hdul.filename()))
+
+
+#-------------------------------------------------------------------------------
+
+def section(header, ra, dec, margin=MARGIN):
+    """ Finds the pixels of an image that cover the given positions.
+
+    Parameters
+    ----------
+    header : astropy.io.fits.Header
+        Of the image.
+    ra, dec : arrays
+        Positions in degrees, e.g. from `flt_footprint`.
+    margin : int
+        Pixels added on every side.
+
+    Returns
+    -------
+    box : tuple or None
+        (y0, y1, x0, x1), the slices of the image, clipped to it; None if
+        the positions fall off the image.
+
+    """
+    x, y = WCS(header).all_world2pix(ra, dec, 0)
+    nx, ny = header['NAXIS1'], header['NAXIS2']
+    x0 = max(int(np.floor(x.min())) - margin, 0)
+    x1 = min(int(np.ceil(x.max())) + margin + 1, nx)
+    y0 = max(int(np.floor(y.min())) - margin, 0)
+    y1 = min(int(np.ceil(y.max())) + margin + 1, ny)
+    if x0 >= x1 or y0 >= y1:
+        return None
+
+    return y0, y1, x0, x1
+
+
+#-------------------------------------------------------------------------------
+
+def cutout(path, ra, dec, margin=MARGIN):
+    """ Cuts out the section of an image that covers the given positions.
+
+    Parameters
+    ----------
+    path : string
+        The image, e.g. the reference mosaic or the segmentation map.
+    ra, dec : arrays
+        Positions in degrees.
+    margin : int
+        Pixels added on every side.
+
+    Returns
+    -------
+    hdu : astropy.io.fits.PrimaryHDU or None
+        The cutout, in memory; None if the positions fall off the image.
+
+    """
+    with fits.open(path, memmap=True, do_not_scale_image_data=True) as hdul:
+        hdu = hdul[_image_ext(hdul)]
+        box = section(hdu.header, ra, dec, margin=margin)
+        if box is None:
+            return None
+        y0, y1, x0, x1 = box
+
+        # Only the pages of the section are read.
+        data = np.array(hdu.data[y0:y1, x0:x1])
+        bscale = hdu.header.get('BSCALE', 1)
+        bzero = hdu.header.get('BZERO', 0)
+        if bscale != 1 or bzero != 0:
+            data = (data * np.float64(bscale) + bzero).astype(np.float32)
+
+        out = fits.PrimaryHDU(data=data)
+        for card in hdu.header.cards:
+            if card.keyword not in STRUCTURAL:
+                out.header.append(card)
+
+    for axis, start in [(1, x0), (2, y0)]:
+        for key in ['CRPIX{}', 'LTV{}']:
+            key = key.format(axis)
+            if key in out.header:
+                out.header[key] -= start
+    out.header['CUTOUT'] = (os.path.basename(path), 'Cut out of this image')
+    out.header['CUTBOX'] = ('[{}:{},{}:{}]'.format(x0 + 1, x1, y0 + 1, y1),
+        'Section of it, 1-based, inclusive')
+
+    return out
+
+
+#-------------------------------------------------------------------------------
+
+def flt_cutouts(flt_file, files, pad=200, margin=MARGIN):
+    """ Cuts the images GroupFLT needs down to the footprint of one FLT.
+
+    Parameters
+    ----------
+    flt_file : string
+        The grism FLT.
+    files : list of strings
+        The images, e.g. [ref_file, seg_file]. None entries are passed
+        through.
+    pad : int
+        The padding of the GroupFLT, pixels.
+    margin : int
+        Pixels of each image added around the footprint.
+
+    Returns
+    -------
+    cutouts : list
+        The cutout of each image, a PrimaryHDU, or the image's path where
+        the FLT doesn't overlap it.
+
+    """
+    ra, dec = flt_footprint(flt_file, pad=pad)
+
+    cutouts = []
+    for path in files:
+        hdu = None
+        if path is not None:
+            hdu = cutout(path, ra, dec, margin=margin)
+        cutouts.append(path if hdu is None else hdu)
+
+    return cutouts
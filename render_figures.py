@@ -0,0 +1,222 @@
+#! /usr/bin/env python
+
+"""
+Deferred rendering of the stack and full PNGs from saved FITS products.
+
+With `--figures 'False'`, the "fit" step of `clear_grizli_pipeline.py` only
+writes FITS. This module draws the figures afterwards, off the critical
+path, in a pool of processes using the Agg backend. Figures newer than
+their FITS are skipped, so re-running only draws what changed.
+
+* <field>_<id>.stack.png from <field>_<id>.stack.fits, with grizli's
+  `show_drizzle_HDU`, as `drizzle_grisms_and_PAs` draws it.
+* <field>_<id>.full_summary.png from <field>_<id>.full.fits: the redshift
+  PDF and the best-fit template. This is a lighter figure than the
+  <field>_<id>.full.png `run_all` draws, which needs the full fit objects,
+  so it has a name of its own and never stands in for it. In a run fit
+  without figures, QA that looks for the full PNGs finds these instead.
+
+Use:
+
+    Be in the outputs directory of the run.
+
+    >>> python render_figures.py --field GN2 --workers 8
+
+"""
+
+import argparse
+import glob
+import logging
+import matplotlib.pyplot as plt
+import multiprocessing
+import numpy as np
+import os
+
+from astropy.io import fits
+
+
+#-------------------------------------------------------------------------------
+
+def figure_name(product):
+    """ Returns the PNG drawn from a stack or full FITS `product`.
+    """
+    if product.endswith('.full.fits'):
+        return product.replace('.full.fits', '.full_summary.png')
+    return product.replace('.fits', '.png')
+
+
+#-------------------------------------------------------------------------------
+
+def is_stale(png, product):
+    """ True if `png` is missing or older than the FITS `product`.
+    """
+    return not os.path.isfile(png) or \
+        os.path.getmtime(png) < os.path.getmtime(product)
+
+
+#-------------------------------------------------------------------------------
+
+def render_stack(stack_fits):
+    """ Draws <root>.stack.png from <root>.stack.fits.
+    """
+    from grizli.multifit import show_drizzle_HDU
+
+    hdu = fits.open(stack_fits)
+    fig = show_drizzle_HDU(hdu, diff=True)
+    fig.savefig(figure_name(stack_fits))
+    plt.close(fig)
+    hdu.close()
+
+
+#-------------------------------------------------------------------------------
+
+def render_full(full_fits):
+    """ Draws <root>.full_summary.png from <root>.full.fits: the redshift
+    PDF and the best-fit continuum and full template.
+    """
+    hdu = fits.open(full_fits)
+    zfit = hdu['ZFIT_STACK'].data
+    templ = hdu['TEMPL'].data
+
+    fig, axes = plt.subplots(1, 2, figsize=[12, 4])
+
+    if 'pdf' in zfit.names:
+        axes[0].plot(zfit['zgrid'], np.log10(np.maximum(zfit['pdf'], 1.e-10)), color='k')
+        axes[0].set_ylabel('log PDF')
+    else:
+        axes[0].plot(zfit['zgrid'], zfit['chi2'], color='k')
+        axes[0].set_ylabel(r'$\chi^2$')
+    axes[0].set_xlabel('z')
+
+    wave = templ['wave'] / 1.e4
+    clip = (wave > 0.75) & (wave < 1.75)
+    axes[1].plot(wave[clip], templ['full'][clip], color='r', label='full')
+    axes[1].plot(wave[clip], templ['continuum'][clip], color='0.5', label='continuum')
+    axes[1].set_xlabel(r'$\lambda$ [$\mu$m]')
+    axes[1].legend(loc='upper right')
+
+    title = os.path.basename(full_fits).split('.full.fits')[0]
+    if 'Z_MAP' in hdu[0].header:
+        title += '  z = {:.4f}'.format(hdu[0].header['Z_MAP'])
+    fig.suptitle(title)
+
+    fig.savefig(figure_name(full_fits))
+    plt.close(fig)
+    hdu.close()
+
+
+#-------------------------------------------------------------------------------
+
+def _init_render_worker():
+    """ Pool initializer. Draws off screen, whatever the parent used. Only
+    ever run in the workers.
+    """
+    plt.switch_backend('Agg')
+
+
+#-------------------------------------------------------------------------------
+
+def _render_one(product):
+    """ Pool task. Renders one product, returning (product, error or None).
+    """
+    try:
+        if product.endswith('.stack.fits'):
+            render_stack(product)
+        else:
+            render_full(product)
+    except Exception as err:
+        return product, '{}: {}'.format(type(err).__name__, err)
+    return product, None
+
+
+#-------------------------------------------------------------------------------
+
+def render(field, workers=1, force=False):
+    """ Renders the stale stack and full summary PNGs of a field in the
+    working directory.
+
+    Parameters
+    ----------
+    field : string
+        The pointing, technically, 'GN1', 'GS1', etc.
+    workers : int
+        Number of rendering processes.
+    force : {True, False}
+        Set to True to redraw figures that are already up to date.
+
+    Returns
+    -------
+    n_rendered : int
+        The number of figures drawn.
+
+    """
+    products = sorted(glob.glob('{}_[0-9]*.stack.fits'.format(field)) +
+                      glob.glob('{}_[0-9]*.full.fits'.format(field)))
+    todo = [p for p in products if force or
+            is_stale(figure_name(p), p)]
+    logging.info("Rendering {} of {} figures for field {}"\
+        .format(len(todo), len(products), field))
+
+    if workers <= 1:
+        # Off screen here too, but the caller keeps its backend.
+        backend = plt.get_backend()
+        plt.switch_backend('Agg')
+        try:
+            results = [_render_one(product) for product in todo]
+        finally:
+            plt.switch_backend(backend)
+    else:
+        pool = multiprocessing.get_context('fork').Pool(processes=workers,
+            initializer=_init_render_worker)
+        try:
+            results = list(pool.imap_unordered(_render_one, todo, chunksize=4))
+        finally:
+            pool.close()
+            pool.join()
+
+    n_rendered = 0
+    for product, error in results:
+        if error is None:
+            n_rendered += 1
+        else:
+            logging.info("Could not render {}: {}".format(product, error))
+
+    return n_rendered
+
+
+#-------------------------------------------------------------------------------
+
+def parse_args():
+    """Parses command line arguments.
+
+    Returns
+    -------
+    args : object
+        Containing the field, workers and force arguments.
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--field', dest = 'field',
+                        action = 'store', type = str, required = True,
+                        help = "The field whose figures to render.")
+    parser.add_argument('--workers', dest = 'workers',
+                        action = 'store', type = int, required = False,
+                        help = "Number of rendering processes. Default is 1.",
+                        default=1)
+    parser.add_argument('--force', dest = 'force',
+                        action = 'store_true', required = False,
+                        help = "Redraw figures that are already up to date.")
+    args = parser.parse_args()
+
+    return args
+
+
+#-------------------------------------------------------------------------------
+#-------------------------------------------------------------------------------
+
+if __name__=="__main__":
+
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    n_rendered = render(args.field, workers=args.workers, force=args.force)
+    print("Rendered {} figures.".format(n_rendered))
@@ -37,18 +37,30 @@ from set_paths import paths
 
 def make_filesinfo():
     """ Creates files.info file in RAW.
+
+    The headers are read through the FLT header index (`flt_index.py`, 
+    Python 3), so only FLTs new since the last call are opened. The 
+    columns are those of `grizli.utils.get_flt_info`, named in the 
+    first line (`read_filesinfo` of check_all.py and reprocess_all.py
+    read them by name). If the index fails, the old files.info is put 
+    back and RuntimeError is raised.
     """
     # Retain the old files.info. User can delete if desired.
     path_to_RAW = paths['path_to_RAW']
-    path_to_software = paths['path_to_software']
-    if os.path.isfile(path_to_RAW + 'files.info'):
+    retained = os.path.isfile(path_to_RAW + 'files.info')
+    if retained:
         os.rename(path_to_RAW + 'files.info', path_to_RAW + 'files.info.retain')
-    cwd = os.getcwd()
 
-    os.chdir('{}threedhst/threedhst/bin/'.format(path_to_software))
-    subprocess.call(['./flt_info.sh'])
-    os.chdir(cwd)
-    shutil.copy(path_to_software+'threedhst/threedhst/bin/files.info', path_to_RAW + 'files.info')
+    flt_index = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flt_index.py')
+    status = subprocess.call(['python3', flt_index, '--raw', path_to_RAW, 
+        '--filesinfo', path_to_RAW + 'files.info'])
+    if status != 0:
+        if retained:
+            os.rename(path_to_RAW + 'files.info.retain', path_to_RAW + 'files.info')
+        elif os.path.isfile(path_to_RAW + 'files.info'):
+            os.remove(path_to_RAW + 'files.info')
+        raise RuntimeError("flt_index.py exited with status {}; files.info "
+            "left as it was".format(status))
 
 
 #-------------------------------------------------------------------------------  
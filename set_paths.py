@@ -32,7 +32,9 @@ paths = {'path_to_outputs' : '/astro/clear/cgosmeyer/outputs/',
          'path_to_PREPARE' : '/astro/clear/cgosmeyer/PREPARE/', 
          'path_to_software' : '/astro/clear/cgosmeyer/software/',
          'path_to_PERSIST' : '/astro/clear/cgosmeyer/PERSIST/',
-         'path_to_Extractions' : '/astro/clear/cgosmeyer/Extractions/'}
+         'path_to_Extractions' : '/astro/clear/cgosmeyer/Extractions/',
+         'path_to_template_cache' : '/astro/clear/cgosmeyer/template_cache/',
+         'path_to_model_cache' : '/astro/clear/cgosmeyer/model_cache/'}
 
          # path_to_ref_files contains REF, CONF, Synphot, iref, jref, and templates 
          # ref_files used to be Work, and REF used to be its own directory, not
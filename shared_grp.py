@@ -0,0 +1,285 @@
+"""
+Shares the arrays of a GroupFLT between processes without copying them.
+
+A GroupFLT holds, for every FLT, the grism and direct science, error and
+DQ arrays, the segmentation map and the contamination model. Handing it to
+a pool of extraction processes would otherwise pickle all of it once per
+worker, or reload it from disk in each. Here the large arrays are moved
+once into `multiprocessing.shared_memory` blocks, and the GroupFLT keeps
+views on them. The `SharedGroup` handle pickles as the GroupFLT without
+those arrays plus the names of the blocks, so a worker attaches to the
+same memory and N workers cost roughly one copy.
+
+Arrays already mapped from a file, as in the GroupFLTs of 
+`lazy_grp.load_lazy_grp`, are left out of shared memory: copying them
+would read them whole and hold them twice. A worker maps the same section
+of the same file instead, so they are shared through the page cache.
+
+Use:
+
+    >>> with SharedGroup(grp) as shared:
+    ...     written = map_grp(shared, extract, zip(ids, mags), workers=8)
+
+"""
+
+import logging
+import multiprocessing
+import numpy as np
+import pickle
+
+from multiprocessing import resource_tracker, shared_memory
+
+
+# Arrays smaller than this stay in the pickled skeleton.
+MIN_BYTES = 1 << 16
+
+_worker_shared = None
+
+
+#-------------------------------------------------------------------------------
+
+def _flt_arrays(flt, min_bytes=MIN_BYTES):
+    """ Yields (path, array) for the large arrays of one GrismFLT.
+
+    A path is ('model',) for an array attribute of the FLT, or
+    ('grism', 'SCI') for an entry of the `data` dict of one of its images.
+    """
+    for name, value in list(vars(flt).items()):
+        if isinstance(value, np.ndarray):
+            if value.nbytes >= min_bytes and not value.dtype.hasobject:
+                yield (name,), value
+        elif isinstance(getattr(value, 'data', None), dict):
+            for key, arr in list(value.data.items()):
+                if isinstance(arr, np.ndarray) and arr.nbytes >= min_bytes \
+                    and not arr.dtype.hasobject:
+                    yield (name, key), arr
+
+
+#-------------------------------------------------------------------------------
+
+def _set_array(flt, path, arr):
+    """ Puts `arr` at `path` (see `_flt_arrays`) in the GrismFLT.
+    """
+    if len(path) == 1:
+        setattr(flt, path[0], arr)
+    else:
+        getattr(flt, path[0]).data[path[1]] = arr
+
+
+#-------------------------------------------------------------------------------
+
+def _get_array(flt, path):
+    """ Returns the array at `path` (see `_flt_arrays`) in the GrismFLT.
+    """
+    if len(path) == 1:
+        return getattr(flt, path[0])
+    return getattr(flt, path[0]).data[path[1]]
+
+
+#-------------------------------------------------------------------------------
+
+def _file_section(arr):
+    """ Returns (file name, offset) of the bytes of `arr` if it is a 
+    contiguous view on a memory-mapped file, or None.
+    """
+    base = arr
+    while base is not None and not isinstance(base, np.memmap):
+        base = getattr(base, 'base', None)
+    if base is None or getattr(base, 'filename', None) is None or \
+        not arr.flags.c_contiguous:
+        return None
+
+    start = arr.__array_interface__['data'][0] - \
+        base.__array_interface__['data'][0]
+    return base.filename, base.offset + start
+
+
+#-------------------------------------------------------------------------------
+
+def _attach(name):
+    """ Attaches to an existing block without handing it to this process's
+    resource tracker; the creator unlinks it. Before Python 3.13 attaching
+    registers the block, so it is unregistered again, lest the tracker 
+    unlink it, or warn of a leak, when this process exits.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+#-------------------------------------------------------------------------------
+
+class SharedGroup():
+    """ A GroupFLT whose large arrays live in shared memory.
+
+    Parameters
+    ----------
+    grp : grizli.multifit.GroupFLT
+        Its arrays, other than those mapped from files, are moved into 
+        shared memory in place; `grp` stays usable in this process.
+    min_bytes : int
+        Arrays smaller than this are left where they are.
+
+    Attributes
+    ----------
+    grp : grizli.multifit.GroupFLT
+        The group, with views on the shared blocks.
+    specs : list of tuples
+        (FLT index, path, block name, shape, dtype) of each shared array.
+    mapped : list of tuples
+        (FLT index, path, file name, offset, shape, dtype) of each array 
+        left mapped from its file.
+    nbytes : int
+        Total size of the shared arrays.
+    """
+    def __init__(self, grp, min_bytes=MIN_BYTES):
+        self.grp = grp
+        self.specs = []
+        self.mapped = []
+        self._blocks = []
+        self._owner = True
+
+        for i, flt in enumerate(grp.FLTs):
+            for path, arr in list(_flt_arrays(flt, min_bytes)):
+                section = _file_section(arr)
+                if section is not None:
+                    self.mapped.append((i, path) + section + (arr.shape, 
+                        arr.dtype.str))
+                    continue
+                shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+                view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+                view[...] = arr
+                _set_array(flt, path, view)
+                self._blocks.append(shm)
+                self.specs.append((i, path, shm.name, arr.shape, arr.dtype.str))
+
+        self.nbytes = sum(shm.size for shm in self._blocks)
+        logging.info("Shared {} arrays of {} FLTs, {:.1f} MB; {} left mapped"\
+            .format(len(self.specs), len(grp.FLTs), self.nbytes / 1.e6, 
+            len(self.mapped)))
+
+    def __getstate__(self):
+        # Pickle the group with the shared and mapped arrays taken out, then
+        # put them back so this process can go on using it.
+        paths = [spec[:2] for spec in self.specs + self.mapped]
+        arrays = [_get_array(self.grp.FLTs[i], path) for i, path in paths]
+        for i, path in paths:
+            _set_array(self.grp.FLTs[i], path, None)
+        try:
+            skeleton = pickle.dumps(self.grp, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            for (i, path), arr in zip(paths, arrays):
+                _set_array(self.grp.FLTs[i], path, arr)
+
+        return {'skeleton':skeleton, 'specs':self.specs, 
+                'mapped':self.mapped, 'nbytes':self.nbytes}
+
+    def __setstate__(self, state):
+        self.grp = pickle.loads(state['skeleton'])
+        self.specs = state['specs']
+        self.mapped = state['mapped']
+        self.nbytes = state['nbytes']
+        self._blocks = []
+        self._owner = False
+
+        for i, path, name, shape, dtype in self.specs:
+            shm = _attach(name)
+            view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            _set_array(self.grp.FLTs[i], path, view)
+            self._blocks.append(shm)
+        for i, path, filename, offset, shape, dtype in self.mapped:
+            # Copy-on-write, as `lazy_grp` maps them.
+            _set_array(self.grp.FLTs[i], path, np.memmap(filename, 
+                dtype=np.dtype(dtype), mode='c', offset=offset, shape=shape))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def release(self):
+        """ Copies the shared arrays back into private memory of this process
+        and frees the blocks. Workers must be done with them. Mapped arrays
+        stay as they are.
+        """
+        for i, path, name, shape, dtype in self.specs:
+            flt = self.grp.FLTs[i]
+            _set_array(flt, path, np.array(_get_array(flt, path)))
+        for shm in self._blocks:
+            try:
+                shm.close()
+            except BufferError:
+                # Something, e.g. a beam cutout, still holds a view; the 
+                # memory goes when that does.
+                pass
+            if self._owner:
+                shm.unlink()
+        self._blocks = []
+        self.specs = []
+        self.mapped = []
+
+
+#-------------------------------------------------------------------------------
+
+def _init_worker(shared):
+    """ Pool initializer. Keeps the attached group, and with it the blocks,
+    for the tasks.
+    """
+    global _worker_shared
+    _worker_shared = shared
+
+
+#-------------------------------------------------------------------------------
+
+def _call(func_task):
+    """ Pool task. Calls `func(grp, task)` on the attached group.
+    """
+    func, task = func_task
+    return func(_worker_shared.grp, task)
+
+
+#-------------------------------------------------------------------------------
+
+def map_grp(shared, func, tasks, workers=1, context='spawn'):
+    """ Calls `func(grp, task)` for every task in a pool of processes that
+    all attach to the same shared GroupFLT.
+
+    Parameters
+    ----------
+    shared : SharedGroup
+        The published group.
+    func : callable
+        A module-level function, called as `func(grp, task)`.
+    tasks : iterable
+        The tasks, e.g. (id, mag) pairs.
+    workers : int
+        Number of processes. Values <= 0 count back from the number of
+        cores, as in joblib (-1 is all cores).
+    context : string
+        The multiprocessing start method. With 'spawn' or 'forkserver'
+        each worker receives the handle once, pickled without the shared
+        arrays; with 'fork' it inherits the mapping.
+
+    Returns
+    -------
+    results : list
+        The return values of `func`, in the order of `tasks`.
+
+    """
+    if workers <= 0:
+        workers = max(multiprocessing.cpu_count() + 1 + workers, 1)
+
+    ctx = multiprocessing.get_context(context)
+    pool = ctx.Pool(processes=workers, initializer=_init_worker,
+        initargs=(shared,))
+    try:
+        results = pool.map(_call, [(func, task) for task in tasks], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
@@ -0,0 +1,185 @@
+"""
+Stages input files into a run directory without copying their bytes.
+
+Each run of the pipeline works in a new time-stamped directory, into which
+the prepared FLTs of an earlier run used to be copied, gigabytes at a time.
+Here a file is staged by the cheapest method that works, in order:
+
+* hardlink : same inode, no data written. Same filesystem only.
+* reflink  : copy-on-write clone (btrfs, XFS, ...). Safe to modify.
+* symlink  : link back to the source, across filesystems.
+* copy     : byte copy, the last resort.
+
+A file that a later step will modify in place is staged `mutable`, by
+reflink or copy only, so the source is never touched. Copies and clones are
+checked against the checksum of the source, and every staged file is
+recorded in the run directory's README with its method, checksum and
+origin.
+
+Use:
+
+    >>> staged = stage_files(flt_files, dest='.', readme='README.txt')
+
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import time
+
+
+METHODS = ['hardlink', 'reflink', 'symlink', 'copy']
+MUTABLE_METHODS = ['reflink', 'copy']
+
+# ioctl request of Linux's FICLONE, which reflinks a whole file.
+FICLONE = 0x40049409
+
+
+#-------------------------------------------------------------------------------
+
+def checksum(path):
+    """ Returns the sha1 hex digest of a file's contents.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+#-------------------------------------------------------------------------------
+
+def _reflink(src, dst):
+    """ Clones `src` to `dst` with FICLONE. Raises OSError where the
+    filesystem (or platform) can't.
+    """
+    import fcntl
+
+    with open(src, 'rb') as fsrc:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(fd, FICLONE, fsrc.fileno())
+        except (OSError, IOError):
+            os.close(fd)
+            os.remove(dst)
+            raise
+        os.close(fd)
+    shutil.copystat(src, dst)
+
+
+#-------------------------------------------------------------------------------
+
+def _link(method, src, dst):
+    """ Stages `src` at `dst` by `method`.
+    """
+    if method == 'hardlink':
+        os.link(src, dst)
+    elif method == 'reflink':
+        _reflink(src, dst)
+    elif method == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+    elif method == 'copy':
+        shutil.copy2(src, dst)
+    else:
+        raise ValueError("Unknown staging method '{}'".format(method))
+
+
+#-------------------------------------------------------------------------------
+
+def stage_file(src, dest='.', mutable=False, src_sum=None):
+    """ Stages one file into the directory `dest`.
+
+    Parameters
+    ----------
+    src : string
+        The file to stage.
+    dest : string
+        The run directory.
+    mutable : {True, False}
+        Set to True if a later step modifies the staged file in place; it
+        is then reflinked or copied, never linked.
+    src_sum : string
+        The checksum of `src`, if already known.
+
+    Returns
+    -------
+    dst : string
+        The staged path.
+    method : string
+        One of METHODS, or 'existing' if `dst` already held the same bytes.
+    src_sum : string
+        The checksum of `src`.
+
+    """
+    dst = os.path.join(dest, os.path.basename(src))
+    if src_sum is None:
+        src_sum = checksum(src)
+
+    if os.path.lexists(dst):
+        if os.path.exists(dst) and os.path.samefile(src, dst) and not mutable:
+            return dst, 'existing', src_sum
+        if not os.path.islink(dst) and not os.path.samefile(src, dst) \
+            and checksum(dst) == src_sum:
+            return dst, 'existing', src_sum
+        os.remove(dst)
+
+    for method in (MUTABLE_METHODS if mutable else METHODS):
+        try:
+            _link(method, src, dst)
+        except (OSError, IOError) as err:
+            if method == 'copy' or err.errno not in [errno.EXDEV,
+                errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EINVAL,
+                errno.ENOTTY, errno.EMLINK, errno.EACCES]:
+                raise
+            continue
+
+        # A link shares the source's inode; clones and copies are checked.
+        if method in ['reflink', 'copy'] and checksum(dst) != src_sum:
+            os.remove(dst)
+            raise IOError("Checksum mismatch staging {} by {}".format(src, method))
+
+        return dst, method, src_sum
+
+
+#-------------------------------------------------------------------------------
+
+def stage_files(files, dest='.', mutable=False, readme='README.txt'):
+    """ Stages files into the directory `dest` and records where they came
+    from.
+
+    Parameters
+    ----------
+    files : list of strings
+        The files to stage.
+    dest : string
+        The run directory.
+    mutable : {True, False}
+        See `stage_file`.
+    readme : string
+        File in `dest` to append the provenance to. None for none.
+
+    Returns
+    -------
+    staged : list of strings
+        The staged paths, in the order of `files`.
+
+    """
+    staged = []
+    records = []
+    for src in files:
+        dst, method, src_sum = stage_file(src, dest=dest, mutable=mutable)
+        logging.info("Staged {} by {}".format(src, method))
+        staged.append(dst)
+        records.append('{} {} sha1:{} {}\n'.format(os.path.basename(dst),
+            method, src_sum, os.path.abspath(src)))
+
+    if readme is not None:
+        with open(os.path.join(dest, readme), 'a') as f:
+            f.write('{}\n'.format(time.ctime()))
+            f.write('Staged {} files (name, method, checksum, origin):\n'\
+                .format(len(records)))
+            f.writelines(records)
+
+    return staged
@@ -0,0 +1,428 @@
+#! /usr/bin/env python
+
+"""
+Synthetic CLEAR-like field for offline performance measurements.
+
+Writes, under one directory, everything `clear_grizli_pipeline.py` reads
+for a field, so its steps can run on a laptop without the archive on
+/astro/clear:
+
+* RAW/<root>_flt.fits : WFC3/IR direct (F105W) and grism (G102) FLTs of a
+  few visits at different PA_V3, with SCI, ERR and DQ extensions, a TAN
+  WCS, and the primary keywords `grizli.utils.get_flt_info` reads. The
+  grism FLTs carry a first-order-like trace of every source: a streak
+  along +x from the source's position, with its spatial profile.
+* REF/ : a reference mosaic, a segmentation map and a SExtractor-style
+  catalog of the same sources, named as `Pointing` expects them for the
+  field and the F105W reference filter.
+
+The sources, pointings and noise all come from `seed`, so the same
+arguments always give the same field. The traces only roughly follow the
+real G102 dispersion: the field is for timing the pipeline, not for
+science.
+
+Use:
+
+    >>> python synthetic_field.py --outdir /tmp/synthetic --field GS1 \
+        --sources 300 --visits 2
+
+    or
+
+    >>> from synthetic_field import make_field
+    >>> field = make_field('/tmp/synthetic', field='GS1', n_sources=300)
+
+"""
+
+import argparse
+import numpy as np
+import os
+
+from astropy.io import fits
+from astropy.wcs import WCS
+from pointings import Pointing
+
+
+# Field centers (ra, dec), degrees.
+CENTERS = {'N':(189.2282, 62.2386), 'S':(53.1590, -27.7810)}
+
+# Pixel scales, arcsec.
+REF_SCALE = 0.06
+FLT_SCALE = 0.128
+
+# WFC3/IR FLT size, pixels.
+FLT_SIZE = 1014
+
+# AB zeropoint of F105W, for e-/s.
+ZEROPOINT = 26.27
+
+# Reach of the synthetic first order along x from the source, pixels.
+TRACE_START, TRACE_END = 30, 200
+
+# Sky and read noise of the FLTs, e-/s and e-.
+SKY = {'F105W':0.8, 'G102':0.6}
+READ_NOISE = 20.
+
+
+#-------------------------------------------------------------------------------
+
+def tan_header(ra, dec, scale, size, orient=0.):
+    """ Returns a TAN WCS header centered on (ra, dec).
+
+    Parameters
+    ----------
+    ra, dec : floats
+        The center, degrees.
+    scale : float
+        Arcsec per pixel.
+    size : int
+        Pixels on a side.
+    orient : float
+        Position angle of the y axis, degrees east of north.
+
+    """
+    theta = np.radians(orient)
+    cd = scale / 3600. * np.array([[-np.cos(theta), np.sin(theta)],
+                                   [np.sin(theta), np.cos(theta)]])
+    header = fits.Header()
+    header['CTYPE1'], header['CTYPE2'] = 'RA---TAN', 'DEC--TAN'
+    header['CRVAL1'], header['CRVAL2'] = ra, dec
+    header['CRPIX1'] = header['CRPIX2'] = (size + 1) / 2.
+    header['CD1_1'], header['CD1_2'] = cd[0]
+    header['CD2_1'], header['CD2_2'] = cd[1]
+    header['ORIENTAT'] = orient
+
+    return header
+
+
+#-------------------------------------------------------------------------------
+
+def add_gaussians(image, x, y, flux, sigma, nsig=4):
+    """ Adds 2D Gaussians of total `flux` at (x, y), zero-indexed, to
+    `image` in place. Sources off the image are skipped.
+    """
+    ny, nx = image.shape
+    for xi, yi, fi, si in zip(x, y, flux, sigma):
+        r = int(np.ceil(nsig * si))
+        x0, x1 = max(int(xi) - r, 0), min(int(xi) + r + 1, nx)
+        y0, y1 = max(int(yi) - r, 0), min(int(yi) + r + 1, ny)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        image[y0:y1, x0:x1] += fi / (2 * np.pi * si**2) * \
+            np.exp(-((xx - xi)**2 + (yy - yi)**2) / (2 * si**2))
+
+
+#-------------------------------------------------------------------------------
+
+def add_traces(image, x, y, flux, sigma):
+    """ Adds a synthetic first order of each source at (x, y) to `image` in
+    place: its flux spread along x from `TRACE_START` to `TRACE_END` pixels
+    to the right, with a smooth sensitivity and a Gaussian profile in y.
+    """
+    ny, nx = image.shape
+    dx = np.arange(TRACE_START, TRACE_END)
+    sens = np.exp(-0.5 * ((dx - dx.mean()) / (0.35 * len(dx)))**2)
+    sens /= sens.sum()
+
+    for xi, yi, fi, si in zip(x, y, flux, sigma):
+        r = int(np.ceil(4 * si))
+        y0, y1 = max(int(yi) - r, 0), min(int(yi) + r + 1, ny)
+        xs = int(xi) + dx
+        keep = (xs >= 0) & (xs < nx)
+        if y0 >= y1 or not keep.any():
+            continue
+        yy = np.arange(y0, y1)[:, None]
+        profile = np.exp(-(yy - yi)**2 / (2 * si**2)) / (np.sqrt(2 * np.pi) * si)
+        image[y0:y1, xs[keep]] += fi * profile * sens[keep]
+
+
+#-------------------------------------------------------------------------------
+
+def make_sources(n_sources, header, size, rng):
+    """ Draws the sources of the field over the reference mosaic.
+
+    Returns
+    -------
+    sources : dict
+        Arrays of 'number', 'x', 'y' (zero-indexed, reference pixels),
+        'ra', 'dec', 'mag', 'flux' (e-/s in F105W) and 'sigma' (reference
+        pixels).
+
+    """
+    margin = 20
+    x = rng.uniform(margin, size - margin, n_sources)
+    y = rng.uniform(margin, size - margin, n_sources)
+    # Fainter sources are the more numerous.
+    mag = 18. + 8. * rng.power(3., n_sources)
+    sigma = rng.uniform(1.5, 4., n_sources) * (1. + 0.1 * (26. - mag))
+    ra, dec = WCS(header).all_pix2world(x, y, 0)
+
+    return {'number':np.arange(1, n_sources + 1), 'x':x, 'y':y, 'ra':ra,
+            'dec':dec, 'mag':mag, 'flux':10**(-0.4 * (mag - ZEROPOINT)),
+            'sigma':sigma}
+
+
+#-------------------------------------------------------------------------------
+
+def write_reference(ref_dir, pointing, sources, header, size, rng):
+    """ Writes the reference mosaic, segmentation map and catalog under the
+    names `pointing` expects.
+    """
+    sci = rng.normal(0., 0.002, (size, size)).astype(np.float32)
+    add_gaussians(sci, sources['x'], sources['y'], sources['flux'],
+        sources['sigma'])
+    hdr = header.copy()
+    hdr['FILTER'] = 'F105W'
+    hdr['PHOTFLAM'] = 3.0386e-20
+    hdr['PHOTPLAM'] = 10551.
+    fits.PrimaryHDU(data=sci, header=hdr).writeto(
+        os.path.join(ref_dir, pointing.ref_image), overwrite=True)
+
+    # Each source claims the pixels within 2.5 sigma; the fainter, drawn
+    # later, win overlaps.
+    seg = np.zeros((size, size), dtype=np.int32)
+    for n, xi, yi, si in zip(sources['number'], sources['x'], sources['y'],
+            sources['sigma']):
+        r = int(np.ceil(2.5 * si))
+        y0, y1 = max(int(yi) - r, 0), min(int(yi) + r + 1, size)
+        x0, x1 = max(int(xi) - r, 0), min(int(xi) + r + 1, size)
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        inside = (xx - xi)**2 + (yy - yi)**2 <= (2.5 * si)**2
+        seg[y0:y1, x0:x1][inside] = n
+    fits.PrimaryHDU(data=seg, header=header).writeto(
+        os.path.join(ref_dir, pointing.seg_map), overwrite=True)
+
+    columns = [('NUMBER', sources['number'], '{:d}'),
+               ('X_IMAGE', sources['x'] + 1, '{:.3f}'),
+               ('Y_IMAGE', sources['y'] + 1, '{:.3f}'),
+               ('X_WORLD', sources['ra'], '{:.7f}'),
+               ('Y_WORLD', sources['dec'], '{:.7f}'),
+               ('MAG_AUTO', sources['mag'], '{:.4f}'),
+               ('MAGERR_AUTO', 0.01 * 10**(0.2 * (sources['mag'] - 20)), '{:.4f}'),
+               ('FLUX_AUTO', sources['flux'], '{:.5g}'),
+               ('FLUX_RADIUS', 1.18 * sources['sigma'], '{:.3f}'),
+               ('A_IMAGE', sources['sigma'], '{:.3f}'),
+               ('B_IMAGE', sources['sigma'], '{:.3f}'),
+               ('THETA_IMAGE', np.zeros(len(sources['x'])), '{:.1f}'),
+               ('CLASS_STAR', np.zeros(len(sources['x'])), '{:.2f}')]
+    with open(os.path.join(ref_dir, pointing.catalog), 'w') as f:
+        for i, (name, values, fmt) in enumerate(columns):
+            f.write('#{:4d} {}\n'.format(i + 1, name))
+        for row in zip(*[values for name, values, fmt in columns]):
+            f.write(' '.join(fmt.format(v) for v, (name, values, fmt)
+                in zip(row, columns)) + '\n')
+
+    # The (ra, dec) catalog `prep` aligns to.
+    with open(os.path.join(ref_dir, pointing.radec_catalog), 'w') as f:
+        for ra, dec in zip(sources['ra'], sources['dec']):
+            f.write('{:.7f} {:.7f}\n'.format(ra, dec))
+
+
+#-------------------------------------------------------------------------------
+
+def write_flt(path, field, filt, ra, dec, orient, visit, expstart, sources,
+    rng, exptime=1000.):
+    """ Writes one synthetic WFC3/IR FLT of the sources.
+
+    Parameters
+    ----------
+    path : string
+        The <root>_flt.fits to write.
+    field : string
+        The TARGNAME.
+    filt : string
+        'F105W' or 'G102'.
+    ra, dec, orient : floats
+        Pointing center and ORIENTAT, degrees.
+    visit : int
+        The visit number, for the header.
+    expstart : float
+        The MJD of the exposure start.
+    sources : dict
+        From `make_sources`.
+    rng : numpy.random.Generator
+    exptime : float
+        Seconds.
+
+    """
+    header = tan_header(ra, dec, FLT_SCALE, FLT_SIZE, orient=orient)
+    x, y = WCS(header).all_world2pix(sources['ra'], sources['dec'], 0)
+    sigma = sources['sigma'] * REF_SCALE / FLT_SCALE
+
+    sci = np.full((FLT_SIZE, FLT_SIZE), SKY[filt], dtype=np.float32)
+    if filt.startswith('G'):
+        add_traces(sci, x, y, sources['flux'], sigma)
+    else:
+        add_gaussians(sci, x, y, sources['flux'], sigma)
+    var = (sci * exptime + READ_NOISE**2) / exptime**2
+    sci += rng.normal(0., 1., sci.shape).astype(np.float32) * np.sqrt(var)
+    sci -= SKY[filt]
+
+    primary = fits.Header()
+    primary['TELESCOP'] = 'HST'
+    primary['INSTRUME'] = 'WFC3'
+    primary['DETECTOR'] = 'IR'
+    primary['FILTER'] = filt
+    primary['TARGNAME'] = field
+    primary['ROOTNAME'] = os.path.basename(path).split('_flt')[0]
+    primary['EXPTIME'] = exptime
+    primary['EXPSTART'] = expstart
+    primary['EXPEND'] = expstart + exptime / 86400.
+    primary['DATE-OBS'] = '2017-01-{:02d}'.format(1 + visit % 28)
+    primary['TIME-OBS'] = '00:00:00'
+    primary['PA_V3'] = (orient - 45.) % 360.
+    primary['RA_TARG'], primary['DEC_TARG'] = ra, dec
+    primary['POSTARG1'] = primary['POSTARG2'] = 0.
+    primary['APERTURE'] = 'IR'
+    primary['SUBARRAY'] = False
+    primary['OBSTYPE'] = 'SPECTROSCOPIC' if filt.startswith('G') else 'IMAGING'
+
+    header['EXTNAME'] = 'SCI'
+    header['EXTVER'] = 1
+    header['BUNIT'] = 'ELECTRONS/S'
+    header['PHOTFLAM'] = 3.0386e-20
+    header['PHOTPLAM'] = 10551.
+    header['PHOTFNU'] = 1.1283e-07
+    header['PHOTZPT'] = -21.1
+    header['PHOTMODE'] = 'WFC3 IR {}'.format(filt)
+    header['EXPTIME'] = exptime
+    header['SAMPTIME'] = exptime
+
+    hdus = [fits.PrimaryHDU(header=primary),
+            fits.ImageHDU(data=sci, header=header)]
+    for extname, data in [('ERR', np.sqrt(var).astype(np.float32)),
+                          ('DQ', np.zeros(sci.shape, dtype=np.int16)),
+                          ('SAMP', np.full(sci.shape, 16, dtype=np.int16)),
+                          ('TIME', np.full(sci.shape, exptime, dtype=np.float32))]:
+        ext = fits.ImageHDU(data=data, header=header.copy())
+        ext.header['EXTNAME'] = extname
+        hdus.append(ext)
+    fits.HDUList(hdus).writeto(path, overwrite=True)
+
+
+#-------------------------------------------------------------------------------
+
+def make_field(outdir, field='GS1', n_sources=300, n_visits=2, n_grism=2,
+    n_direct=1, ref_size=3200, seed=1):
+    """ Writes a synthetic field under `outdir`.
+
+    Parameters
+    ----------
+    outdir : string
+        Gets the RAW/ and REF/ directories.
+    field : string
+        The pointing, e.g. 'GS1'. Picks the hemisphere, and so the names of
+        the reference products, as `Pointing` does.
+    n_sources : int
+        Sources in the reference mosaic.
+    n_visits : int
+        Visits, each at its own orient and a small offset.
+    n_grism, n_direct : int
+        G102 and F105W exposures per visit.
+    ref_size : int
+        Pixels on a side of the reference mosaic. By default it covers an
+        FLT with the grizli padding at any orient.
+    seed : int
+        Of every random draw.
+
+    Returns
+    -------
+    products : dict
+        'raw' and 'ref' directories, 'flts' (the FLT paths) and 'pointing'.
+
+    """
+    rng = np.random.default_rng(seed)
+    raw_dir = os.path.join(outdir, 'RAW')
+    ref_dir = os.path.join(outdir, 'REF')
+    for path in [raw_dir, ref_dir]:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    pointing = Pointing(field=field, ref_filter='F105W')
+    hemisphere = 'N' if 'N' in field.upper() else 'S'
+    ra0, dec0 = CENTERS[hemisphere]
+
+    header = tan_header(ra0, dec0, REF_SCALE, ref_size)
+    sources = make_sources(n_sources, header, ref_size, rng)
+    write_reference(ref_dir, pointing, sources, header, ref_size, rng)
+
+    flts = []
+    expstart = 57754.
+    for visit in range(n_visits):
+        orient = (visit * 37.) % 360.
+        # Small dithers around the field center.
+        dra, ddec = rng.uniform(-3., 3., 2) / 3600.
+        ra = ra0 + dra / np.cos(np.radians(dec0))
+        dec = dec0 + ddec
+        for filt, n_exp, kind in [('F105W', n_direct, 'd'), ('G102', n_grism, 'g')]:
+            for exp in range(n_exp):
+                root = 'isy{:02d}{}{:02d}q'.format(visit + 1, kind, exp)
+                path = os.path.join(raw_dir, root + '_flt.fits')
+                write_flt(path, field, filt, ra, dec, orient, visit, expstart,
+                    sources, rng)
+                flts.append(path)
+                expstart += 0.02
+
+    return {'raw':raw_dir, 'ref':ref_dir, 'flts':flts, 'pointing':pointing}
+
+
+#-------------------------------------------------------------------------------
+
+def parse_args():
+    """Parses command line arguments.
+
+    Returns
+    -------
+    args : object
+        Containing the outdir, field, sources, visits, grism, direct,
+        ref_size and seed arguments.
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outdir', dest = 'outdir',
+                        action = 'store', type = str, required = True,
+                        help = "Directory to write RAW/ and REF/ in.")
+    parser.add_argument('--field', dest = 'field',
+                        action = 'store', type = str, required = False,
+                        help = "The pointing. Default is 'GS1'.",
+                        default='GS1')
+    parser.add_argument('--sources', dest = 'sources',
+                        action = 'store', type = int, required = False,
+                        help = "Number of sources. Default is 300.",
+                        default=300)
+    parser.add_argument('--visits', dest = 'visits',
+                        action = 'store', type = int, required = False,
+                        help = "Number of visits. Default is 2.",
+                        default=2)
+    parser.add_argument('--grism', dest = 'grism',
+                        action = 'store', type = int, required = False,
+                        help = "G102 exposures per visit. Default is 2.",
+                        default=2)
+    parser.add_argument('--direct', dest = 'direct',
+                        action = 'store', type = int, required = False,
+                        help = "F105W exposures per visit. Default is 1.",
+                        default=1)
+    parser.add_argument('--ref_size', dest = 'ref_size',
+                        action = 'store', type = int, required = False,
+                        help = "Pixels on a side of the reference mosaic. Default is 3200.",
+                        default=3200)
+    parser.add_argument('--seed', dest = 'seed',
+                        action = 'store', type = int, required = False,
+                        help = "Random seed. Default is 1.",
+                        default=1)
+    args = parser.parse_args()
+
+    return args
+
+
+#-------------------------------------------------------------------------------
+#-------------------------------------------------------------------------------
+
+if __name__=="__main__":
+
+    args = parse_args()
+    products = make_field(args.outdir, field=args.field, n_sources=args.sources,
+        n_visits=args.visits, n_grism=args.grism, n_direct=args.direct,
+        ref_size=args.ref_size, seed=args.seed)
+    print("Wrote {} FLTs in {} and the reference products in {}".format(
+        len(products['flts']), products['raw'], products['ref']))
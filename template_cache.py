@@ -0,0 +1,194 @@
+"""
+On-disk cache of `grizli.utils.load_templates` template sets.
+
+Building the FSPS + emission line templates takes several seconds per call,
+and every fit (and every fit worker) used to do it twice. The cache stores
+each template set as two flat .npy arrays plus a JSON index, which reload
+memory-mapped in milliseconds and share their pages between processes.
+
+Entries live in versioned sub-directories keyed on the `load_templates`
+arguments, the grizli version, and the size and mtime of every file in the
+grizli templates directory, so editing a template or upgrading grizli
+rebuilds the entry instead of serving stale spectra.
+
+Use:
+
+    >>> from template_cache import load_cached_templates
+    >>> templ0 = load_cached_templates(fwhm=1200, line_complexes=True,
+    ...     stars=False, fsps_templates=True)
+
+"""
+
+import grizli
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import shutil
+import tempfile
+
+from collections import OrderedDict
+from set_paths import paths
+
+
+# Bump when the on-disk layout changes.
+CACHE_VERSION = 1
+
+
+#-------------------------------------------------------------------------------
+
+def _template_sources():
+    """ Lists (relative path, size, mtime) of every file in the grizli
+    templates directory, which `load_templates` reads from.
+    """
+    grizli_path = getattr(grizli, 'GRIZLI_PATH', None) or os.getenv('GRIZLI', '')
+    templates_dir = os.path.join(grizli_path, 'templates')
+
+    sources = []
+    for root, dirs, files in os.walk(templates_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            sources.append([os.path.relpath(path, templates_dir),
+                stat.st_size, int(stat.st_mtime)])
+
+    return sources
+
+
+#-------------------------------------------------------------------------------
+
+def template_cache_key(**kwargs):
+    """ Returns the hex digest identifying a template set.
+
+    Parameters
+    ----------
+    kwargs :
+        The keyword arguments that will be passed to `load_templates`.
+
+    Returns
+    -------
+    key : string
+
+    """
+    desc = {'cache_version' : CACHE_VERSION,
+            'grizli_version' : getattr(grizli, '__version__', ''),
+            'kwargs' : sorted(kwargs.items()),
+            'sources' : _template_sources()}
+
+    return hashlib.sha1(json.dumps(desc, sort_keys=True, default=str)\
+        .encode('utf-8')).hexdigest()
+
+
+#-------------------------------------------------------------------------------
+
+def write_templates(templates, path):
+    """ Writes a template set to the directory `path`.
+
+    The directory is built under a temporary name and renamed into place,
+    so concurrent writers and readers never see a partial entry.
+
+    Parameters
+    ----------
+    templates : OrderedDict
+        Keys of template names; values of `grizli.utils.SpectrumTemplate`.
+    path : string
+        The cache entry directory.
+
+    """
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+
+    index = []
+    start = 0
+    for name in templates:
+        size = len(templates[name].wave)
+        index.append({'name':name, 'start':start, 'stop':start+size})
+        start += size
+
+    np.save(os.path.join(tmp, 'wave.npy'),
+        np.hstack([templates[name].wave for name in templates]).astype(np.float64))
+    np.save(os.path.join(tmp, 'flux.npy'),
+        np.hstack([templates[name].flux for name in templates]).astype(np.float64))
+    with open(os.path.join(tmp, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Someone else finished the same entry first.
+        shutil.rmtree(tmp)
+
+
+#-------------------------------------------------------------------------------
+
+def read_templates(path):
+    """ Reads a template set written by `write_templates`.
+
+    The arrays are opened copy-on-write memory maps, so pages are shared
+    between every process reading the same entry.
+
+    Parameters
+    ----------
+    path : string
+        The cache entry directory.
+
+    Returns
+    -------
+    templates : OrderedDict
+        Keys of template names; values of `grizli.utils.SpectrumTemplate`.
+
+    """
+    wave = np.load(os.path.join(path, 'wave.npy'), mmap_mode='c')
+    flux = np.load(os.path.join(path, 'flux.npy'), mmap_mode='c')
+    with open(os.path.join(path, 'index.json')) as f:
+        index = json.load(f)
+
+    templates = OrderedDict()
+    for entry in index:
+        sl = slice(entry['start'], entry['stop'])
+        templates[entry['name']] = grizli.utils.SpectrumTemplate(
+            wave=wave[sl], flux=flux[sl], name=entry['name'])
+
+    return templates
+
+
+#-------------------------------------------------------------------------------
+
+def load_cached_templates(cache_dir=None, fwhm=1200, line_complexes=True,
+    stars=False, full_line_list=None, continuum_list=None, fsps_templates=True):
+    """ Drop-in for `grizli.utils.load_templates` that goes through the cache.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Root of the cache. By default `paths['path_to_template_cache']`.
+    fwhm, line_complexes, stars, full_line_list, continuum_list, fsps_templates :
+        Passed to `grizli.utils.load_templates` on a cache miss.
+
+    Returns
+    -------
+    templates : OrderedDict
+        Keys of template names; values of `grizli.utils.SpectrumTemplate`.
+
+    """
+    if cache_dir is None:
+        cache_dir = paths['path_to_template_cache']
+
+    kwargs = {'fwhm':fwhm, 'line_complexes':line_complexes, 'stars':stars,
+              'full_line_list':full_line_list, 'continuum_list':continuum_list,
+              'fsps_templates':fsps_templates}
+    path = os.path.join(cache_dir, 'v{}'.format(CACHE_VERSION),
+        template_cache_key(**kwargs))
+
+    if os.path.isdir(path):
+        return read_templates(path)
+
+    logging.info("Building template cache entry {}".format(path))
+    templates = grizli.utils.load_templates(**kwargs)
+    write_templates(templates, path)
+
+    return read_templates(path)
@@ -0,0 +1,9 @@
+"""
+Shared setup of the tests: the pipeline modules live at the top of the
+repository, not in a package, so it goes on the path.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
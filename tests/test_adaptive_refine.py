@@ -0,0 +1,123 @@
+"""
+Tests of `adaptive_refine` on synthetic FLTs: the object footprints, the
+residual of each object, and which objects are refined.
+"""
+
+import numpy as np
+
+from adaptive_refine import (_integral, flt_chi2, flt_footprints,
+    object_residuals, refine_adaptive)
+
+
+class FLT():
+    """ The parts of a GrismFLT that `adaptive_refine` reads. """
+
+    def __init__(self, seg, sci, model=None):
+        self.seg = seg
+        self.grism = {'SCI':sci, 'ERR':np.ones(sci.shape),
+            'DQ':np.zeros(sci.shape, dtype=int)}
+        self.model = np.zeros(sci.shape) if model is None else model
+
+
+class Group():
+    """ A GroupFLT whose refinement makes an object's model match its
+    footprint exactly.
+    """
+
+    def __init__(self, FLTs, catalog):
+        self.FLTs = FLTs
+        self.catalog = catalog
+        self.refined = []
+
+    def refine_list(self, ids=[], mags=[], **kwargs):
+        self.refined.append(list(ids))
+        for flt in self.FLTs:
+            boxes = flt_footprints(flt, beam_extent=[0, 4])
+            for id in ids:
+                y0, y1, x0, x1 = boxes[id]
+                flt.model[y0:y1, x0:x1] = flt.grism['SCI'][y0:y1, x0:x1]
+
+
+def two_objects():
+    """ Objects 3 and 7 on a 20x40 FLT, with a chi-squared of 3 per pixel
+    over the footprint of 7 and 1 over that of 3.
+    """
+    seg = np.zeros((20, 40), dtype=int)
+    seg[2:4, 5:7] = 3
+    seg[10:13, 20:22] = 7
+    sci = np.zeros(seg.shape)
+    sci[2:4, 5:11] = 1.
+    sci[10:13, 20:26] = 3.**0.5
+    return FLT(seg, sci)
+
+
+#-------------------------------------------------------------------------------
+
+def test_flt_footprints():
+    flt = two_objects()
+    assert flt_footprints(flt, beam_extent=[0, 4]) == {3:(2, 4, 5, 11),
+        7:(10, 13, 20, 26)}
+
+    # Clipped to the FLT.
+    assert flt_footprints(flt, beam_extent=[-10, 30]) == {3:(2, 4, 0, 37),
+        7:(10, 13, 10, 40)}
+
+    # BEAM_EXTENT without a grism configuration.
+    assert flt_footprints(flt)[7] == (10, 13, 0, 40)
+
+
+def test_integral():
+    image = np.random.RandomState(1).rand(6, 9)
+    t = _integral(image)
+    assert t.shape == (7, 10)
+    for y0, y1, x0, x1 in [(0, 6, 0, 9), (1, 4, 2, 7), (5, 6, 8, 9)]:
+        box = t[y1, x1] - t[y0, x1] - t[y1, x0] + t[y0, x0]
+        assert np.isclose(box, image[y0:y1, x0:x1].sum())
+
+
+def test_flt_chi2_skips_bad_pixels():
+    flt = FLT(np.zeros((2, 2), dtype=int), np.full((2, 2), 2.))
+    flt.grism['ERR'][0, 0] = 0
+    flt.grism['DQ'][0, 1] = 4
+    flt.grism['SCI'][1, 0] = np.nan
+
+    table, count = flt_chi2(flt)
+    assert table[-1, -1] == 4.
+    assert count[-1, -1] == 1
+
+
+#-------------------------------------------------------------------------------
+
+def test_object_residuals():
+    flt = two_objects()
+    footprints = [flt_footprints(flt, beam_extent=[0, 4])]
+    grp = Group([flt, flt], None)
+
+    chi2 = object_residuals(grp, [3, 7, 99], footprints=footprints*2)
+    assert np.allclose(chi2[:2], [1., 3.])
+    assert np.isnan(chi2[2])
+
+
+def test_refine_adaptive_refines_only_bad_objects():
+    flt = two_objects()
+    flt.conf = type('conf', (), {'conf':{'BEAMA':[0, 4]}})()
+    catalog = {'NUMBER':[3, 7, 9], 'MAG_AUTO':[20., 18., 30.]}
+    grp = Group([flt], catalog)
+
+    stats = refine_adaptive(grp, threshold=2., max_iter=3)
+
+    # 7 is above the threshold; 3 isn't; 9 is outside mag_limits.
+    assert grp.refined == [[7]]
+    assert stats == {'measured':4, 'refined':1, 'passes':1, 'above':0}
+
+
+def test_refine_adaptive_gives_up_on_objects_that_dont_improve():
+    flt = two_objects()
+    flt.conf = type('conf', (), {'conf':{'BEAMA':[0, 4]}})()
+    grp = Group([flt], {'NUMBER':[3, 7], 'MAG_AUTO':[20., 18.]})
+    grp.refine_list = lambda ids=[], **kwargs: grp.refined.append(list(ids))
+
+    stats = refine_adaptive(grp, threshold=2., max_iter=5)
+    assert grp.refined == [[7]]
+    assert stats['passes'] == 1
+    assert stats['above'] == 1
@@ -0,0 +1,119 @@
+"""
+Tests of the model and fit steps of `clear_grizli_pipeline`, with the
+grizli modeling itself replaced by stand-ins that track what the saved
+models on disk are.
+"""
+
+import pytest
+
+for name in ['grizli', 'drizzlepac', 'matplotlib', 'record']:
+    pytest.importorskip(name)
+
+import clear_grizli_pipeline as cgp
+
+
+#-------------------------------------------------------------------------------
+
+def test_refinement_starts_from_unrefined_models(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    grism_files = ['ia01_flt.fits', 'ia02_flt.fits', 'ia03_flt.fits']
+    # ia01 changed; the others still hold models refined by another field.
+    disk = {'ia01_flt.fits':'old', 'ia02_flt.fits':'refined:GN3',
+        'ia03_flt.fits':'refined:GN3'}
+    refined_from = []
+
+    def restore_models(flts, manifest, group=None):
+        if group is not None:
+            return list(flts)
+        for flt in flts:
+            disk[flt] = 'modeled'
+        return []
+
+    class GroupFLT():
+        def __init__(self, grism_files=[], **kwargs):
+            refined_from.append(dict((flt, disk[flt]) for flt in grism_files))
+
+        def refine_list(self, **kwargs):
+            pass
+
+        def save_full_data(self):
+            for flt in disk:
+                disk[flt] = 'refined:GN2'
+
+    monkeypatch.setattr(cgp, 'plan_models', lambda *args, **kwargs:
+        (['ia01_flt.fits'], {'flts':{}}))
+    monkeypatch.setattr(cgp, 'needs_refinement', lambda *args: True)
+    monkeypatch.setattr(cgp, 'restore_models', restore_models)
+    monkeypatch.setattr(cgp, 'store_models', lambda *args, **kwargs: None)
+    monkeypatch.setattr(cgp, 'model_flts', lambda *args, **kwargs: None)
+    monkeypatch.setattr(cgp, 'remove_saved_models', lambda flt: None)
+    monkeypatch.setattr(cgp, 'refined_digests', lambda *args: {})
+    monkeypatch.setattr(cgp, 'flt_residuals', lambda *args, **kwargs: None)
+    monkeypatch.setattr(cgp, 'model_workers', lambda n: 1)
+    monkeypatch.setattr(cgp, 'GroupFLT', GroupFLT)
+
+    cgp.update_models(grism_files, name='GN2', refine='all')
+
+    assert refined_from == [{flt:'modeled' for flt in grism_files}]
+    assert set(disk.values()) == set(['refined:GN2'])
+
+
+#-------------------------------------------------------------------------------
+
+def test_model_shared_models_shared_flts_once(monkeypatch):
+    files = {'GN2':['ia01_flt.fits', 'ia02_flt.fits', 'ia03_flt.fits'],
+        'GN3':['ia02_flt.fits', 'ia03_flt.fits', 'ib01_flt.fits'],
+        'GN4':['ib01_flt.fits'],
+        'GS1':['ia01_flt.fits', 'ic01_flt.fits']}
+    updated = []
+
+    class Pointing():
+        def __init__(self, field='', ref_filter=''):
+            mosaic = 'goodss' if field.startswith('GS') else 'goodsn'
+            self.ref_image = mosaic + '_ref.fits'
+            self.seg_map = mosaic + '_seg.fits'
+            self.catalog = mosaic + '.cat'
+            self.pad = 200
+
+    def update_models(grism_files, name='', refine='all', **kwargs):
+        updated.append((name, grism_files, refine))
+
+    monkeypatch.setattr(cgp, 'Pointing', Pointing)
+    monkeypatch.setattr(cgp, 'field_files', lambda visits, field:
+        (files[field], files[field]))
+    monkeypatch.setattr(cgp, 'update_models', update_models)
+
+    cgp.model_shared({}, ['GN2', 'GN3', 'GN4', 'GS1'], ref_filter='F105W')
+
+    # ia01 is in GS1 too, but GS1 is modeled from other mosaics.
+    assert updated == [('GN2-GN3-GN4', ['ia02_flt.fits', 'ia03_flt.fits',
+        'ib01_flt.fits'], None)]
+
+
+#-------------------------------------------------------------------------------
+
+def test_fit_field_refits_on_new_models(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    inputs = ['ia01.01.GrismFLT.fits', 'GN2.model_manifest.json']
+    for path in inputs:
+        (tmp_path / path).write_text('v1')
+    fitted = []
+
+    def fit(grp, field='', **kwargs):
+        ledger = cgp.FitLedger('{}.ledger'.format(field))
+        for id in [1, 2]:
+            if not ledger.is_finished(id):
+                ledger.record(id, 'run_all')
+                fitted.append(id)
+
+    monkeypatch.setattr(cgp, 'model', lambda *args, **kwargs: None)
+    monkeypatch.setattr(cgp, 'fit', fit)
+
+    cgp.fit_field({}, field='GN2', inputs=inputs)
+    assert fitted == [1, 2]
+    cgp.fit_field({}, field='GN2', inputs=inputs)
+    assert fitted == [1, 2]
+
+    (tmp_path / inputs[0]).write_text('v2')
+    cgp.fit_field({}, field='GN2', inputs=inputs)
+    assert fitted == [1, 2, 1, 2]
@@ -0,0 +1,59 @@
+"""
+Tests of `clear_inspection_tools.flt_residuals`: statistics, flags and
+previews of the model residuals, drawn without touching the caller's
+matplotlib backend.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+plt = pytest.importorskip('matplotlib.pyplot')
+
+from clear_inspection_tools import flag_outliers, flt_residuals
+
+
+class Image(dict):
+    pad = 0
+
+
+class FLT():
+    def __init__(self, name, noise, rng):
+        self.grism = Image(SCI=rng.normal(0., noise, (40, 40)),
+            ERR=np.ones((40, 40)), DQ=np.zeros((40, 40), dtype=int))
+        self.grism.parent_file = name
+        self.model = np.zeros((40, 40))
+
+
+class Group():
+    def __init__(self, FLTs):
+        self.FLTs = FLTs
+
+
+#-------------------------------------------------------------------------------
+
+def test_flag_outliers():
+    flagged = flag_outliers([1., 1.1, 0.9, 1., 9.], [0., 0., 0.05, 0., 0.])
+    assert list(flagged) == [False, False, True, False, True]
+
+
+#-------------------------------------------------------------------------------
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_flt_residuals(tmp_path, monkeypatch, workers):
+    monkeypatch.chdir(tmp_path)
+    plt.switch_backend('pdf')
+    rng = np.random.RandomState(4)
+    grp = Group([FLT('ia0{}_flt.fits'.format(i), noise, rng) for i, noise
+        in enumerate([0.01, 0.011, 0.009, 0.01, 1.])])
+
+    stats = flt_residuals(grp, workers=workers, output='GN2.flt_residuals.txt')
+
+    assert plt.get_backend() == 'pdf'
+    assert list(stats['flagged']) == [False] * 4 + [True]
+    assert np.allclose(stats['rms'][:4], 0.01, rtol=0.15)
+    assert os.path.isfile('GN2.flt_residuals.txt')
+    assert os.path.isfile('ia00_residuals_preview.png')
+    assert os.path.isfile('ia04_residuals.png')
+    assert not os.path.isfile('ia00_residuals.png')
@@ -0,0 +1,87 @@
+"""
+Tests of `fit_ledger.FitLedger`: records survive a reload, including one
+cut short by a crash.
+"""
+
+import pytest
+
+from fit_ledger import FitLedger, start_ledger
+
+
+#-------------------------------------------------------------------------------
+
+def test_reload(tmp_path):
+    path = str(tmp_path / 'GN2.ledger')
+    ledger = FitLedger(path)
+    assert ledger.is_new
+    ledger.record(1, 'beams', 1.5)
+    ledger.record(1, 'run_all', 20., note='z=1.2  done')
+    ledger.record(2, 'polyfit', 3.)
+
+    ledger = FitLedger(path)
+    assert not ledger.is_new
+    assert ledger.is_finished(1)
+    assert not ledger.is_finished(2)
+    assert ledger.stage(2) == 'polyfit'
+    assert ledger.elapsed[1] == {'beams':1.5, 'run_all':20.}
+    assert list(ledger.ids()) == [1]
+
+
+#-------------------------------------------------------------------------------
+
+def test_truncated_last_line(tmp_path):
+    path = str(tmp_path / 'GN2.ledger')
+    ledger = FitLedger(path)
+    ledger.record(1, 'run_all', 20.)
+    ledger.record(2, 'beams', 1.)
+    # A worker killed halfway through writing its line.
+    with open(path, 'a') as f:
+        f.write('1700000000.000 2 sta')
+
+    ledger = FitLedger(path)
+    assert ledger.is_finished(1)
+    assert ledger.stage(2) == 'beams'
+
+    # Appending goes on after the partial line is skipped.
+    with open(path, 'a') as f:
+        f.write('\n')
+    ledger.record(2, 'failed', note='killed')
+    assert FitLedger(path).stage(2) == 'failed'
+
+
+#-------------------------------------------------------------------------------
+
+def test_unknown_stage(tmp_path):
+    ledger = FitLedger(str(tmp_path / 'GN2.ledger'))
+    with pytest.raises(ValueError):
+        ledger.record(1, 'stacked')
+
+
+#-------------------------------------------------------------------------------
+
+def test_start_ledger(tmp_path):
+    path = str(tmp_path / 'GN2.ledger')
+    assert not start_ledger(path, 'models-a')
+    FitLedger(path).record(1, 'run_all', 20.)
+
+    # Same inputs: resumed.
+    assert not start_ledger(path, 'models-a')
+    assert FitLedger(path).is_finished(1)
+
+    # New inputs: nothing counts as fit, nor is seeded from old products.
+    (tmp_path / 'GN2_00001.full.fits').write_text('')
+    assert start_ledger(path, 'models-b')
+    ledger = FitLedger(path)
+    assert not ledger.is_new
+    assert not ledger.is_finished(1)
+    assert FitLedger(path + '.models-a').is_finished(1)
+
+
+#-------------------------------------------------------------------------------
+
+def test_start_ledger_adopts_unstamped(tmp_path):
+    path = str(tmp_path / 'GN2.ledger')
+    FitLedger(path).record(1, 'run_all', 20.)
+
+    assert not start_ledger(path, 'models-a')
+    assert FitLedger(path).is_finished(1)
@@ -0,0 +1,58 @@
+"""
+Tests of `fit_planner`: the work list skips what the ledger records as
+finished, and the cost estimate comes from the ledger's timings.
+"""
+
+import numpy as np
+import pytest
+
+from fit_ledger import FitLedger
+from fit_planner import DEFAULT_COST, estimate_cost, plan_fits
+
+
+IDS = np.array([5, 1, 3, 4, 2, 6])
+MAGS = np.array([24.5, 21.0, 26.0, 22.0, 23.2, 21.0])
+
+
+#-------------------------------------------------------------------------------
+
+def test_plan_fits(tmp_path):
+    ledger = FitLedger(str(tmp_path / 'GN2.ledger'))
+    ledger.record(4, 'run_all', 60.)
+    ledger.record(2, 'timeout', 600.)
+    ledger.record(6, 'stack', 5.)
+
+    ids, mags = plan_fits(IDS, MAGS, ledger=ledger, mag_lim=25)
+    assert list(ids) == [1, 6, 5]
+    assert list(mags) == [21.0, 21.0, 24.5]
+
+    ids, mags = plan_fits(IDS, MAGS, ledger=ledger, mag_lim=25,
+        order='catalog')
+    assert list(ids) == [5, 1, 6]
+
+    ids, mags = plan_fits(IDS, MAGS, mag_lim=27, mag_min=22, min_id=2)
+    assert list(ids) == [4, 5, 3]
+    assert list(plan_fits(IDS, MAGS, id_choose=3)[0]) == [3]
+
+    with pytest.raises(ValueError):
+        plan_fits(IDS, MAGS, order='faintest')
+
+
+#-------------------------------------------------------------------------------
+
+def test_estimate_cost(tmp_path):
+    assert list(estimate_cost(IDS, MAGS, [22.5], ledger=None)) == \
+        [DEFAULT_COST]
+
+    ledger = FitLedger(str(tmp_path / 'GN2.ledger'))
+    assert list(estimate_cost(IDS, MAGS, [22.5], ledger=ledger)) == \
+        [DEFAULT_COST]
+
+    # Object 1 (mag 21.0) took 100 s, object 5 (24.5) took 300 s.
+    ledger.record(1, 'beams', 10.)
+    ledger.record(1, 'run_all', 90.)
+    ledger.record(5, 'run_all', 300.)
+    ledger.record(2, 'failed', 1000.)
+
+    cost = estimate_cost(IDS, MAGS, [21.4, 24.1, 22.5], ledger=ledger)
+    assert list(cost) == [100., 300., 200.]
@@ -0,0 +1,113 @@
+"""
+Tests of `fit_supervisor`: outcomes of forked tasks and of the streamed
+extract/fit stages.
+"""
+
+import os
+import time
+
+from fit_supervisor import PENDING, stream, supervise
+
+
+def _task(task):
+    if task == 'raise':
+        raise ValueError('bad task')
+    if task == 'crash':
+        os._exit(3)
+    if task == 'hang':
+        time.sleep(30)
+    return task * 2
+
+
+#-------------------------------------------------------------------------------
+
+def test_supervise_statuses():
+    results = {task:(status, result) for task, status, result in
+        supervise(_task, [1, 'raise', 'crash', 'hang', 2], workers=3,
+        timeout=1., poll=0.1)}
+
+    assert results[1] == ('done', 2)
+    assert results[2] == ('done', 4)
+    assert results['raise'][0] == 'failed'
+    assert 'ValueError: bad task' in results['raise'][1]
+    assert results['crash'] == ('failed', 'child exited with code 3')
+    assert results['hang'][0] == 'timeout'
+    assert results['hang'][1] < 10
+
+
+#-------------------------------------------------------------------------------
+
+def test_supervise_callable_timeout():
+    # Budgets per task: the same hang survives a longer one.
+    budget = lambda task: 0.5 if task == 'hang' else None
+    results = {task:status for task, status, result in
+        supervise(_task, ['hang', 3], workers=2, timeout=budget, poll=0.1)}
+
+    assert results == {'hang':'timeout', 3:'done'}
+
+
+#-------------------------------------------------------------------------------
+
+def test_supervise_pending():
+    def tasks():
+        yield 1
+        for i in range(3):
+            time.sleep(0.05)
+            yield PENDING
+        yield 2
+
+    done = sorted([result for task, status, result in
+        supervise(_task, tasks(), workers=2, poll=0.1)])
+
+    assert done == [2, 4]
+
+
+#-------------------------------------------------------------------------------
+
+def test_stream_outcomes():
+    def extract(task):
+        if task == 3:
+            raise ValueError('no beams')
+        if task == 5:
+            os._exit(4)
+        return task != 7
+
+    def fit(task):
+        if task == 9:
+            time.sleep(30)
+        return task * 10
+
+    outcomes = {task:(stage, status, result) for task, stage, status, result
+        in stream(extract, fit, range(12), extract_workers=2, fit_workers=3,
+        timeout=1., poll=0.1)}
+
+    # Every task is reported exactly once.
+    assert sorted(outcomes) == list(range(12))
+    for task in [0, 1, 2, 4, 6, 8, 10, 11]:
+        assert outcomes[task] == ('fit', 'done', task * 10)
+    assert outcomes[3][:2] == ('extract', 'failed')
+    assert 'ValueError: no beams' in outcomes[3][2]
+    assert outcomes[5][:2] == ('extract', 'failed')
+    assert 'code 4' in outcomes[5][2]
+    assert outcomes[7] == ('extract', 'skipped', None)
+    assert outcomes[9][:2] == ('fit', 'timeout')
+
+
+#-------------------------------------------------------------------------------
+
+def test_stream_extract_timeout():
+    def extract(task):
+        if task == 2:
+            time.sleep(30)
+        return True
+
+    start = time.time()
+    outcomes = {task:(stage, status) for task, stage, status, result
+        in stream(extract, lambda task: task, range(6), extract_workers=1,
+        fit_workers=2, queue_size=3, timeout=None, extract_timeout=1.,
+        poll=0.1)}
+
+    assert time.time() - start < 10
+    assert outcomes[2] == ('extract', 'timeout')
+    for task in [0, 1, 3, 4, 5]:
+        assert outcomes[task] == ('fit', 'done')
@@ -0,0 +1,55 @@
+"""
+Tests of `flt_index.flt_info`: only new or changed headers are read.
+"""
+
+import os
+
+import pytest
+
+grizli = pytest.importorskip('grizli')
+
+from astropy.table import Table
+
+import flt_index
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """ Stands in for `get_flt_info`, recording the files it is given.
+    """
+    reads = []
+
+    def get_flt_info(files):
+        reads.extend(files)
+        return Table(rows=[[os.path.basename(f), os.path.getsize(f)]
+            for f in files], names=['FILE', 'SIZE'], dtype=['U64', 'i8'])
+
+    monkeypatch.setattr(grizli.utils, 'get_flt_info', get_flt_info)
+    return reads
+
+
+#-------------------------------------------------------------------------------
+
+def test_incremental_refresh(tmp_path, reads):
+    files = []
+    for i in range(5):
+        path = str(tmp_path / 'ib{}_flt.fits'.format(i))
+        with open(path, 'w') as f:
+            f.write('x' * (i + 1))
+        files.append(path)
+    index = str(tmp_path / 'flt_index.sqlite')
+
+    info = flt_index.flt_info(files, index, threads=2)
+    assert sorted(reads) == sorted(files)
+    assert list(info['SIZE']) == [1, 2, 3, 4, 5]
+
+    del reads[:]
+    info = flt_index.flt_info(files, index, threads=2)
+    assert reads == []
+    assert list(info['FILE']) == [os.path.basename(f) for f in files]
+
+    with open(files[2], 'a') as f:
+        f.write('more')
+    info = flt_index.flt_info(files[::-1], index, threads=2)
+    assert reads == [files[2]]
+    assert list(info['SIZE']) == [5, 4, 7, 2, 1]
@@ -0,0 +1,59 @@
+"""
+Tests of `lazy_grp`: saved GrismFLTs are mapped rather than read, and
+grizli's loader is restored once the group is built.
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('grizli')
+
+import grizli.model
+
+from astropy.io import fits
+
+from lazy_grp import load_from_fits_mmap, mapped_loading
+
+
+class Image():
+    pass
+
+
+class FLT():
+    def __init__(self):
+        self.direct = Image()
+        self.grism = Image()
+
+
+#-------------------------------------------------------------------------------
+
+def test_load_from_fits_mmap(tmp_path):
+    path = str(tmp_path / 'ia01.01.GrismFLT.fits')
+    arrays = {'SEG':np.arange(20, dtype=np.int32).reshape(4, 5),
+        'MODEL':np.ones((4, 5), dtype=np.float32),
+        'DREF':np.full((4, 5), 2., dtype=np.float32),
+        'GSCI':np.full((4, 5), 3., dtype=np.float32)}
+    fits.HDUList([fits.PrimaryHDU()] + [fits.ImageHDU(data, name=key)
+        for key, data in arrays.items()]).writeto(path)
+
+    flt = FLT()
+    assert load_from_fits_mmap(flt, path)
+    for data, key in [(flt.seg, 'SEG'), (flt.model, 'MODEL'),
+        (flt.direct.data['REF'], 'DREF'), (flt.grism.data['SCI'], 'GSCI')]:
+        assert isinstance(data, np.memmap)
+        assert np.array_equal(data, arrays[key])
+
+    # Copy-on-write: the saved file is untouched.
+    flt.model[...] = 0.
+    assert fits.getdata(path, 'MODEL').sum() == 20
+
+
+#-------------------------------------------------------------------------------
+
+def test_mapped_loading_restores():
+    original = grizli.model.GrismFLT.load_from_fits
+    with pytest.raises(RuntimeError):
+        with mapped_loading():
+            assert grizli.model.GrismFLT.load_from_fits is load_from_fits_mmap
+            raise RuntimeError('GroupFLT failed')
+    assert grizli.model.GrismFLT.load_from_fits is original
@@ -0,0 +1,130 @@
+"""
+Tests of `model_cache`: the keys of models as modeled and as refined, and
+storing and restoring them.
+"""
+
+import os
+
+import pytest
+
+grizli = pytest.importorskip('grizli')
+
+from model_cache import group_digest, model_key, restore_models, store_models
+from model_deps import remove_saved_models
+
+
+FLTS = ['ia01_flt.fits', 'ia02_flt.fits', 'ib01_flt.fits']
+
+
+def manifest(refinement={'refine':'all'}, **digests):
+    flts = {flt:'digest of ' + flt for flt in FLTS}
+    flts.update(digests)
+    return {'flts':flts, 'inputs':{'ref_file':'r', 'seg_file':'s', 'pad':200},
+        'catalog':'c', 'refinement':refinement}
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """ The working directory, with a grizli CONF directory of one file. """
+    conf = tmp_path / 'grizli' / 'CONF'
+    conf.mkdir(parents=True)
+    (conf / 'G102.conf').write_text('BEAMA -20 300')
+    monkeypatch.setattr(grizli, 'GRIZLI_PATH', str(tmp_path / 'grizli'),
+        raising=False)
+    run = tmp_path / 'run'
+    run.mkdir()
+    monkeypatch.chdir(run)
+    return tmp_path
+
+
+def save_models(flts, text):
+    """ Stands in for `save_full_data`, after `remove_saved_models`, as
+    restored models may be links into the cache.
+    """
+    for flt in flts:
+        remove_saved_models(flt)
+        root = flt.split('_flt')[0]
+        for ext in ['fits', 'pkl']:
+            with open('{}.01.GrismFLT.{}'.format(root, ext), 'w') as f:
+                f.write(text)
+
+
+def read_model(flt):
+    with open('{}.01.GrismFLT.fits'.format(flt.split('_flt')[0])) as f:
+        return f.read()
+
+
+#-------------------------------------------------------------------------------
+
+def test_group_digest_ignores_order_and_paths():
+    m = manifest()
+    assert group_digest(FLTS, m) == group_digest(
+        ['prep/' + flt for flt in reversed(FLTS)] + FLTS[:1], m)
+    assert group_digest(FLTS, m) != group_digest(FLTS[:2], m)
+    assert group_digest(FLTS, m) != group_digest(FLTS, 
+        manifest(**{FLTS[2]:'changed'}))
+
+
+def test_model_key(workdir):
+    m = manifest()
+    unrefined = model_key(FLTS[0], m)
+    refined = model_key(FLTS[0], m, group=FLTS)
+
+    assert len(set([unrefined, refined, model_key(FLTS[0], m, group=FLTS[:2]),
+        model_key(FLTS[1], m)])) == 4
+    assert model_key(FLTS[0], manifest(refinement={'refine':'adaptive'}),
+        group=FLTS) != refined
+
+    # A new grism configuration.
+    (workdir / 'grizli' / 'CONF' / 'G141.conf').write_text('BEAMA -20 200')
+    assert model_key(FLTS[0], m) != unrefined
+
+
+def test_unrefined_key_shared_by_fields(workdir):
+    # Another field's manifest: other FLTs, refined otherwise.
+    other = manifest(refinement={'refine':None}, **{FLTS[2]:'changed'})
+    del other['flts'][FLTS[1]]
+
+    assert model_key(FLTS[0], other) == model_key(FLTS[0], manifest())
+    assert model_key(FLTS[0], other, group=FLTS[::2]) != \
+        model_key(FLTS[0], manifest(), group=FLTS[::2])
+
+
+#-------------------------------------------------------------------------------
+
+def test_store_and_restore(workdir):
+    m = manifest()
+    cache_dir = str(workdir / 'cache')
+    save_models(FLTS[:2], 'modeled')
+    store_models(FLTS[:2], m, cache_dir=cache_dir)
+
+    save_models(FLTS, 'stale')
+    assert restore_models(FLTS, m, cache_dir=cache_dir) == FLTS[2:]
+    assert [read_model(flt) for flt in FLTS] == ['modeled', 'modeled', 'stale']
+
+    # A later store of the same key leaves the entry alone.
+    save_models(FLTS[:1], 'modeled again')
+    store_models(FLTS[:1], m, cache_dir=cache_dir)
+    os.remove('ia01.01.GrismFLT.fits')
+    restore_models(FLTS[:1], m, cache_dir=cache_dir)
+    assert read_model(FLTS[0]) == 'modeled'
+
+
+def test_restore_refined_group_all_or_nothing(workdir):
+    m = manifest()
+    cache_dir = str(workdir / 'cache')
+    save_models(FLTS, 'refined')
+    store_models(FLTS[:2], m, cache_dir=cache_dir, group=FLTS)
+
+    save_models(FLTS, 'stale')
+    assert restore_models(FLTS, m, cache_dir=cache_dir, group=FLTS) == FLTS
+    assert [read_model(flt) for flt in FLTS] == ['stale'] * 3
+
+    # Nor are they the models as modeled.
+    assert restore_models(FLTS[:2], m, cache_dir=cache_dir) == FLTS[:2]
+
+    save_models(FLTS, 'refined')
+    store_models(FLTS[2:], m, cache_dir=cache_dir, group=FLTS)
+    save_models(FLTS, 'stale')
+    assert restore_models(FLTS, m, cache_dir=cache_dir, group=FLTS) == []
+    assert [read_model(flt) for flt in FLTS] == ['refined'] * 3
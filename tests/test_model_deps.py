@@ -0,0 +1,178 @@
+"""
+Tests of `model_deps` on synthetic FLTs and catalogs: which FLTs are
+re-modeled, and when a field is refined again.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('grizli')
+
+from astropy.io import fits
+from astropy.table import Table
+
+from model_deps import (changed_objects, needs_refinement, plan_models,
+    refined_digests, save_manifest)
+
+
+# Two FLTs a degree apart.
+CENTERS = {'ia01_flt.fits':(189.2, 62.2), 'ib01_flt.fits':(189.2, 63.2)}
+MANIFEST = 'GN2.model_manifest.json'
+
+
+def write_flt(path, ra, dec, value=0.):
+    header = fits.Header()
+    header['CTYPE1'], header['CTYPE2'] = 'RA---TAN', 'DEC--TAN'
+    header['CRVAL1'], header['CRVAL2'] = ra, dec
+    header['CRPIX1'], header['CRPIX2'] = 50.5, 50.5
+    header['CD1_1'], header['CD2_2'] = -3.6e-5, 3.6e-5
+    sci = fits.ImageHDU(np.full((100, 100), value, dtype=np.float32),
+        header=header, name='SCI')
+    fits.HDUList([fits.PrimaryHDU(), sci]).writeto(path, overwrite=True)
+
+
+def write_catalog(path, objects):
+    """ `objects` of (NUMBER, ra, dec, mag). """
+    numbers, ra, dec, mags = zip(*objects)
+    Table({'NUMBER':numbers, 'X_WORLD':ra, 'Y_WORLD':dec, 'MAG_AUTO':mags})\
+        .write(path, overwrite=True)
+
+
+def touch_later(path):
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime + 10, stat.st_mtime + 10))
+
+
+@pytest.fixture
+def field(tmp_path, monkeypatch):
+    """ A field in the working directory: its FLTs, reference image, 
+    segmentation map and catalog, with one object on each FLT.
+    """
+    monkeypatch.chdir(tmp_path)
+    for name, (ra, dec) in CENTERS.items():
+        write_flt(name, ra, dec)
+    for name in ['ref.fits', 'seg.fits']:
+        (tmp_path / name).write_text(name)
+    write_catalog('cat.fits', [(1, 189.2, 62.2, 20.), (2, 189.2, 63.2, 21.)])
+    return sorted(CENTERS)
+
+
+def save_models(flts):
+    """ Stands in for `save_full_data`. """
+    for flt in flts:
+        root = flt.split('_flt')[0]
+        for ext in ['fits', 'pkl']:
+            with open('{}.01.GrismFLT.{}'.format(root, ext), 'w') as f:
+                f.write('model')
+
+
+def plan(flts, pad=200, **kwargs):
+    return plan_models(flts, 'ref.fits', 'seg.fits', 'cat.fits', pad=pad,
+        params={'mag_limit':26}, manifest_path=MANIFEST, **kwargs)
+
+
+def run(flts, **kwargs):
+    """ Plans, models the stale FLTs and saves the manifest. """
+    stale, manifest = plan(flts, **kwargs)
+    save_models(stale)
+    save_manifest(manifest, MANIFEST)
+    return stale
+
+
+#-------------------------------------------------------------------------------
+
+def test_changed_objects():
+    old = {'1':['a', 1., 2.], '2':['b', 3., 4.], '3':['c', 5., 6.]}
+    new = {'1':['a', 1., 2.], '2':['B', 3.5, 4.], '4':['d', 7., 8.]}
+
+    radec = changed_objects(old, new)
+    assert sorted(map(tuple, radec)) == [(3., 4.), (3.5, 4.), (5., 6.), 
+        (7., 8.)]
+    assert changed_objects(old, old).shape == (0, 2)
+
+
+#-------------------------------------------------------------------------------
+
+def test_plan_models_reuses_saved_models(field):
+    assert run(field) == field
+    assert plan(field)[0] == []
+
+
+def test_plan_models_changed_inputs(field):
+    run(field)
+
+    assert plan(field, pad=100)[0] == field
+
+    with open('seg.fits', 'a') as f:
+        f.write('new segments')
+    touch_later('seg.fits')
+    assert plan(field)[0] == field
+
+
+def test_plan_models_changed_flt(field):
+    run(field)
+
+    write_flt('ib01_flt.fits', *CENTERS['ib01_flt.fits'], value=1.)
+    touch_later('ib01_flt.fits')
+    assert plan(field)[0] == ['ib01_flt.fits']
+
+
+def test_plan_models_missing_model(field):
+    run(field)
+
+    os.remove('ia01.01.GrismFLT.pkl')
+    os.remove('ia01.01.GrismFLT.fits')
+    assert plan(field)[0] == ['ia01_flt.fits']
+
+
+def test_plan_models_catalog_changes_near_flts(field):
+    run(field)
+
+    # A new object on ia01, and object 2 brighter, on ib01.
+    write_catalog('cat.fits', [(1, 189.2, 62.2, 20.), (2, 189.2, 63.2, 21.), 
+        (3, 189.201, 62.2, 23.)])
+    touch_later('cat.fits')
+    assert run(field) == ['ia01_flt.fits']
+
+    write_catalog('cat.fits', [(1, 189.2, 62.2, 20.), (2, 189.2, 63.2, 19.), 
+        (3, 189.201, 62.2, 23.)])
+    touch_later('cat.fits')
+    assert run(field) == ['ib01_flt.fits']
+
+    # An object far from both.
+    write_catalog('cat.fits', [(1, 189.2, 62.2, 20.), (2, 189.2, 63.2, 19.), 
+        (3, 189.201, 62.2, 23.), (4, 10., -30., 22.)])
+    touch_later('cat.fits')
+    assert run(field) == []
+
+
+#-------------------------------------------------------------------------------
+
+def test_needs_refinement(field):
+    refinement = {'refine':'all', 'poly_order':2}
+    stale, manifest = plan(field, refinement=refinement)
+    assert needs_refinement(field, stale, manifest, MANIFEST)
+
+    save_models(stale)
+    manifest['refined'] = refined_digests(field, manifest)
+    save_manifest(manifest, MANIFEST)
+    stale, manifest = plan(field, refinement=refinement)
+    assert stale == []
+    assert not needs_refinement(field, stale, manifest, MANIFEST)
+
+    # Other refinement parameters.
+    stale, manifest = plan(field, refinement={'refine':'adaptive'})
+    assert needs_refinement(field, stale, manifest, MANIFEST)
+
+    # A group of fewer FLTs.
+    stale, manifest = plan(field[:1], refinement=refinement)
+    assert needs_refinement(field[:1], stale, manifest, MANIFEST)
+
+    # A model rewritten since, e.g. by another field's refinement.
+    with open('ib01.01.GrismFLT.fits', 'a') as f:
+        f.write(' refined with GN3')
+    touch_later('ib01.01.GrismFLT.fits')
+    stale, manifest = plan(field, refinement=refinement)
+    assert needs_refinement(field, stale, manifest, MANIFEST)
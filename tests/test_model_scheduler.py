@@ -0,0 +1,88 @@
+"""
+Tests of `model_scheduler`: the number of workers, the cost estimates and
+the order in which FLTs are modeled.
+"""
+
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip('grizli')
+
+import model_scheduler
+from model_scheduler import estimate_costs, model_flts, model_workers
+
+
+MANIFEST = {'rows':{'1':['a', 189.1, 62.2], '2':['b', 189.2, 62.3]}}
+
+
+@pytest.fixture
+def counts(monkeypatch):
+    """ Catalog objects dispersing onto each FLT, in place of projecting
+    the catalog through the FLT's WCS.
+    """
+    counts = {'ia01_flt.fits':10, 'ia02_flt.fits':40, 'ia03_flt.fits':20}
+    monkeypatch.setattr(model_scheduler, 'flt_object_count',
+        lambda flt, radec, pad=200: counts[flt])
+    return counts
+
+
+#-------------------------------------------------------------------------------
+
+def test_model_workers(monkeypatch):
+    monkeypatch.setattr(model_scheduler, 'available_memory', lambda: 10.e9)
+
+    assert model_workers(20, memory_per_worker=2.e9, cores=16) == 4
+    assert model_workers(3, memory_per_worker=2.e9, cores=16) == 3
+    assert model_workers(20, memory_per_worker=1.e8, cores=6) == 6
+    assert model_workers(20, memory_per_worker=1.e12, cores=6) == 1
+
+
+#-------------------------------------------------------------------------------
+
+def test_estimate_costs(counts):
+    flts = sorted(counts)
+    costs, n_objects = estimate_costs(flts, MANIFEST)
+    assert list(n_objects) == [10, 40, 20]
+    assert list(costs) == [10., 40., 20.]
+
+    # The median of 2 and 4 s per object in the history; ia02 was timed 
+    # itself.
+    history = {'ia02_flt.fits':[80., 40], 'ib09_flt.fits':[40., 10]}
+    costs, n_objects = estimate_costs(flts, MANIFEST, history=history)
+    assert list(costs) == [30., 80., 60.]
+
+
+#-------------------------------------------------------------------------------
+
+def test_model_flts_biggest_first(tmp_path, monkeypatch, counts):
+    monkeypatch.chdir(tmp_path)
+    log = str(tmp_path / 'modeled.log')
+
+    class GroupFLT():
+        def __init__(self, grism_files=[], ref_file=None, **kwargs):
+            self.flt = grism_files[0]
+            assert ref_file == 'ref.fits'
+
+        def compute_full_model(self, **kwargs):
+            pass
+
+        def save_full_data(self):
+            with open(log, 'a') as f:
+                f.write(self.flt + '\n')
+
+    monkeypatch.setattr(model_scheduler, 'GroupFLT', GroupFLT)
+    history_path = str(tmp_path / 'GN2.model_times.json')
+
+    assert model_flts(sorted(counts), MANIFEST, ref_file='ref.fits',
+        seg_file='seg.fits', workers=1, history_path=history_path,
+        cutouts=False) == 1
+
+    with open(log) as f:
+        assert f.read().split() == ['ia02_flt.fits', 'ia03_flt.fits',
+            'ia01_flt.fits']
+    with open(history_path) as f:
+        history = json.load(f)
+    assert sorted(history) == sorted(counts)
+    assert history['ia02_flt.fits'][1] == 40
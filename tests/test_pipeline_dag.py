@@ -0,0 +1,83 @@
+"""
+Tests of `pipeline_dag.run_dag`: tasks are skipped while up to date, rerun
+when an input changes, and block the tasks waiting for them on failure.
+"""
+
+import pytest
+
+pytest.importorskip('grizli')
+
+from pipeline_dag import Task, run_dag
+
+
+def _copy(src, dest, log):
+    with open(log, 'a') as f:
+        f.write(dest + '\n')
+    with open(src) as f:
+        text = f.read()
+    with open(dest, 'w') as f:
+        f.write(text.upper())
+
+
+def _fail():
+    raise RuntimeError('bad input')
+
+
+def _runs(log):
+    try:
+        with open(log) as f:
+            return f.read().split()
+    except IOError:
+        return []
+
+
+def _tasks(tmp_path):
+    raw, mid, out, log = [str(tmp_path / name) for name in
+        ['raw.txt', 'mid.txt', 'out.txt', 'runs.log']]
+    return [Task('first', _copy, args=(raw, mid, log), inputs=[raw],
+            outputs=[mid]),
+        Task('second', _copy, args=(mid, out, log), inputs=[mid],
+            outputs=[out], deps=['first'])]
+
+
+#-------------------------------------------------------------------------------
+
+def test_skip_and_rerun(tmp_path):
+    state = str(tmp_path / 'dag_state.json')
+    log = str(tmp_path / 'runs.log')
+    with open(str(tmp_path / 'raw.txt'), 'w') as f:
+        f.write('grism')
+
+    status = run_dag(_tasks(tmp_path), state_path=state, jobs=2)
+    assert list(status.values()) == ['done', 'done']
+    assert len(_runs(log)) == 2
+
+    status = run_dag(_tasks(tmp_path), state_path=state, jobs=2)
+    assert list(status.values()) == ['up to date', 'up to date']
+    assert len(_runs(log)) == 2
+
+    with open(str(tmp_path / 'raw.txt'), 'a') as f:
+        f.write(' flt')
+    status = run_dag(_tasks(tmp_path), state_path=state, jobs=2)
+    assert list(status.values()) == ['done', 'done']
+    assert len(_runs(log)) == 4
+    with open(str(tmp_path / 'out.txt')) as f:
+        assert f.read() == 'GRISM FLT'
+
+    # A deleted output reruns only the task that wrote it.
+    (tmp_path / 'out.txt').unlink()
+    status = run_dag(_tasks(tmp_path), state_path=state, jobs=2)
+    assert list(status.values()) == ['up to date', 'done']
+
+
+#-------------------------------------------------------------------------------
+
+def test_failure_blocks(tmp_path):
+    state = str(tmp_path / 'dag_state.json')
+    with open(str(tmp_path / 'raw.txt'), 'w') as f:
+        f.write('grism')
+    tasks = _tasks(tmp_path)
+    tasks[0].func, tasks[0].args = _fail, ()
+
+    status = run_dag(tasks, state_path=state)
+    assert status == {'first':'failed', 'second':'blocked'}
@@ -0,0 +1,78 @@
+"""
+Tests of `poly_prefit.batch_prefit`: the batched least squares agree with
+one `lstsq` per object and with `MultiBeam.template_at_z`.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+grizli = pytest.importorskip('grizli')
+
+import poly_prefit
+
+
+#-------------------------------------------------------------------------------
+
+def test_lstsq_parity(monkeypatch):
+    rng = np.random.RandomState(2)
+    problems = {}
+    for mb, (n_pix, n_bg) in enumerate([(400, 2), (250, 1), (300, 2)]):
+        A = rng.normal(size=(n_pix, n_bg + 4))
+        y = A.dot(rng.normal(size=n_bg + 4)) + 0.01 * rng.normal(size=n_pix)
+        problems[mb] = (A, y)
+
+    monkeypatch.setattr(poly_prefit, '_design_matrix',
+        lambda mb, templates: problems[mb])
+    monkeypatch.setattr(poly_prefit, '_pfit_dict',
+        lambda mb, templates, coeffs, covar, chi2:
+            {'coeffs':coeffs, 'covar':covar, 'chi2':chi2})
+
+    fits = poly_prefit.batch_prefit(list(problems), templates={})
+
+    for mb, pfit in enumerate(fits):
+        A, y = problems[mb]
+        coeffs = np.linalg.lstsq(A, y, rcond=None)[0]
+        assert np.allclose(pfit['coeffs'], coeffs, rtol=1e-8, atol=1e-10)
+        assert np.isclose(pfit['chi2'], ((y - A.dot(coeffs))**2).sum())
+        assert np.allclose(pfit['covar'], np.linalg.inv(A.T.dot(A)))
+
+
+#-------------------------------------------------------------------------------
+
+def test_template_at_z_parity(tmp_path):
+    if not os.path.isdir(os.path.join(grizli.GRIZLI_PATH, 'CONF')):
+        pytest.skip('grizli CONF files are not installed')
+
+    from astropy.io import fits as pyfits
+    from grizli.model import GroupFLT
+    from grizli.multifit import MultiBeam
+    from synthetic_field import make_field
+
+    field = make_field(str(tmp_path), n_sources=40, n_visits=1, n_grism=1,
+        ref_size=1200)
+    grism = [f for f in field['flts']
+        if pyfits.getheader(f, 0).get('FILTER') == 'G102']
+    p = field['pointing']
+    grp = GroupFLT(grism_files=grism,
+        ref_file=os.path.join(field['ref'], p.ref_image),
+        seg_file=os.path.join(field['ref'], p.seg_map),
+        catalog=os.path.join(field['ref'], p.catalog), pad=200)
+    grp.compute_full_model(mag_limit=25)
+
+    ids = [id for id in grp.catalog['NUMBER'][:10]]
+    mbs = []
+    for id in ids:
+        beams = grp.get_beams(id, size=32)
+        if beams:
+            mbs.append(MultiBeam(beams, fcontam=1.))
+    assert mbs
+
+    templates = poly_prefit.poly_templates()
+    for mb, pfit in zip(mbs, poly_prefit.batch_prefit(mbs, templates)):
+        ref = mb.template_at_z(z=0, templates=templates, fit_background=True,
+            fitter='lstsq', fwhm=1400, get_uncertainties=2)
+        assert np.allclose(pfit['coeffs'], ref['coeffs'], rtol=1e-4,
+            atol=1e-6 * np.abs(ref['coeffs']).max())
+        assert np.isclose(pfit['chi2'], ref['chi2'], rtol=1e-4)
@@ -0,0 +1,93 @@
+"""
+Tests of `prep_pool`: pairing of direct and grism visits, and reporting of
+pairs that fail.
+"""
+
+import os
+import time
+
+import prep_pool
+from prep_pool import match_visits, plan_pairs, prep_pairs
+
+
+def _visit(product):
+    return {'product':product, 'files':[product + '_flt.fits']}
+
+
+VISITS = [_visit(p) for p in ['gn2-cxt-51-345.0-f105w',
+    'gn2-cxt-51-345.0-g102', 'gn2-cxt-52-345.0-f105w',
+    'gn2-cxt-53-345.0-g102', 'gn2-cxt-54-345.0-f140w',
+    'gn2-cxt-54-345.0-g141']]
+
+
+#-------------------------------------------------------------------------------
+
+def test_plan_pairs():
+    pairs = plan_pairs(VISITS, configs=[('G102', 'F105W'), ('G141', 'F140W')])
+
+    assert [(d['product'], g['product']) for d, g in pairs] == [
+        ('gn2-cxt-51-345.0-f105w', 'gn2-cxt-51-345.0-g102'),
+        ('gn2-cxt-54-345.0-f140w', 'gn2-cxt-54-345.0-g141')]
+
+
+#-------------------------------------------------------------------------------
+
+def test_match_visits():
+    pairs = match_visits(VISITS, ref_filter='F140W', ref_grism='G141')
+
+    assert [(d['product'], g['product']) for d, g in pairs] == [
+        ('gn2-cxt-54-345.0-f140w', 'gn2-cxt-54-345.0-g141')]
+    assert match_visits(VISITS, ref_filter='F105W', ref_grism='G141') == []
+
+
+#-------------------------------------------------------------------------------
+
+def test_prep_pairs_failures(tmp_path, monkeypatch):
+    def process_pair(direct, grism, radec, run_dir='.', **kwargs):
+        if direct['product'].startswith('gn2-cxt-52'):
+            raise IOError('no overlap')
+        if direct['product'].startswith('gn2-cxt-53'):
+            os._exit(9)
+        return None, []
+
+    monkeypatch.setattr(prep_pool, 'process_pair', process_pair)
+    pairs = [(_visit('gn2-cxt-{}-345.0-f105w'.format(n)),
+        _visit('gn2-cxt-{}-345.0-g102'.format(n))) for n in [51, 52, 53]]
+
+    failed = prep_pairs(pairs, 'radec.cat', run_dir=str(tmp_path), workers=2)
+
+    failed = {direct:error for direct, grism, error in failed}
+    assert sorted(failed) == ['gn2-cxt-52-345.0-f105w',
+        'gn2-cxt-53-345.0-f105w']
+    assert 'no overlap' in failed['gn2-cxt-52-345.0-f105w']
+    assert 'code 9' in failed['gn2-cxt-53-345.0-f105w']
+
+
+#-------------------------------------------------------------------------------
+
+def test_prep_pairs_of_one_direct_visit_in_turn(tmp_path, monkeypatch):
+    log = str(tmp_path / 'runs.log')
+
+    def process_pair(direct, grism, radec, run_dir='.', **kwargs):
+        start = time.time()
+        time.sleep(0.3)
+        with open(log, 'a') as f:
+            f.write('{} {} {} {}\n'.format(direct['product'],
+                grism['product'], start, time.time()))
+        return None, []
+
+    monkeypatch.setattr(prep_pool, 'process_pair', process_pair)
+    direct = [_visit('gn2-cxt-51-345.0-f105w'), _visit('gn2-cxt-52-345.0-f105w')]
+    pairs = [(direct[0], _visit('gn2-cxt-51-345.0-g102')),
+        (direct[0], _visit('gn2-cxt-51-345.0-g141')),
+        (direct[1], _visit('gn2-cxt-52-345.0-g102'))]
+
+    assert prep_pairs(pairs, 'radec.cat', run_dir=str(tmp_path),
+        workers=3) == []
+
+    with open(log) as f:
+        runs = [line.split() for line in f]
+    assert len(runs) == 3
+    spans = sorted([(float(start), float(end)) for d, g, start, end in runs
+        if d == direct[0]['product']])
+    assert spans[0][1] <= spans[1][0]
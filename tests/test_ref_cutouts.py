@@ -0,0 +1,83 @@
+"""
+Tests of `ref_cutouts.cutout`: the cutout maps the same pixels to the same
+sky as the mosaic.
+"""
+
+import numpy as np
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from ref_cutouts import cutout
+
+
+def _mosaic(path, bscale=None):
+    """ A 400x300 mosaic with a tangent-plane WCS, and pixel values that
+    encode their position.
+    """
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [189.2, 62.2]
+    wcs.wcs.crpix = [150.5, 200.5]
+    wcs.wcs.cdelt = [-0.06 / 3600, 0.06 / 3600]
+    header = wcs.to_header()
+    header['PHOTFLAM'] = 3.0e-20
+    header['FILTER'] = 'F105W'
+
+    y, x = np.indices((400, 300))
+    data = (1000. * y + x).astype(np.float32)
+    hdu = fits.PrimaryHDU(data=data, header=header)
+    if bscale is not None:
+        hdu.scale('int32', bscale=bscale, bzero=0)
+    hdu.writeto(path)
+
+    return data, wcs
+
+
+#-------------------------------------------------------------------------------
+
+def test_wcs_round_trip(tmp_path):
+    path = str(tmp_path / 'ref.fits')
+    data, wcs = _mosaic(path)
+    ra, dec = wcs.all_pix2world([50.3, 119.6], [80.3, 209.6], 0)
+
+    hdu = cutout(path, ra, dec, margin=5)
+
+    # Pixels x 45..125, y 75..215.
+    assert hdu.data.shape == (141, 81)
+    assert hdu.header['CUTBOX'] == '[46:126,76:216]'
+    assert hdu.header['PHOTFLAM'] == 3.0e-20
+    assert hdu.header['FILTER'] == 'F105W'
+
+    # Every pixel of the cutout lands on the mosaic pixel of the same value.
+    sub = WCS(hdu.header)
+    y, x = np.indices(hdu.data.shape)
+    r, d = sub.all_pix2world(x.ravel(), y.ravel(), 0)
+    mx, my = wcs.all_world2pix(r, d, 0)
+    mx, my = np.round(mx).astype(int), np.round(my).astype(int)
+    assert np.allclose(mx - x.ravel(), 45, atol=1e-6)
+    assert np.array_equal(hdu.data.ravel(), data[my, mx])
+
+
+#-------------------------------------------------------------------------------
+
+def test_scaled_image(tmp_path):
+    path = str(tmp_path / 'ref.fits')
+    data, wcs = _mosaic(path, bscale=0.5)
+    ra, dec = wcs.all_pix2world([10.3, 19.6], [10.3, 19.6], 0)
+
+    hdu = cutout(path, ra, dec, margin=0)
+
+    assert hdu.data.dtype == np.float32
+    assert 'BSCALE' not in hdu.header
+    assert np.allclose(hdu.data, data[10:21, 10:21], atol=0.5)
+
+
+#-------------------------------------------------------------------------------
+
+def test_off_image(tmp_path):
+    path = str(tmp_path / 'ref.fits')
+    data, wcs = _mosaic(path)
+    ra, dec = wcs.all_pix2world([1000., 1100.], [1000., 1100.], 0)
+
+    assert cutout(path, ra, dec) is None
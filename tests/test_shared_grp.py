@@ -0,0 +1,88 @@
+"""
+Tests of `shared_grp.SharedGroup`: the group attached in another process
+sees the same arrays, mapped ones are mapped again rather than copied, and
+releasing gives the arrays back to the owner.
+"""
+
+import multiprocessing
+import pickle
+
+import numpy as np
+
+from shared_grp import SharedGroup, map_grp
+
+
+class Image():
+    def __init__(self, data):
+        self.data = data
+
+
+class FLT():
+    def __init__(self, model, sci, seg):
+        self.model = model
+        self.grism = Image({'SCI':sci, 'DQ':np.zeros(4, dtype=np.int16)})
+        self.seg = seg
+
+
+class Group():
+    def __init__(self, FLTs):
+        self.FLTs = FLTs
+
+
+def _group(tmp_path):
+    rng = np.random.RandomState(3)
+    seg = np.memmap(str(tmp_path / 'seg.dat'), dtype='>i4', mode='w+',
+        shape=(150, 130))
+    seg[...] = rng.randint(0, 50, seg.shape)
+    seg.flush()
+    # Copy-on-write, and offset into the file, as `lazy_grp` maps them.
+    seg = np.memmap(str(tmp_path / 'seg.dat'), dtype='>i4', mode='c',
+        offset=4 * 130, shape=(149, 130))
+    flts = [FLT(rng.normal(size=(120, 110)), rng.normal(size=(100, 90)), seg)]
+    return Group(flts)
+
+
+def _sums(grp, task):
+    flt = grp.FLTs[0]
+    return [float(flt.model.sum()), float(flt.grism.data['SCI'].sum()),
+        int(flt.seg.sum()), isinstance(flt.seg, np.memmap)]
+
+
+#-------------------------------------------------------------------------------
+
+def test_attach_round_trip(tmp_path):
+    grp = _group(tmp_path)
+    model, sci = grp.FLTs[0].model.copy(), grp.FLTs[0].grism.data['SCI'].copy()
+    expected = _sums(grp, None)
+
+    with SharedGroup(grp, min_bytes=1024) as shared:
+        assert sorted([spec[1] for spec in shared.specs]) == [
+            ('grism', 'SCI'), ('model',)]
+        assert [spec[1] for spec in shared.mapped] == [('seg',)]
+
+        # The pickle carries neither the shared nor the mapped arrays.
+        blob = pickle.dumps(shared)
+        assert len(blob) < 32 * 1024
+
+        attached = pickle.loads(blob)
+        flt = attached.grp.FLTs[0]
+        assert np.array_equal(flt.model, model)
+        assert np.array_equal(flt.grism.data['DQ'], np.zeros(4))
+        assert _sums(attached.grp, None) == expected
+
+        # Writes through one handle are seen through the other.
+        shared.grp.FLTs[0].model[0, 0] = 1.e6
+        assert flt.model[0, 0] == 1.e6
+        attached.release()
+
+        ctx = 'spawn' if 'spawn' in multiprocessing.get_all_start_methods() \
+            else 'fork'
+        assert map_grp(shared, _sums, [0, 1], workers=2, context=ctx) == \
+            [_sums(shared.grp, None)] * 2
+
+    flt = grp.FLTs[0]
+    assert shared.specs == [] and shared.mapped == []
+    assert flt.model.base is None
+    assert np.array_equal(flt.grism.data['SCI'], sci)
+    assert flt.model[0, 0] == 1.e6
+    assert isinstance(flt.seg, np.memmap)
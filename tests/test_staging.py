@@ -0,0 +1,84 @@
+"""
+Tests of `staging`: files are linked where they can be, never linked when
+they will be modified, and their origin is recorded.
+"""
+
+import errno
+import os
+
+import staging
+from staging import stage_file, stage_files
+
+
+def _source(tmp_path, name='ia01_flt.fits', text='grism exposure'):
+    src_dir = tmp_path / 'prep'
+    src_dir.mkdir(exist_ok=True)
+    src = src_dir / name
+    src.write_text(text)
+    run_dir = tmp_path / 'run'
+    run_dir.mkdir(exist_ok=True)
+    return str(src), str(run_dir)
+
+
+#-------------------------------------------------------------------------------
+
+def test_hardlink_and_readme(tmp_path):
+    src, run_dir = _source(tmp_path)
+
+    staged = stage_files([src], dest=run_dir, readme='README.txt')
+
+    assert staged == [os.path.join(run_dir, 'ia01_flt.fits')]
+    assert os.path.samefile(src, staged[0])
+    with open(os.path.join(run_dir, 'README.txt')) as f:
+        readme = f.read()
+    assert 'ia01_flt.fits hardlink sha1:{} {}'.format(staging.checksum(src),
+        src) in readme
+
+    # Staged again: nothing to do.
+    assert stage_file(src, dest=run_dir)[1] == 'existing'
+
+
+#-------------------------------------------------------------------------------
+
+def test_mutable_never_shares_the_source(tmp_path):
+    src, run_dir = _source(tmp_path)
+    # An earlier, immutable staging left a hardlink.
+    stage_file(src, dest=run_dir)
+
+    dst, method, src_sum = stage_file(src, dest=run_dir, mutable=True)
+
+    assert method in staging.MUTABLE_METHODS
+    assert not os.path.samefile(src, dst)
+    with open(dst, 'a') as f:
+        f.write(' modified in place')
+    assert staging.checksum(src) == src_sum
+
+
+#-------------------------------------------------------------------------------
+
+def test_falls_back_across_filesystems(tmp_path, monkeypatch):
+    src, run_dir = _source(tmp_path)
+
+    def link(src, dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    monkeypatch.setattr(os, 'link', link)
+    dst, method, src_sum = stage_file(src, dest=run_dir)
+
+    assert method in ['reflink', 'symlink']
+    with open(dst) as f:
+        assert f.read() == 'grism exposure'
+
+
+#-------------------------------------------------------------------------------
+
+def test_replaces_a_different_file(tmp_path):
+    src, run_dir = _source(tmp_path)
+    with open(os.path.join(run_dir, 'ia01_flt.fits'), 'w') as f:
+        f.write('an older exposure')
+
+    dst, method, src_sum = stage_file(src, dest=run_dir)
+
+    assert method == 'hardlink'
+    with open(dst) as f:
+        assert f.read() == 'grism exposure'
@@ -0,0 +1,70 @@
+"""
+Tests of `template_cache.load_cached_templates`: a template set is built
+once, read back the same, and rebuilt when its arguments or the template
+files change.
+"""
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+grizli = pytest.importorskip('grizli')
+
+import grizli.utils
+
+from template_cache import load_cached_templates
+
+
+@pytest.fixture
+def builds(tmp_path, monkeypatch):
+    """ Stands in for `load_templates`, recording its arguments, with a
+    templates directory of its own.
+    """
+    builds = []
+
+    def load_templates(**kwargs):
+        builds.append(kwargs)
+        templates = OrderedDict()
+        for i, name in enumerate(['fsps 1', 'line Ha']):
+            wave = np.linspace(3000., 12000., 50 + 10 * i)
+            templates[name] = grizli.utils.SpectrumTemplate(wave=wave,
+                flux=np.sin(wave / 1000. + i) + kwargs['fwhm'], name=name)
+        return templates
+
+    (tmp_path / 'grizli' / 'templates').mkdir(parents=True)
+    monkeypatch.setattr(grizli, 'GRIZLI_PATH', str(tmp_path / 'grizli'),
+        raising=False)
+    monkeypatch.setattr(grizli.utils, 'load_templates', load_templates)
+    return builds
+
+
+#-------------------------------------------------------------------------------
+
+def test_built_once(tmp_path, builds):
+    cache_dir = str(tmp_path / 'cache')
+    first = load_cached_templates(cache_dir=cache_dir, fwhm=1200)
+    again = load_cached_templates(cache_dir=cache_dir, fwhm=1200)
+
+    assert len(builds) == 1
+    assert list(again) == ['fsps 1', 'line Ha']
+    for name in first:
+        assert np.array_equal(again[name].wave, first[name].wave)
+        assert np.array_equal(again[name].flux, first[name].flux)
+    assert len(again['line Ha'].wave) == 60
+
+
+#-------------------------------------------------------------------------------
+
+def test_rebuilt_on_change(tmp_path, builds):
+    cache_dir = str(tmp_path / 'cache')
+    load_cached_templates(cache_dir=cache_dir, fwhm=1200)
+    templates = load_cached_templates(cache_dir=cache_dir, fwhm=1000)
+    assert len(builds) == 2
+    assert builds[1]['fwhm'] == 1000
+    assert templates['fsps 1'].flux.min() > 998
+
+    (tmp_path / 'grizli' / 'templates' / 'fsps_QSF_12_v3.txt').write_text('')
+    load_cached_templates(cache_dir=cache_dir, fwhm=1200)
+    assert len(builds) == 3